@@ -14,6 +14,7 @@ each represents "invVR" matrix =
 fm == feature_matches :: [(Int, Int)]
 indices into kpts{1,2} indicating a match
 */
+#include <algorithm>
 #include <cmath>
 #include <cstdio>
 #include <opencv2/core/core.hpp>
@@ -54,6 +55,9 @@ indices into kpts{1,2} indicating a match
 using cv::Matx;
 using std::vector;
 
+// Number of hypotheses the float32 search re-scores with the exact tests
+#define SVER_F32_RESCORE 8
+
 // adapted from hesaff's helpers.h
 #ifndef M_TAU
 #define M_TAU 6.28318
@@ -138,7 +142,7 @@ template<typename T> inline T ori_distance(const Matx<T, 3, 3>& kpt1, const Matx
     // ltool.ori_distance
     T delta = fabs(ori1 - ori2);
     delta = ensure_0toTau(delta);
-    return std::min(delta, M_TAU - delta);
+    return std::min(delta, (T)(M_TAU - delta));
 }
 
 template<typename T> inline Matx<T, 3, 3> get_Aff_mat(const Matx<T, 3, 3>& invVR1_m,
@@ -150,6 +154,674 @@ template<typename T> inline Matx<T, 3, 3> get_Aff_mat(const Matx<T, 3, 3>& invVR
     return Aff_mat;
 }
 
+template<typename T> inline bool test_affine_correspondence(
+        const Matx<T, 3, 3>& Aff_mat, const Matx<T, 3, 3>& invVR1_m,
+        const Matx<T, 3, 3>& invVR2_m, T xy_thresh_sqrd, T scale_thresh_sqrd,
+        T ori_thresh, T& xy_err, T& ori_err, T& scale_err)
+{
+    // _test_hypothesis_inliers for a single correspondence
+    Matx<T, 3, 3> invVR1_mt = Aff_mat * invVR1_m;
+    xy_err = xy_distance(invVR1_mt, invVR2_m);
+    ori_err = ori_distance(invVR1_mt, invVR2_m);
+    scale_err = det_distance(invVR1_mt, invVR2_m);
+    return (xy_err    <    xy_thresh_sqrd) &&
+           (scale_err < scale_thresh_sqrd) &&
+           (ori_err   <        ori_thresh);
+}
+
+// ktool.get_invVR_mats3x3 for the matching keypoints
+inline void get_matching_invVRs(const double* kpts1, const double* kpts2,
+                                const size_t* fm, size_t nMatch,
+                                vector<Matx<double, 3, 3> >& invVR1s,
+                                vector<Matx<double, 3, 3> >& invVR2s)
+{
+    invVR1s.resize(nMatch);
+    invVR2s.resize(nMatch);
+    for(size_t ix = 0; ix < nMatch; ix++)
+    {
+        const double* kpt1 = &kpts1[6 * fm[(2 * ix) + 0]];
+        const double* kpt2 = &kpts2[6 * fm[(2 * ix) + 1]];
+        invVR1s[ix] = get_invV_mat(kpt1[0], kpt1[1], kpt1[2], kpt1[3], kpt1[4], kpt1[5]);
+        invVR2s[ix] = get_invV_mat(kpt2[0], kpt2[1], kpt2[2], kpt2[3], kpt2[4], kpt2[5]);
+    }
+}
+
+/*
+Inlier weight of one affine hypothesis. Projecting only the keypoint center
+is a handful of flops, so the xy test is done first and the full matrix
+product, scale, and orientation errors are only computed for matches inside
+the xy radius (usually a small fraction of them).
+*/
+inline double affine_hypothesis_weight(const Matx<double, 3, 3>& Aff_mat,
+                                       const vector<Matx<double, 3, 3> >& invVR1s,
+                                       const vector<Matx<double, 3, 3> >& invVR2s,
+                                       const double* fs, size_t nMatch,
+                                       double xy_thresh_sqrd, double scale_thresh_sqrd,
+                                       double ori_thresh)
+{
+    double xy_err, ori_err, scale_err;
+    double weight = 0;
+    for(size_t ix2 = 0; ix2 < nMatch; ix2++)
+    {
+        const Matx<double, 3, 3>& invVR1_m = invVR1s[ix2];
+        const Matx<double, 3, 3>& invVR2_m = invVR2s[ix2];
+        // same arithmetic as (Aff_mat * invVR1_m)(0:2, 2)
+        const double x1_t = Aff_mat(0, 0) * invVR1_m(0, 2) + Aff_mat(0, 1) * invVR1_m(1, 2) + Aff_mat(0, 2);
+        const double y1_t = Aff_mat(1, 0) * invVR1_m(0, 2) + Aff_mat(1, 1) * invVR1_m(1, 2) + Aff_mat(1, 2);
+        const double dx = invVR2_m(0, 2) - x1_t, dy = invVR2_m(1, 2) - y1_t;
+        if(!((dx * dx + dy * dy) < xy_thresh_sqrd))
+        {
+            continue;
+        }
+        if(test_affine_correspondence(Aff_mat, invVR1_m, invVR2_m,
+                                      xy_thresh_sqrd, scale_thresh_sqrd, ori_thresh,
+                                      xy_err, ori_err, scale_err))
+        {
+            weight += fs[ix2];
+        }
+    }
+    return weight;
+}
+
+// Writes the inliers, errors (3 x nMatch), and matrix of the chosen hypothesis
+inline void write_affine_hypothesis(size_t hypo_ix,
+                                    const vector<Matx<double, 3, 3> >& invVR1s,
+                                    const vector<Matx<double, 3, 3> >& invVR2s,
+                                    size_t nMatch, double xy_thresh_sqrd,
+                                    double scale_thresh_sqrd, double ori_thresh,
+                                    bool* out_inliers, double* out_errors, double* out_matrix)
+{
+    Matx<double, 3, 3> Aff_mat = get_Aff_mat(invVR1s[hypo_ix], invVR2s[hypo_ix]);
+    memcpy(out_matrix, &Aff_mat, sizeof(Matx<double, 3, 3>));
+    for(size_t ix2 = 0; ix2 < nMatch; ix2++)
+    {
+        out_inliers[ix2] = test_affine_correspondence(
+            Aff_mat, invVR1s[ix2], invVR2s[ix2],
+            xy_thresh_sqrd, scale_thresh_sqrd, ori_thresh,
+            out_errors[(0 * nMatch) + ix2],
+            out_errors[(1 * nMatch) + ix2],
+            out_errors[(2 * nMatch) + ix2]);
+    }
+}
+
+/*
+Serial version of get_best_affine_inliers used by the batched entry point,
+which parallelizes over verification jobs instead of over hypotheses.
+
+The invVR matrices are built once per correspondence instead of once per
+hypothesis pair. Only the weight of each hypothesis is tracked in the main
+loop; the errors and inliers of the winner are recomputed into the output at
+the end, so no scratch buffers are needed. Ties are broken towards the first
+hypothesis, which matches the argmax in the python implementation.
+*/
+inline double best_affine_inliers_serial(const double* kpts1, const double* kpts2,
+        const size_t* fm, const double* fs, size_t nMatch,
+        double xy_thresh_sqrd, double scale_thresh_sqrd, double ori_thresh,
+        vector<Matx<double, 3, 3> >& invVR1s, vector<Matx<double, 3, 3> >& invVR2s,
+        bool* out_inliers, double* out_errors, double* out_matrix)
+{
+    if(nMatch == 0)
+    {
+        return 0;
+    }
+    get_matching_invVRs(kpts1, kpts2, fm, nMatch, invVR1s, invVR2s);
+    double best_weight = -1;
+    size_t best_ix = 0;
+    for(size_t ix1 = 0; ix1 < nMatch; ix1++)
+    {
+        Matx<double, 3, 3> Aff_mat = get_Aff_mat(invVR1s[ix1], invVR2s[ix1]);
+        double weight = affine_hypothesis_weight(
+            Aff_mat, invVR1s, invVR2s, fs, nMatch,
+            xy_thresh_sqrd, scale_thresh_sqrd, ori_thresh);
+        if(weight > best_weight)
+        {
+            best_weight = weight;
+            best_ix = ix1;
+        }
+    }
+    write_affine_hypothesis(best_ix, invVR1s, invVR2s, nMatch, xy_thresh_sqrd,
+                            scale_thresh_sqrd, ori_thresh, out_inliers,
+                            out_errors, out_matrix);
+    return best_weight;
+}
+
+// Orders hypothesis indexes by descending weight (ties towards lower index)
+struct HypothesisWeightGreater
+{
+    const vector<double>& weights;
+    HypothesisWeightGreater(const vector<double>& weights_) : weights(weights_) {}
+    bool operator()(size_t ix1, size_t ix2) const
+    {
+        return (weights[ix1] > weights[ix2]) ||
+               (weights[ix1] == weights[ix2] && ix1 < ix2);
+    }
+};
+
+/*
+Structure-of-arrays layout of the matching invVR matrices used by the float32
+kernel. Each invVR is [[a b x], [c d y], [0 0 1]] and every member holds that
+entry for all matches, so the scoring loop is a run of elementwise float ops
+the compiler can vectorize (instead of striding over 3x3 double Matx).
+*/
+struct InvVRsSoA
+{
+    vector<float> a, b, c, d, x, y;
+    // determinant (squared scale) and norm of the first row (orientation)
+    vector<float> det, nrm;
+
+    void resize(size_t n)
+    {
+        a.resize(n); b.resize(n); c.resize(n); d.resize(n);
+        x.resize(n); y.resize(n); det.resize(n); nrm.resize(n);
+    }
+
+    void set(size_t ix, const float* kpt)
+    {
+        // same as get_invV_mat
+        const double ct = cos((double)kpt[5]), st = sin((double)kpt[5]);
+        a[ix] = (float)(kpt[2] * ct);
+        b[ix] = (float)(kpt[2] * -st);
+        c[ix] = (float)(kpt[3] * ct + kpt[4] * st);
+        d[ix] = (float)(kpt[3] * -st + kpt[4] * ct);
+        x[ix] = kpt[0];
+        y[ix] = kpt[1];
+        det[ix] = a[ix] * d[ix] - b[ix] * c[ix];
+        nrm[ix] = sqrtf(a[ix] * a[ix] + b[ix] * b[ix]);
+    }
+
+    Matx<float, 3, 3> mat(size_t ix) const
+    {
+        return Matx<float, 3, 3>(a[ix], b[ix], x[ix],
+                                 c[ix], d[ix], y[ix],
+                                 0.0f,  0.0f,  1.0f);
+    }
+};
+
+inline void get_matching_invVRs_soa(const float* kpts1, const float* kpts2,
+                                    const size_t* fm, size_t nMatch,
+                                    InvVRsSoA& invVR1s, InvVRsSoA& invVR2s)
+{
+    invVR1s.resize(nMatch);
+    invVR2s.resize(nMatch);
+    for(size_t ix = 0; ix < nMatch; ix++)
+    {
+        invVR1s.set(ix, &kpts1[6 * fm[(2 * ix) + 0]]);
+        invVR2s.set(ix, &kpts2[6 * fm[(2 * ix) + 1]]);
+    }
+}
+
+// Top two rows of get_Aff_mat(invVR1s[hypo_ix], invVR2s[hypo_ix]) (in double)
+inline Matx<double, 3, 3> get_Aff_mat_soa(const InvVRsSoA& invVR1s,
+                                          const InvVRsSoA& invVR2s, size_t hypo_ix)
+{
+    const double a1 = invVR1s.a[hypo_ix], b1 = invVR1s.b[hypo_ix];
+    const double c1 = invVR1s.c[hypo_ix], d1 = invVR1s.d[hypo_ix];
+    const double x1 = invVR1s.x[hypo_ix], y1 = invVR1s.y[hypo_ix];
+    const double a2 = invVR2s.a[hypo_ix], b2 = invVR2s.b[hypo_ix];
+    const double c2 = invVR2s.c[hypo_ix], d2 = invVR2s.d[hypo_ix];
+    const double x2 = invVR2s.x[hypo_ix], y2 = invVR2s.y[hypo_ix];
+    const double det1 = a1 * d1 - b1 * c1;
+    // inverse of the affine invVR1
+    const double ia = d1 / det1, ib = -b1 / det1, ic = -c1 / det1, id = a1 / det1;
+    const double itx = -(ia * x1 + ib * y1), ity = -(ic * x1 + id * y1);
+    return Matx<double, 3, 3>(
+               a2 * ia + b2 * ic, a2 * ib + b2 * id, a2 * itx + b2 * ity + x2,
+               c2 * ia + d2 * ic, c2 * ib + d2 * id, c2 * itx + d2 * ity + y2,
+               0.0, 0.0, 1.0);
+}
+
+/*
+float32 version of affine_hypothesis_weight. The loop is branch free so it can
+be vectorized:
+    * the scale of the transformed keypoint is det(Aff) * det1, and
+      det_distance < thresh is tested as two products instead of a division
+    * ori_distance < ori_thresh is tested as cos(delta) > cos(ori_thresh)
+      using the dot product of the first rows, which avoids atan2
+*/
+inline float affine_hypothesis_weight_soa(const Matx<double, 3, 3>& Aff_mat,
+                                          const InvVRsSoA& invVR1s,
+                                          const InvVRsSoA& invVR2s,
+                                          const float* fs, size_t nMatch,
+                                          float xy_thresh_sqrd, float scale_thresh_sqrd,
+                                          float ori_cos_thresh)
+{
+    const float A00 = (float)Aff_mat(0, 0), A01 = (float)Aff_mat(0, 1), A02 = (float)Aff_mat(0, 2);
+    const float A10 = (float)Aff_mat(1, 0), A11 = (float)Aff_mat(1, 1), A12 = (float)Aff_mat(1, 2);
+    const float det_aff = A00 * A11 - A01 * A10;
+    const float* a1 = &invVR1s.a[0];
+    const float* b1 = &invVR1s.b[0];
+    const float* c1 = &invVR1s.c[0];
+    const float* d1 = &invVR1s.d[0];
+    const float* x1 = &invVR1s.x[0];
+    const float* y1 = &invVR1s.y[0];
+    const float* det1 = &invVR1s.det[0];
+    const float* a2 = &invVR2s.a[0];
+    const float* b2 = &invVR2s.b[0];
+    const float* x2 = &invVR2s.x[0];
+    const float* y2 = &invVR2s.y[0];
+    const float* det2 = &invVR2s.det[0];
+    const float* nrm2 = &invVR2s.nrm[0];
+    float weight = 0;
+    #pragma omp simd reduction(+:weight)
+    for(size_t ix2 = 0; ix2 < nMatch; ix2++)
+    {
+        const float dx = x2[ix2] - (A00 * x1[ix2] + A01 * y1[ix2] + A02);
+        const float dy = y2[ix2] - (A10 * x1[ix2] + A11 * y1[ix2] + A12);
+        const float det1_t = det_aff * det1[ix2];
+        const float a1_t = A00 * a1[ix2] + A01 * c1[ix2];
+        const float b1_t = A00 * b1[ix2] + A01 * d1[ix2];
+        const float nrm1_t = sqrtf(a1_t * a1_t + b1_t * b1_t);
+        const float ori_dot = a1_t * a2[ix2] + b1_t * b2[ix2];
+        const bool is_inlier = ((dx * dx + dy * dy) < xy_thresh_sqrd) &
+                               (det1_t < scale_thresh_sqrd * det2[ix2]) &
+                               (det2[ix2] < scale_thresh_sqrd * det1_t) &
+                               (ori_dot > ori_cos_thresh * nrm1_t * nrm2[ix2]);
+        weight += is_inlier ? fs[ix2] : 0.0f;
+    }
+    return weight;
+}
+
+inline Matx<float, 3, 3> to_float_mat(const Matx<double, 3, 3>& Aff_mat)
+{
+    return Matx<float, 3, 3>(
+               (float)Aff_mat(0, 0), (float)Aff_mat(0, 1), (float)Aff_mat(0, 2),
+               (float)Aff_mat(1, 0), (float)Aff_mat(1, 1), (float)Aff_mat(1, 2),
+               0.0f, 0.0f, 1.0f);
+}
+
+/*
+Inlier weight of hypothesis hypo_ix under the exact scalar tests, i.e. the
+weight of the inliers write_affine_hypothesis_soa writes for it.
+*/
+inline float exact_affine_hypothesis_weight_soa(size_t hypo_ix,
+                                                const InvVRsSoA& invVR1s,
+                                                const InvVRsSoA& invVR2s,
+                                                const float* fs, size_t nMatch,
+                                                float xy_thresh_sqrd,
+                                                float scale_thresh_sqrd, float ori_thresh)
+{
+    const Matx<float, 3, 3> Aff_mat32 = to_float_mat(
+        get_Aff_mat_soa(invVR1s, invVR2s, hypo_ix));
+    float xy_err, ori_err, scale_err;
+    float weight = 0;
+    for(size_t ix2 = 0; ix2 < nMatch; ix2++)
+    {
+        if(test_affine_correspondence(Aff_mat32, invVR1s.mat(ix2), invVR2s.mat(ix2),
+                                      xy_thresh_sqrd, scale_thresh_sqrd, ori_thresh,
+                                      xy_err, ori_err, scale_err))
+        {
+            weight += fs[ix2];
+        }
+    }
+    return weight;
+}
+
+// float32 version of write_affine_hypothesis (uses the exact scalar tests)
+inline void write_affine_hypothesis_soa(size_t hypo_ix,
+                                        const InvVRsSoA& invVR1s,
+                                        const InvVRsSoA& invVR2s,
+                                        size_t nMatch, float xy_thresh_sqrd,
+                                        float scale_thresh_sqrd, float ori_thresh,
+                                        bool* out_inliers, float* out_errors, double* out_matrix)
+{
+    const Matx<double, 3, 3> Aff_mat = get_Aff_mat_soa(invVR1s, invVR2s, hypo_ix);
+    memcpy(out_matrix, &Aff_mat, sizeof(Matx<double, 3, 3>));
+    const Matx<float, 3, 3> Aff_mat32 = to_float_mat(Aff_mat);
+    for(size_t ix2 = 0; ix2 < nMatch; ix2++)
+    {
+        out_inliers[ix2] = test_affine_correspondence(
+            Aff_mat32, invVR1s.mat(ix2), invVR2s.mat(ix2),
+            xy_thresh_sqrd, scale_thresh_sqrd, ori_thresh,
+            out_errors[(0 * nMatch) + ix2],
+            out_errors[(1 * nMatch) + ix2],
+            out_errors[(2 * nMatch) + ix2]);
+    }
+}
+
+// Exact tau used by the python refinement tests (M_TAU above is truncated)
+#define SVER_TAU 6.283185307179586
+#define GRAVITY_THETA (SVER_TAU / 4)
+
+/*
+Eigen decomposition of a small symmetric matrix via cyclic Jacobi rotations.
+On return the diagonal of A holds the eigenvalues and the columns of V hold
+the corresponding eigenvectors. A is overwritten.
+*/
+template<int N> void jacobi_eigen_symmetric(double (&A)[N][N], double (&V)[N][N])
+{
+    double total = 0;
+    for(int p = 0; p < N; p++)
+    {
+        for(int q = 0; q < N; q++)
+        {
+            V[p][q] = (p == q) ? 1.0 : 0.0;
+            total += A[p][q] * A[p][q];
+        }
+    }
+    for(int sweep = 0; sweep < 100; sweep++)
+    {
+        double off = 0;
+        for(int p = 0; p < N; p++)
+        {
+            for(int q = p + 1; q < N; q++)
+            {
+                off += A[p][q] * A[p][q];
+            }
+        }
+        if(off <= 1e-30 * total)
+        {
+            break;
+        }
+        for(int p = 0; p < N; p++)
+        {
+            for(int q = p + 1; q < N; q++)
+            {
+                if(A[p][q] == 0)
+                {
+                    continue;
+                }
+                double theta = (A[q][q] - A[p][p]) / (2 * A[p][q]);
+                double t = (theta >= 0 ? 1.0 : -1.0) / (fabs(theta) + sqrt(theta * theta + 1));
+                double c = 1 / sqrt(t * t + 1), s = t * c;
+                for(int k = 0; k < N; k++)
+                {
+                    double akp = A[k][p], akq = A[k][q];
+                    A[k][p] = c * akp - s * akq;
+                    A[k][q] = s * akp + c * akq;
+                }
+                for(int k = 0; k < N; k++)
+                {
+                    double apk = A[p][k], aqk = A[q][k];
+                    A[p][k] = c * apk - s * aqk;
+                    A[q][k] = s * apk + c * aqk;
+                }
+                for(int k = 0; k < N; k++)
+                {
+                    double vkp = V[k][p], vkq = V[k][q];
+                    V[k][p] = c * vkp - s * vkq;
+                    V[k][q] = s * vkp + c * vkq;
+                }
+            }
+        }
+    }
+}
+
+// ltool.whiten_xy_points (operates in place and returns the transform)
+inline Matx<double, 3, 3> whiten_xy_points(vector<double>& xs, vector<double>& ys)
+{
+    const size_t n = xs.size();
+    double mu_x = 0, mu_y = 0, var_x = 0, var_y = 0;
+    for(size_t ix = 0; ix < n; ix++)
+    {
+        mu_x += xs[ix];
+        mu_y += ys[ix];
+    }
+    mu_x /= n;
+    mu_y /= n;
+    for(size_t ix = 0; ix < n; ix++)
+    {
+        var_x += (xs[ix] - mu_x) * (xs[ix] - mu_x);
+        var_y += (ys[ix] - mu_y) * (ys[ix] - mu_y);
+    }
+    double std_x = sqrt(var_x / n), std_y = sqrt(var_y / n);
+    // prevent divide by zero
+    if(std_x == 0)
+    {
+        std_x = 1;
+    }
+    if(std_y == 0)
+    {
+        std_y = 1;
+    }
+    for(size_t ix = 0; ix < n; ix++)
+    {
+        xs[ix] = (xs[ix] - mu_x) / std_x;
+        ys[ix] = (ys[ix] - mu_y) / std_y;
+    }
+    return Matx<double, 3, 3>(
+               1 / std_x,          0, -mu_x / std_x,
+                       0,  1 / std_y, -mu_y / std_y,
+                       0,          0,             1);
+}
+
+// sver.compute_homog
+// The nullspace of the Mx9 least squares matrix is the eigenvector of Mx9.T *
+// Mx9 with the smallest eigenvalue, so the Mx9 matrix is never built.
+inline Matx<double, 3, 3> compute_homog(const vector<double>& x1s, const vector<double>& y1s,
+                                        const vector<double>& x2s, const vector<double>& y2s)
+{
+    double AtA[9][9] = {{0}}, V[9][9];
+    for(size_t ix = 0; ix < x1s.size(); ix++)
+    {
+        const double x1 = x1s[ix], y1 = y1s[ix], u2 = x2s[ix], v2 = y2s[ix];
+        const double row1[9] = {0, 0, 0, -x1, -y1, -1, v2 * x1, v2 * y1, v2};
+        const double row2[9] = {x1, y1, 1, 0, 0, 0, -u2 * x1, -u2 * y1, -u2};
+        for(int p = 0; p < 9; p++)
+        {
+            for(int q = 0; q < 9; q++)
+            {
+                AtA[p][q] += (row1[p] * row1[q]) + (row2[p] * row2[q]);
+            }
+        }
+    }
+    jacobi_eigen_symmetric<9>(AtA, V);
+    int min_ix = 0;
+    for(int p = 1; p < 9; p++)
+    {
+        if(AtA[p][p] < AtA[min_ix][min_ix])
+        {
+            min_ix = p;
+        }
+    }
+    return Matx<double, 3, 3>(
+               V[0][min_ix], V[1][min_ix], V[2][min_ix],
+               V[3][min_ix], V[4][min_ix], V[5][min_ix],
+               V[6][min_ix], V[7][min_ix], V[8][min_ix]);
+}
+
+// sver.compute_affine
+// Each row of the affine matrix is an independent 3 parameter least squares
+// problem, so this solves two 3x3 normal equations. Returns false if the
+// points are degenerate.
+inline bool compute_affine(const vector<double>& x1s, const vector<double>& y1s,
+                           const vector<double>& x2s, const vector<double>& y2s,
+                           Matx<double, 3, 3>& A)
+{
+    Matx<double, 3, 3> PtP;
+    double Ptx[3] = {0, 0, 0}, Pty[3] = {0, 0, 0};
+    for(size_t ix = 0; ix < x1s.size(); ix++)
+    {
+        const double p[3] = {x1s[ix], y1s[ix], 1};
+        for(int r = 0; r < 3; r++)
+        {
+            for(int c = 0; c < 3; c++)
+            {
+                PtP(r, c) += p[r] * p[c];
+            }
+            Ptx[r] += p[r] * x2s[ix];
+            Pty[r] += p[r] * y2s[ix];
+        }
+    }
+    const double det = (
+        PtP(0, 0) * (PtP(1, 1) * PtP(2, 2) - PtP(1, 2) * PtP(2, 1)) -
+        PtP(0, 1) * (PtP(1, 0) * PtP(2, 2) - PtP(1, 2) * PtP(2, 0)) +
+        PtP(0, 2) * (PtP(1, 0) * PtP(2, 1) - PtP(1, 1) * PtP(2, 0)));
+    if(fabs(det) < 1e-12)
+    {
+        return false;
+    }
+    const Matx<double, 3, 3> PtP_inv = PtP.inv();
+    for(int c = 0; c < 3; c++)
+    {
+        A(0, c) = PtP_inv(c, 0) * Ptx[0] + PtP_inv(c, 1) * Ptx[1] + PtP_inv(c, 2) * Ptx[2];
+        A(1, c) = PtP_inv(c, 0) * Pty[0] + PtP_inv(c, 1) * Pty[1] + PtP_inv(c, 2) * Pty[2];
+    }
+    A(2, 0) = 0;
+    A(2, 1) = 0;
+    A(2, 2) = 1;
+    return true;
+}
+
+// npl.matrix_rank(M) == 3 (using the same default tolerance as numpy)
+inline bool is_full_rank(const Matx<double, 3, 3>& M)
+{
+    double MtM[3][3], V[3][3];
+    for(int p = 0; p < 3; p++)
+    {
+        for(int q = 0; q < 3; q++)
+        {
+            MtM[p][q] = M(0, p) * M(0, q) + M(1, p) * M(1, q) + M(2, p) * M(2, q);
+        }
+    }
+    jacobi_eigen_symmetric<3>(MtM, V);
+    double svals[3], smax = 0;
+    for(int p = 0; p < 3; p++)
+    {
+        svals[p] = sqrt(std::max(MtM[p][p], 0.0));
+        smax = std::max(smax, svals[p]);
+    }
+    const double tol = smax * 3 * 2.220446049250313e-16;
+    return (svals[0] > tol) && (svals[1] > tol) && (svals[2] > tol);
+}
+
+// ltool.transform_points_with_homography for a single point
+inline void transform_point(const Matx<double, 3, 3>& H, double x, double y,
+                            double& x_t, double& y_t)
+{
+    const double z_t = H(2, 0) * x + H(2, 1) * y + H(2, 2);
+    x_t = (H(0, 0) * x + H(0, 1) * y + H(0, 2)) / z_t;
+    y_t = (H(1, 0) * x + H(1, 1) * y + H(1, 2)) / z_t;
+}
+
+/*
+sver.test_homog_errors for a single correspondence. The scale and orientation
+of kpt1 are tested by transforming a reference point offset from its center.
+*/
+inline bool test_homog_correspondence(const Matx<double, 3, 3>& H,
+                                      const double* kpt1, const double* kpt2,
+                                      double xy_thresh_sqrd, double scale_thresh,
+                                      double ori_thresh, bool full_homog_checks,
+                                      double& xy_err, double& ori_err, double& scale_err)
+{
+    double x1_t, y1_t;
+    transform_point(H, kpt1[0], kpt1[1], x1_t, y1_t);
+    const double dx = x1_t - kpt2[0], dy = y1_t - kpt2[1];
+    xy_err = dx * dx + dy * dy;
+    if(!full_homog_checks)
+    {
+        return xy_err < xy_thresh_sqrd;
+    }
+    const double ori1 = kpt1[5];
+    const double scale1 = sqrt(kpt1[2] * kpt1[4]);
+    double off_x1_t, off_y1_t;
+    transform_point(H, kpt1[0] + sin(ori1) * scale1, kpt1[1] - cos(ori1) * scale1,
+                    off_x1_t, off_y1_t);
+    const double scaled_dx1_t = x1_t - off_x1_t, scaled_dy1_t = y1_t - off_y1_t;
+    const double det1_t = scaled_dx1_t * scaled_dx1_t + scaled_dy1_t * scaled_dy1_t;
+    // adjust for gravity vector being 0
+    const double ori1_t = atan2(scaled_dy1_t, scaled_dx1_t) - GRAVITY_THETA;
+    const double det2 = kpt2[2] * kpt2[4];
+    // dtool.det_distance
+    scale_err = det1_t / det2;
+    if(scale_err < 1)
+    {
+        scale_err = 1 / scale_err;
+    }
+    // dtool.ori_distance
+    const double ori_diff = fmod(fabs(ori1_t - kpt2[5]), SVER_TAU);
+    ori_err = std::min(ori_diff, SVER_TAU - ori_diff);
+    return (xy_err    < xy_thresh_sqrd) &&
+           (scale_err <   scale_thresh) &&
+           (ori_err   <     ori_thresh);
+}
+
+/*
+Shared implementation of refine_inliers and refine_inliers_f32. KPT_T is the
+storage type of the keypoints; the transform is always estimated in double.
+*/
+template<typename KPT_T> int refine_inliers_impl(
+        const KPT_T* kpts1, const KPT_T* kpts2,
+        const size_t* fm, size_t nMatch,
+        const size_t* aff_inliers, size_t nAffInliers,
+        double xy_thresh_sqrd, double scale_thresh, double ori_thresh,
+        bool full_homog_checks, int refine_method,
+        bool* out_inliers, double* out_errors, double* out_matrix)
+{
+    // sver.get_normalized_affine_inliers
+    vector<double> x1s(nAffInliers), y1s(nAffInliers), x2s(nAffInliers), y2s(nAffInliers);
+    for(size_t ix = 0; ix < nAffInliers; ix++)
+    {
+        const size_t fm_ind = 2 * aff_inliers[ix];
+        x1s[ix] = kpts1[6 * fm[fm_ind + 0] + 0];
+        y1s[ix] = kpts1[6 * fm[fm_ind + 0] + 1];
+        x2s[ix] = kpts2[6 * fm[fm_ind + 1] + 0];
+        y2s[ix] = kpts2[6 * fm[fm_ind + 1] + 1];
+    }
+    const Matx<double, 3, 3> T1 = whiten_xy_points(x1s, y1s);
+    const Matx<double, 3, 3> T2 = whiten_xy_points(x2s, y2s);
+    // sver.estimate_refined_transform
+    Matx<double, 3, 3> H_prime;
+    if(refine_method == 0)
+    {
+        H_prime = compute_homog(x1s, y1s, x2s, y2s);
+    }
+    else if(!compute_affine(x1s, y1s, x2s, y2s, H_prime))
+    {
+        return 1;
+    }
+    // sver.unnormalize_transform
+    Matx<double, 3, 3> H = T2.inv() * H_prime * T1;
+    if(H(2, 2) == 0)
+    {
+        return 1;
+    }
+    const double H22 = H(2, 2);
+    for(int r = 0; r < 3; r++)
+    {
+        for(int c = 0; c < 3; c++)
+        {
+            H(r, c) /= H22;
+        }
+    }
+    if(!is_full_rank(H))
+    {
+        return 1;
+    }
+    memcpy(out_matrix, &H, sizeof(Matx<double, 3, 3>));
+    // sver.test_homog_errors / sver.test_affine_errors
+    for(size_t ix = 0; ix < nMatch; ix++)
+    {
+        // keypoints are read in their storage type and tested in double
+        double kpt1[6], kpt2[6];
+        std::copy(&kpts1[6 * fm[(2 * ix) + 0]], &kpts1[6 * fm[(2 * ix) + 0]] + 6, kpt1);
+        std::copy(&kpts2[6 * fm[(2 * ix) + 1]], &kpts2[6 * fm[(2 * ix) + 1]] + 6, kpt2);
+        double& xy_err = out_errors[(0 * nMatch) + ix];
+        if(refine_method == 0)
+        {
+            double ori_err, scale_err;
+            out_inliers[ix] = test_homog_correspondence(
+                H, kpt1, kpt2, xy_thresh_sqrd, scale_thresh, ori_thresh,
+                full_homog_checks, xy_err, ori_err, scale_err);
+            if(full_homog_checks)
+            {
+                out_errors[(1 * nMatch) + ix] = ori_err;
+                out_errors[(2 * nMatch) + ix] = scale_err;
+            }
+        }
+        else
+        {
+            const Matx<double, 3, 3> invVR1_m = get_invV_mat(
+                kpt1[0], kpt1[1], kpt1[2], kpt1[3], kpt1[4], kpt1[5]);
+            const Matx<double, 3, 3> invVR2_m = get_invV_mat(
+                kpt2[0], kpt2[1], kpt2[2], kpt2[3], kpt2[4], kpt2[5]);
+            out_inliers[ix] = test_affine_correspondence(
+                H, invVR1_m, invVR2_m, xy_thresh_sqrd, scale_thresh, ori_thresh,
+                xy_err, out_errors[(1 * nMatch) + ix], out_errors[(2 * nMatch) + ix]);
+        }
+    }
+    return 0;
+}
+
 extern "C" {
     void get_affine_inliers(double* kpts1, size_t kpts1_len,
                             double* kpts2, size_t kpts2_len,
@@ -284,77 +956,278 @@ Matx<double, 3, 3> prefix##invVR2_m = get_invV_mat( \
         MARKUSED(kpts1_len);
         MARKUSED(kpts2_len);
         CHECK_FM_BOUNDS(fm, nMatch, kpts1_len, kpts2_len);
-        //const size_t num_matches = nMatch / 2;
-        const size_t num_matches = nMatch;
-        double current_max_inlier_weight = 0;
+        if(nMatch == 0)
+        {
+            return 0;
+        }
         #define USE_PAR_SVER
 
         #ifndef USE_PAR_SVER
         const bool parallel_flag = 0;
-        bool* tmp_inliers = new bool[num_matches];
-        double* tmp_errors = new double[num_matches * 3];
         #else
         const bool parallel_flag = 1;
         #endif
         printDBG_SVER(" * parallel_flag = " << parallel_flag);
-
+        vector<Matx<double, 3, 3> > invVR1s, invVR2s;
+        get_matching_invVRs(kpts1, kpts2, fm, nMatch, invVR1s, invVR2s);
+        double current_max_inlier_weight = -1;
+        size_t current_max_ix = 0;
         {
-            //(max : max_val)
+            // Only the weight of each hypothesis is computed in parallel.
+            // Ties are broken towards the lowest index, so the result no
+            // longer depends on thread scheduling.
             #pragma omp parallel for if(parallel_flag)
-            for(size_t i1 = 0; i1 < nMatch * 2; i1 += 2)
+            for(size_t ix1 = 0; ix1 < nMatch; ix1++)
             {
-                #ifdef USE_PAR_SVER
-                bool* tmp_inliers = new bool[num_matches];
-                double* tmp_errors = new double[num_matches * 3];
-                #endif
-                SETUP_invVRs(i1, i1_)
-                    Matx<double, 3, 3> Aff_mat = get_Aff_mat(i1_invVR1_m, i1_invVR2_m);
-                double inlier_weight_for_i1 = 0;
-                for(size_t i2 = 0; i2 < nMatch * 2; i2 += 2)
-                {
-                    SETUP_invVRs(i2, i2_)
-                        Matx<double, 3, 3> i2_invVR1_mt = Aff_mat * i2_invVR1_m;
-                    double    xy_err = tmp_errors[(0 * num_matches) + (i2 / 2)] =  xy_distance(i2_invVR1_mt, i2_invVR2_m);
-                    double   ori_err = tmp_errors[(1 * num_matches) + (i2 / 2)] = ori_distance(i2_invVR1_mt, i2_invVR2_m);
-                    double scale_err = tmp_errors[(2 * num_matches) + (i2 / 2)] = det_distance(i2_invVR1_mt, i2_invVR2_m);
-                    bool is_inlier = (xy_err    <    xy_thresh_sqrd) &&
-                                     (scale_err < scale_thresh_sqrd) &&
-                                     (ori_err   <        ori_thresh);
-                    if(is_inlier)
-                    {
-                        //inlier_weight_for_i1++;
-                        inlier_weight_for_i1 += fs[i2 / 2];
-                    }
-                    tmp_inliers[i2 / 2] = is_inlier;
-                }
+                Matx<double, 3, 3> Aff_mat = get_Aff_mat(invVR1s[ix1], invVR2s[ix1]);
+                double inlier_weight_for_ix1 = affine_hypothesis_weight(
+                    Aff_mat, invVR1s, invVR2s, fs, nMatch,
+                    xy_thresh_sqrd, scale_thresh_sqrd, ori_thresh);
                 #pragma omp critical(current_max_inlier_weight)
                 {
-                    if(inlier_weight_for_i1 >= current_max_inlier_weight)
+                    if((inlier_weight_for_ix1 > current_max_inlier_weight) ||
+                       (inlier_weight_for_ix1 == current_max_inlier_weight && ix1 < current_max_ix))
                     {
-                        printDBG_SVER(" * inlier_weight_for_i1 = " << inlier_weight_for_i1);
-                        printDBG_SVER(" * i1 = " << i1);
-                        printDBG_SVER(" * current_max_inlier_weight = " << current_max_inlier_weight);
-                        current_max_inlier_weight = inlier_weight_for_i1;
-                        // reuse the output space for the current maximum (since
-                        //  the final "current maximum" is the intended output)
-                        memcpy(out_inliers, tmp_inliers, num_matches * sizeof(bool));
-                        memcpy(out_errors,   tmp_errors, num_matches * 3 * sizeof(double));
-                        memcpy(out_matrix, &Aff_mat, sizeof(Matx<double, 3, 3>));
+                        printDBG_SVER(" * inlier_weight_for_ix1 = " << inlier_weight_for_ix1);
+                        printDBG_SVER(" * ix1 = " << ix1);
+                        current_max_inlier_weight = inlier_weight_for_ix1;
+                        current_max_ix = ix1;
                     }
                 }
-                #ifdef USE_PAR_SVER
-                delete [] tmp_inliers;
-                delete [] tmp_errors;
-                #endif
             }
         }
-        #ifndef USE_PAR_SVER
-        delete [] tmp_inliers;
-        delete [] tmp_errors;
-        #endif
+        write_affine_hypothesis(current_max_ix, invVR1s, invVR2s, nMatch,
+                                xy_thresh_sqrd, scale_thresh_sqrd, ori_thresh,
+                                out_inliers, out_errors, out_matrix);
         return current_max_inlier_weight;
     }
 #undef SETUP_invVRs
+
+    /*
+    Like get_affine_inliers, but only the top_k hypotheses with the largest
+    inlier weight are written, in descending order of weight. The outputs are
+    O(top_k * nMatch) instead of O(nMatch ** 2):
+        * out_hypo_idxs and out_weights have top_k entries
+        * out_inlier_flags is top_k x nMatch
+        * out_errors_list is top_k x 3 x nMatch
+        * out_matrices_list is top_k x 3 x 3
+    Returns the number of hypotheses written (min(top_k, nMatch)).
+    */
+    size_t get_affine_inliers_topk(double* kpts1, size_t kpts1_len,
+                                   double* kpts2, size_t kpts2_len,
+                                   size_t* fm, double* fs, size_t nMatch,
+                                   double xy_thresh_sqrd, double scale_thresh_sqrd, double ori_thresh,
+                                   size_t top_k,
+                                   // memory is expected to by allocated by the caller (i.e. via numpy.empty)
+                                   size_t* out_hypo_idxs, double* out_weights,
+                                   bool* out_inlier_flags, double* out_errors_list,
+                                   double* out_matrices_list)
+    {
+        printDBG_SVER("get_affine_inliers_topk");
+        printDBG_SVER(" * nMatch = " << nMatch);
+        printDBG_SVER(" * top_k = " << top_k);
+        MARKUSED(kpts1_len);
+        MARKUSED(kpts2_len);
+        CHECK_FM_BOUNDS(fm, nMatch, kpts1_len, kpts2_len);
+        vector<Matx<double, 3, 3> > invVR1s, invVR2s;
+        get_matching_invVRs(kpts1, kpts2, fm, nMatch, invVR1s, invVR2s);
+        vector<double> weights(nMatch);
+        #pragma omp parallel for
+        for(size_t ix1 = 0; ix1 < nMatch; ix1++)
+        {
+            Matx<double, 3, 3> Aff_mat = get_Aff_mat(invVR1s[ix1], invVR2s[ix1]);
+            weights[ix1] = affine_hypothesis_weight(
+                Aff_mat, invVR1s, invVR2s, fs, nMatch,
+                xy_thresh_sqrd, scale_thresh_sqrd, ori_thresh);
+        }
+        vector<size_t> sortx(nMatch);
+        for(size_t ix1 = 0; ix1 < nMatch; ix1++)
+        {
+            sortx[ix1] = ix1;
+        }
+        const size_t nTop = std::min(top_k, nMatch);
+        std::partial_sort(sortx.begin(), sortx.begin() + nTop, sortx.end(),
+                          HypothesisWeightGreater(weights));
+        for(size_t rank = 0; rank < nTop; rank++)
+        {
+            const size_t hypo_ix = sortx[rank];
+            out_hypo_idxs[rank] = hypo_ix;
+            out_weights[rank] = weights[hypo_ix];
+            write_affine_hypothesis(hypo_ix, invVR1s, invVR2s, nMatch,
+                                    xy_thresh_sqrd, scale_thresh_sqrd, ori_thresh,
+                                    &out_inlier_flags[rank * nMatch],
+                                    &out_errors_list[rank * 3 * nMatch],
+                                    &out_matrices_list[rank * 9]);
+        }
+        return nTop;
+    }
+
+    /*
+    float32 version of get_best_affine_inliers. Keypoints and weights are
+    read as float32 (the dtype pyhesaff produces) and the hypotheses are
+    scored with the structure-of-arrays kernel. Its cos / product tests can
+    disagree with the exact tests on borderline matches, so the
+    SVER_F32_RESCORE best scoring hypotheses are re-scored with the exact
+    tests that write the inliers, and the best of those wins. The returned
+    weight is always the weight of the written inliers. The errors of the
+    best hypothesis are written as float32, its matrix as float64.
+    */
+    int get_best_affine_inliers_f32(float* kpts1, size_t kpts1_len,
+                                    float* kpts2, size_t kpts2_len,
+                                    size_t* fm, float* fs, size_t nMatch,
+                                    double xy_thresh_sqrd, double scale_thresh_sqrd, double ori_thresh,
+                                    // memory is expected to by allocated by the caller (i.e. via numpy.empty)
+                                    bool* out_inliers, float* out_errors, double* out_matrix)
+    {
+        printDBG_SVER("get_best_affine_inliers_f32");
+        printDBG_SVER(" * nMatch = " << nMatch);
+        MARKUSED(kpts1_len);
+        MARKUSED(kpts2_len);
+        CHECK_FM_BOUNDS(fm, nMatch, kpts1_len, kpts2_len);
+        if(nMatch == 0)
+        {
+            return 0;
+        }
+        InvVRsSoA invVR1s, invVR2s;
+        get_matching_invVRs_soa(kpts1, kpts2, fm, nMatch, invVR1s, invVR2s);
+        // ori_distance is at most pi, so larger thresholds accept everything
+        const float ori_cos_thresh = (ori_thresh < M_PI) ? (float)cos(ori_thresh) : -2.0f;
+        vector<double> weights(nMatch);
+        #pragma omp parallel for
+        for(size_t ix1 = 0; ix1 < nMatch; ix1++)
+        {
+            const Matx<double, 3, 3> Aff_mat = get_Aff_mat_soa(invVR1s, invVR2s, ix1);
+            weights[ix1] = affine_hypothesis_weight_soa(
+                Aff_mat, invVR1s, invVR2s, fs, nMatch,
+                (float)xy_thresh_sqrd, (float)scale_thresh_sqrd, ori_cos_thresh);
+        }
+        vector<size_t> sortx(nMatch);
+        for(size_t ix1 = 0; ix1 < nMatch; ix1++)
+        {
+            sortx[ix1] = ix1;
+        }
+        const size_t nRescore = std::min((size_t)SVER_F32_RESCORE, nMatch);
+        std::partial_sort(sortx.begin(), sortx.begin() + nRescore, sortx.end(),
+                          HypothesisWeightGreater(weights));
+        float current_max_inlier_weight = -1;
+        size_t current_max_ix = 0;
+        for(size_t rank = 0; rank < nRescore; rank++)
+        {
+            const size_t hypo_ix = sortx[rank];
+            const float exact_weight = exact_affine_hypothesis_weight_soa(
+                hypo_ix, invVR1s, invVR2s, fs, nMatch, (float)xy_thresh_sqrd,
+                (float)scale_thresh_sqrd, (float)ori_thresh);
+            if((exact_weight > current_max_inlier_weight) ||
+               (exact_weight == current_max_inlier_weight && hypo_ix < current_max_ix))
+            {
+                current_max_inlier_weight = exact_weight;
+                current_max_ix = hypo_ix;
+            }
+        }
+        write_affine_hypothesis_soa(current_max_ix, invVR1s, invVR2s, nMatch,
+                                    (float)xy_thresh_sqrd, (float)scale_thresh_sqrd,
+                                    (float)ori_thresh, out_inliers, out_errors,
+                                    out_matrix);
+        return current_max_inlier_weight;
+    }
+
+    /*
+    Runs get_best_affine_inliers on many (kpts1, kpts2, fm, fs) jobs in one
+    call. The inputs of all jobs are stacked into flat buffers. Job j owns:
+        * keypoint rows kpts1_offsets[j] ... and kpts2_offsets[j] ...
+          (fm indexes are relative to these offsets, jobs may share keypoints)
+        * matches fm_offsets[j] to fm_offsets[j + 1]
+    Outputs are laid out the same way as the matches:
+        * out_inliers_flat[fm_offsets[j]:fm_offsets[j + 1]]
+        * out_errors_flat[3 * fm_offsets[j]:3 * fm_offsets[j + 1]] (as 3 x nMatch)
+        * out_matrices[9 * j:9 * (j + 1)] and out_weights[j]
+    */
+    void get_best_affine_inliers_batch(double* kpts1_flat, size_t* kpts1_offsets,
+                                       double* kpts2_flat, size_t* kpts2_offsets,
+                                       size_t* fm_flat, double* fs_flat,
+                                       size_t* fm_offsets, size_t nJobs,
+                                       double* xy_thresh_sqrd_list,
+                                       double scale_thresh_sqrd, double ori_thresh,
+                                       // memory is expected to by allocated by the caller (i.e. via numpy.empty)
+                                       bool* out_inliers_flat, double* out_errors_flat,
+                                       double* out_matrices, double* out_weights)
+    {
+        printDBG_SVER("get_best_affine_inliers_batch");
+        printDBG_SVER(" * nJobs = " << nJobs);
+        #pragma omp parallel
+        {
+            // per-thread scratch reused across jobs
+            vector<Matx<double, 3, 3> > invVR1s, invVR2s;
+            #pragma omp for schedule(dynamic)
+            for(size_t jx = 0; jx < nJobs; jx++)
+            {
+                const size_t fm_offset = fm_offsets[jx];
+                const size_t nMatch = fm_offsets[jx + 1] - fm_offset;
+                out_weights[jx] = best_affine_inliers_serial(
+                    &kpts1_flat[6 * kpts1_offsets[jx]],
+                    &kpts2_flat[6 * kpts2_offsets[jx]],
+                    &fm_flat[2 * fm_offset], &fs_flat[fm_offset], nMatch,
+                    xy_thresh_sqrd_list[jx], scale_thresh_sqrd, ori_thresh,
+                    invVR1s, invVR2s,
+                    &out_inliers_flat[fm_offset],
+                    &out_errors_flat[3 * fm_offset],
+                    &out_matrices[9 * jx]);
+            }
+        }
+    }
+
+    /*
+    Native version of sver.refine_inliers for refine_method='homog' (0) and
+    refine_method='affine' (1). Estimates the refined transform from the
+    normalized affine inliers and tests every match against it.
+
+    Returns 0 on success and 1 if the transform is degenerate (where the
+    python version raises a LinAlgError). out_errors is 3 x nMatch (xy, ori,
+    scale). The ori and scale rows are not written when testing a homography
+    without full_homog_checks.
+    */
+    int refine_inliers(double* kpts1, size_t kpts1_len,
+                       double* kpts2, size_t kpts2_len,
+                       size_t* fm, size_t nMatch,
+                       size_t* aff_inliers, size_t nAffInliers,
+                       double xy_thresh_sqrd, double scale_thresh, double ori_thresh,
+                       bool full_homog_checks, int refine_method,
+                       // memory is expected to by allocated by the caller (i.e. via numpy.empty)
+                       bool* out_inliers, double* out_errors, double* out_matrix)
+    {
+        printDBG_SVER("refine_inliers");
+        printDBG_SVER(" * nMatch = " << nMatch);
+        printDBG_SVER(" * nAffInliers = " << nAffInliers);
+        printDBG_SVER(" * refine_method = " << refine_method);
+        MARKUSED(kpts1_len);
+        MARKUSED(kpts2_len);
+        return refine_inliers_impl(kpts1, kpts2, fm, nMatch, aff_inliers,
+                                   nAffInliers, xy_thresh_sqrd, scale_thresh,
+                                   ori_thresh, full_homog_checks, refine_method,
+                                   out_inliers, out_errors, out_matrix);
+    }
+
+    /*
+    refine_inliers for float32 keypoints (as used by
+    get_best_affine_inliers_f32), so they do not need a float64 copy
+    */
+    int refine_inliers_f32(float* kpts1, size_t kpts1_len,
+                           float* kpts2, size_t kpts2_len,
+                           size_t* fm, size_t nMatch,
+                           size_t* aff_inliers, size_t nAffInliers,
+                           double xy_thresh_sqrd, double scale_thresh, double ori_thresh,
+                           bool full_homog_checks, int refine_method,
+                           // memory is expected to by allocated by the caller (i.e. via numpy.empty)
+                           bool* out_inliers, double* out_errors, double* out_matrix)
+    {
+        printDBG_SVER("refine_inliers_f32");
+        MARKUSED(kpts1_len);
+        MARKUSED(kpts2_len);
+        return refine_inliers_impl(kpts1, kpts2, fm, nMatch, aff_inliers,
+                                   nAffInliers, xy_thresh_sqrd, scale_thresh,
+                                   ori_thresh, full_homog_checks, refine_method,
+                                   out_inliers, out_errors, out_matrix);
+    }
 #undef printDBG_SVER
     void hello_world()
     {
@@ -16,6 +16,11 @@ except ImportError as ex:
 (print, rrr, profile) = ut.inject2(__name__, '[chip]', DEBUG=False)
 
 
+# Pyramid extraction only shrinks the source when the chip is at least this
+# many times smaller than it
+PYRAMID_MIN_DOWNSCALE = 2.0
+
+
 @profile
 def get_image_to_chip_transform(bbox, chipsz, theta):
     """
@@ -101,9 +106,11 @@ def _get_chip_to_image_transform(bbox, chipsz, theta):
 
 
 @profile
-def extract_chip_from_gpath(gfpath, bbox, theta, new_size, interpolation=cv2.INTER_LANCZOS4):
+def extract_chip_from_gpath(gfpath, bbox, theta, new_size, interpolation=cv2.INTER_LANCZOS4,
+                            pyramid=False):
     imgBGR = gtool.imread(gfpath)  # Read parent image
-    chipBGR = extract_chip_from_img(imgBGR, bbox, theta, new_size, interpolation)
+    chipBGR = extract_chip_from_img(imgBGR, bbox, theta, new_size, interpolation,
+                                    pyramid=pyramid)
     return chipBGR
 
 
@@ -122,7 +129,8 @@ def extract_chip_from_gpath_into_square(args):
 
 
 @profile
-def extract_chip_from_img(imgBGR, bbox, theta, new_size, interpolation=cv2.INTER_LANCZOS4):
+def extract_chip_from_img(imgBGR, bbox, theta, new_size, interpolation=cv2.INTER_LANCZOS4,
+                          pyramid=False):
     """ Crops chip from image ; Rotates and scales;
 
     ibs.show_annot_image(aid)[0].pt_save_and_view()
@@ -132,6 +140,12 @@ def extract_chip_from_img(imgBGR, bbox, theta, new_size, interpolation=cv2.INTER
         bbox (tuple):  xywh
         theta (float):
         new_size (tuple): wy
+        pyramid (bool): antialiasing option. If True and the chip is much
+            smaller than the bbox, the rotated bbox extent is cropped and
+            area-downsampled to near the chip scale before the final warp,
+            which removes the aliasing of warping a large region straight
+            to a small chip. It is not generally faster; see
+            vtool/tests/time_chip_extraction.py. (default = False)
 
     Returns:
         ndarray: chipBGR
@@ -156,12 +170,24 @@ def extract_chip_from_img(imgBGR, bbox, theta, new_size, interpolation=cv2.INTER
         >>> import plottool as pt
         >>> pt.imshow(chipBGR)
         >>> pt.show_if_requested()
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from vtool.chip import *  # NOQA
+        >>> imgBGR = gtool.imread(ut.grab_test_imgpath('carl.jpg'))
+        >>> bbox = (40, 20, 400, 300)
+        >>> theta = 0.3
+        >>> new_size = (80, 60)
+        >>> chipBGR1 = extract_chip_from_img(imgBGR, bbox, theta, new_size)
+        >>> chipBGR2 = extract_chip_from_img(imgBGR, bbox, theta, new_size, pyramid=True)
+        >>> assert chipBGR2.shape == chipBGR1.shape
+        >>> diff = np.abs(chipBGR1.astype(np.float32) - chipBGR2).mean()
+        >>> assert diff < 10, diff
     """
     # THE CULPRIT FOR MULTIPROCESSING FREEZES
-    flags = interpolation
     #if True:
     M = get_image_to_chip_transform(bbox, new_size, theta)  # Build transformation
-    chipBGR = cv2.warpAffine(imgBGR, M[0:2], tuple(new_size), flags=flags, borderMode=cv2.BORDER_CONSTANT)
+    chipBGR = _warp_chip(imgBGR, M, new_size, interpolation, pyramid=pyramid)
     #else:
     #    # if theta == 0, not sure if this is better. Certainly not more general
     #    x, y, w, h = bbox
@@ -171,6 +197,233 @@ def extract_chip_from_img(imgBGR, bbox, theta, new_size, interpolation=cv2.INTER
     return chipBGR
 
 
+def _warp_chip(imgBGR, M, new_size, interpolation=cv2.INTER_LANCZOS4,
+               pyramid=False):
+    """ warps imgBGR into a chip of size new_size using the affine M """
+    if pyramid:
+        imgBGR, M = _pyramid_reduce_roi(imgBGR, M, new_size)
+    flags = interpolation
+    chipBGR = cv2.warpAffine(imgBGR, M[0:2], tuple(new_size), flags=flags,
+                             borderMode=cv2.BORDER_CONSTANT)
+    return chipBGR
+
+
+def _pyramid_reduce_roi(imgBGR, M, new_size, kernel_radius=4):
+    """
+    Crops the region of imgBGR that the chip transform M reads from and
+    shrinks it by the largest integer factor that keeps at least as many
+    pixels per unit length as the chip. Returns the ROI and the chip
+    transform of the ROI.
+
+    The ROI is padded by kernel_radius shrunk pixels so the final warp sees
+    the same neighborhood it would in the full image. Integer factors let
+    cv2.resize use its fast box-filter path for INTER_AREA.
+    """
+    # Largest number of chip pixels per image pixel along any direction
+    chip_scale = npl.svd(M[0:2, 0:2], compute_uv=False).max()
+    factor = int(np.floor(1.0 / chip_scale))
+    if factor < PYRAMID_MIN_DOWNSCALE:
+        return imgBGR, M
+    # Extent of the rotated bbox in image space
+    (cw, ch) = new_size
+    chip_corners = np.array([[-.5, cw - .5, cw - .5, -.5],
+                             [-.5, -.5, ch - .5, ch - .5],
+                             [1, 1, 1, 1]])
+    img_corners = npl.inv(M).dot(chip_corners)[0:2]
+    margin = (kernel_radius + 1) * factor
+    (img_h, img_w) = imgBGR.shape[0:2]
+    x1 = max(int(np.floor(img_corners[0].min() - margin)), 0)
+    y1 = max(int(np.floor(img_corners[1].min() - margin)), 0)
+    x2 = min(int(np.ceil(img_corners[0].max() + margin)), img_w)
+    y2 = min(int(np.ceil(img_corners[1].max() + margin)), img_h)
+    if x2 <= x1 or y2 <= y1:
+        # The chip is entirely outside of the image
+        return imgBGR, M
+    # Grow the ROI to a multiple of factor, padding with the warp border
+    # value wherever it extends past the image
+    roi_w = factor * int(np.ceil((x2 - x1) / factor))
+    roi_h = factor * int(np.ceil((y2 - y1) / factor))
+    roiBGR = imgBGR[y1:y1 + roi_h, x1:x1 + roi_w]
+    pad_w = roi_w - roiBGR.shape[1]
+    pad_h = roi_h - roiBGR.shape[0]
+    if pad_w > 0 or pad_h > 0:
+        roiBGR = cv2.copyMakeBorder(roiBGR, 0, pad_h, 0, pad_w,
+                                    cv2.BORDER_CONSTANT, value=0)
+    reduced_size = (roi_w // factor, roi_h // factor)
+    roiBGR = cv2.resize(roiBGR, reduced_size, interpolation=cv2.INTER_AREA)
+    T = ltool.translation_mat3x3(x1, y1)
+    U = _get_reduced_to_image_transform((roi_w, roi_h), reduced_size)
+    M_roi = M.dot(T.dot(U))
+    return roiBGR, M_roi
+
+
+def _get_reduced_to_image_transform(img_size, reduced_size):
+    """
+    transforms the pixel grid of a downsampled image into the pixel grid of
+    the full resolution image (pixel centers are aligned as in cv2.resize)
+    """
+    fx = img_size[0] / reduced_size[0]
+    fy = img_size[1] / reduced_size[1]
+    T1 = ltool.translation_mat3x3(.5, .5)
+    S  = ltool.scale_mat3x3(fx, fy)
+    T2 = ltool.translation_mat3x3(-.5, -.5)
+    U = T2.dot(S.dot(T1))
+    return U
+
+
+def _compute_image_chips(gfpath, bbox_list, theta_list, new_size_list,
+                         filter_list, interpolation, chip_fpath_list,
+                         reduced_decode, pyramid):
+    """
+    worker for generate_chips. Reads gfpath once and extracts all of its chips.
+    """
+    M_list = [get_image_to_chip_transform(bbox, new_size, theta)
+              for bbox, theta, new_size in
+              zip(bbox_list, theta_list, new_size_list)]
+    # The largest number of chip pixels per image pixel over all chips
+    chip_scale = max(max(new_size[0] / bbox[2], new_size[1] / bbox[3])
+                     for bbox, new_size in zip(bbox_list, new_size_list))
+    if reduced_decode and chip_scale < 1.0:
+        # Stored size. The decoder may apply the EXIF orientation, so the
+        # longest side is bounded to keep the bound orientation independent.
+        stored_size = gtool.open_image_size(gfpath)
+        max_side = int(np.ceil(max(stored_size) * chip_scale))
+        imgBGR = gtool.imread(gfpath, max_dsize=(max_side, max_side))
+        reduced_size = gtool.get_size(imgBGR)
+        # Size of a full read, which the bboxes refer to
+        img_size = gtool._decoded_full_size(reduced_size, stored_size)
+        if reduced_size != tuple(img_size):
+            U = _get_reduced_to_image_transform(img_size, reduced_size)
+            M_list = [M.dot(U) for M in M_list]
+    else:
+        imgBGR = gtool.imread(gfpath)
+    result_list = []
+    for count, (M, new_size) in enumerate(zip(M_list, new_size_list)):
+        chipBGR = _warp_chip(imgBGR, M, new_size, interpolation,
+                             pyramid=pyramid)
+        chipBGR = apply_filter_funcs(chipBGR, filter_list)
+        if chip_fpath_list is None:
+            result_list.append(chipBGR)
+        else:
+            gtool.imwrite(chip_fpath_list[count], chipBGR)
+            result_list.append(chip_fpath_list[count])
+    return result_list
+
+
+def _compute_image_chips_worker(args):
+    """ returns the exception of one image instead of raising """
+    try:
+        return _compute_image_chips(*args), None
+    except Exception as ex:
+        return None, ex
+
+
+def generate_chips(gfpath_list, bbox_list, theta_list, new_size_list,
+                   filter_list=[], interpolation=cv2.INTER_LANCZOS4,
+                   chip_fpath_list=None, reduced_decode=True,
+                   pyramid=False, num_threads=None, prefetch=None):
+    r"""
+    Extracts many chips, decoding each parent image only once.
+
+    Requests are grouped by gfpath and each group is handled by one task on a
+    thread pool (decoding and warping release the GIL). If reduced_decode is
+    True, a parent image is decoded at the smallest resolution that still
+    has at least as many pixels per unit length as its highest resolution
+    chip (see the max_dsize argument of :func:`vtool.image.imread`). For
+    JPEGs this lets the decoder skip most of the work when the chips are
+    much smaller than the image. Chips are yielded as each image finishes.
+    At most ``prefetch`` images are in flight at any time (as in
+    :func:`vtool.image.imread_many`), and an image that cannot be read or
+    warped does not stop the batch.
+
+    Args:
+        gfpath_list (list): parent image path of each chip
+        bbox_list (list): bounding box (x, y, w, h) of each chip
+        theta_list (list): rotation of each chip in radians
+        new_size_list (list): (w, h) chip sizes
+        filter_list (list): filters applied to every chip
+        interpolation (int): cv2 interpolation flag
+        chip_fpath_list (list): if specified, each chip is written to this
+            path and the path is yielded instead of the chip
+        reduced_decode (bool): decode images at reduced resolution when
+            possible (default = True)
+        pyramid (bool): see :func:`extract_chip_from_img` (default = False)
+        num_threads (int): defaults to the number of cpus
+        prefetch (int): maximum number of images being processed or waiting
+            to be consumed (default = 2 * num_threads)
+
+    Yields:
+        tuple: (cx, chipBGR, ex) - the index of the request, the chip (or its
+            path if chip_fpath_list is given), and the exception raised while
+            processing its image (the chip is None then). Chips from the same
+            image are yielded together.
+
+    CommandLine:
+        python -m vtool.chip --test-generate_chips
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from vtool.chip import *  # NOQA
+        >>> gpath1 = ut.grab_test_imgpath('carl.jpg')
+        >>> gpath2 = ut.grab_test_imgpath('lena.png')
+        >>> gfpath_list = [gpath1, gpath2, gpath1, gpath1, 'does/not/exist.jpg']
+        >>> bbox_list = [(100, 3, 100, 100), (50, 50, 200, 300),
+        >>>              (0, 0, 300, 200), (10, 20, 400, 400), (0, 0, 10, 10)]
+        >>> theta_list = [0.0, .3, 0.0, 1.1, 0.0]
+        >>> new_size_list = [(58, 34), (100, 150), (60, 40), (400, 400), (5, 5)]
+        >>> result_list = list(generate_chips(gfpath_list, bbox_list,
+        >>>                                   theta_list, new_size_list,
+        >>>                                   num_threads=2, prefetch=2))
+        >>> cx_list = sorted([cx for cx, chipBGR, ex in result_list])
+        >>> failed = [cx for cx, chipBGR, ex in result_list if ex is not None]
+        >>> print('cx_list = %r' % (cx_list,))
+        >>> print('failed = %r' % (failed,))
+        >>> chip_list = ut.take({cx: chipBGR for cx, chipBGR, ex in result_list},
+        >>>                     range(len(gfpath_list)))
+        >>> # The unreduced chips are exactly the serial chips
+        >>> full_list = list(generate_chips(gfpath_list[0:4], bbox_list[0:4],
+        >>>                                 theta_list[0:4], new_size_list[0:4],
+        >>>                                 reduced_decode=False))
+        >>> for cx, chipBGR, ex in full_list:
+        >>>     chipBGR_ = compute_chip(gfpath_list[cx], bbox_list[cx],
+        >>>                             theta_list[cx], new_size_list[cx])
+        >>>     assert np.all(chipBGR == chipBGR_)
+        >>>     assert chip_list[cx].shape == chipBGR.shape
+        cx_list = [0, 1, 2, 3, 4]
+        failed = [4]
+    """
+    num_chips = len(gfpath_list)
+    assert len(bbox_list) == num_chips, 'unequal len'
+    assert len(theta_list) == num_chips, 'unequal len'
+    assert len(new_size_list) == num_chips, 'unequal len'
+    if num_chips == 0:
+        return
+    # Group requests by their parent image
+    unique_gfpaths, groupxs = ut.group_indices(gfpath_list)
+
+    def _args(gx):
+        cxs = groupxs[gx]
+        chip_fpaths = (None if chip_fpath_list is None else
+                       ut.take(chip_fpath_list, cxs))
+        return (unique_gfpaths[gx], ut.take(bbox_list, cxs),
+                ut.take(theta_list, cxs), ut.take(new_size_list, cxs),
+                filter_list, interpolation, chip_fpaths, reduced_decode,
+                pyramid)
+
+    def _yield_group(gx, result_list, ex):
+        for count, cx in enumerate(groupxs[gx]):
+            result = None if ex is not None else result_list[count]
+            yield cx, result, ex
+
+    def _compute(gx):
+        return _compute_image_chips_worker(_args(gx))
+    for gx, (result_list, ex) in gtool._bounded_pool_imap(
+            _compute, len(unique_gfpaths), num_threads, prefetch,
+            ordered=False):
+        for item in _yield_group(gx, result_list, ex):
+            yield item
+
+
 def gridsearch_chipextract():
     r"""
     CommandLine:
@@ -8,9 +8,12 @@ TODO:
 from __future__ import absolute_import, division, print_function, unicode_literals
 from six.moves import range, zip, map
 import utool as ut
+import os
 import sys
+import multiprocessing
 import numpy as np
 import scipy.sparse as spsparse
+from os.path import exists, join
 import vtool.nearest_neighbors as nntool
 
 (print, rrr, profile) = ut.inject2(__name__, '[clustering2]')
@@ -184,10 +187,36 @@ def k_means_pp_cv2(data, K):
 
 @profile
 def akmeans_plusplus_init(data, K, num_samples=None, flann_params=None,
-                          rng=None):
+                          rng=None, oversample=2.0, num_rounds=5,
+                          num_procs=None, verbose=False):
     """
+    Scalable k-means++ seeding (k-means||).
+
+    Each of num_rounds rounds samples about oversample * K candidates with
+    probability proportional to their squared distance to the closest
+    candidate so far. The weighted candidates are then reduced to K centers
+    with weighted k-means++. Distances to large candidate sets are
+    approximated with a FLANN index. When there are too many candidates for
+    an exact reduction the k-means++ reduction picks centers in batches and
+    updates the candidate distances with a FLANN index over each batch.
+
+    Args:
+        data (ndarray): rows of data
+        K (int): number of centers
+        num_samples (int): if specified seed from a random subsample of data
+        flann_params (dict): params of the index over the candidates
+        rng (RandomState or int): random number generator or seed
+        oversample (float): expected candidates per round as a multiple of K
+        num_rounds (int): number of oversampling rounds
+        num_procs (int): threads used for exact distance updates
+        verbose (bool): print progress
+
+    Returns:
+        ndarray: centers
+
     Referencs:
         http://datasciencelab.wordpress.com/2014/01/15/improved-seeding-for-clustering-with-k-means/
+        Bahmani et al. Scalable K-Means++. VLDB 2012.
 
     Example:
         >>> # SLOW_DOCTEST
@@ -241,6 +270,22 @@ def akmeans_plusplus_init(data, K, num_samples=None, flann_params=None,
         >>> initial_centers = akmeans_plusplus_init(data, K, num_samples,
         >>>                                         flann_params)
 
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from vtool.clustering2 import *  # NOQA
+        >>> rng = np.random.RandomState(0)
+        >>> # 10 well separated blobs
+        >>> blob_centers = rng.randint(0, 255, (10, 16))
+        >>> data = np.vstack([rng.randn(100, 16) + c for c in blob_centers])
+        >>> data = data.astype(np.float32)
+        >>> centers = akmeans_plusplus_init(data, 10, rng=0)
+        >>> # one center was seeded in each blob
+        >>> dists = ((centers[:, None, :] - blob_centers[None, :, :]) ** 2).sum(-1)
+        >>> print(sorted(dists.argmin(axis=1).tolist()))
+        [0, 1, 2, 3, 4, 5, 6, 7, 8, 9]
+        >>> centers2 = akmeans_plusplus_init(data, 10, rng=0, num_samples=500)
+        >>> assert np.all(centers2 == akmeans_plusplus_init(data, 10, rng=0, num_samples=500))
+
     CommandLine:
         python -m vtool akmeans_plusplus_init:0
         python -m vtool akmeans_plusplus_init:1
@@ -294,130 +339,345 @@ def akmeans_plusplus_init(data, K, num_samples=None, flann_params=None,
 
 
     """
-    raise NotImplementedError('use sklearn or opencv')
-    return kmeans_plusplus_sklearn(data, K)
-    # # import pyflann
-    # # import six
-
-    # # rng = ut.ensure_rng(rng)
-
-    # # if num_samples is None:
-    #     # num_samples = 8192
-    # # num_samples = min(num_samples, len(data))
-    # # do_sampling = num_samples < len(data)
-
-    # # print('akmeans++ on %r points. K=%r, num_samples=%r. ' % (
-    #     # len(data), K, num_samples))
-
-    # # if len(data) == K:
-    #     # print('Warning, K is the same size as data')
-    #     # return data
-
-    # # assert len(data) > K
-
-    # # # Allocate data for centers
-    # # centers = np.empty((K, data.shape[1]), dtype=data.dtype)
-
-    # # # Create a mask denoting all unused elements
-    # # num_unused = len(data)
-    # # num_used = 0
-    # # is_unused = np.ones(len(data), dtype=np.bool)
-    # # unused_didxs = list(range(len(data)))
-    # # used_didxs = []
-
-    # # prog = ut.ProgPartial(lbl='akmeans++ init', freq=1, adjust=True, bs=True)
-    # # _iter = iter(prog(range(K)))
-
-    # # six.next(_iter)
-
-    # # # Choose an index and "use" it
-    # # chosen_datax = rng.randint(0, num_unused)
-    # # is_unused[chosen_datax] = False
-    # # centers[num_used] = data[chosen_datax]
-    # # num_used += 1
-    # # num_unused -= 1
-
-    # # # initalize flann index for approximate nn calculation
-    # # if flann_params is None:
-    #     # flann_params = {}
-    #     # #flann_params['algorithm'] = 'linear'
-    #     # flann_params['algorithm'] = 'kdtree'
-    #     # flann_params['trees'] = 1
-    #     # flann_params['checks'] = 8
-
-    # # flann = None
-
-    # # import vtool as vt
-    # # try:
-    #     # for count in _iter:
-
-    #         # # Randomly sample choose a set of data vectors
-    #         # if do_sampling:
-    #             # unused_didx = np.where(is_unused)[0]
-    #             # sx_to_uidx = rng.randint(num_unused, size=num_samples)
-    #             # sx_to_didx = unused_didx[sx_to_uidx]
-    #             # sx_to_data = data.take(sx_to_didx, axis=0)
-    #         # else:
-    #             # sx_to_data = data.compress(is_unused, axis=0)
-
-    #         # flann_on = num_used > 128
-
-    #         # if flann_on:
-    #             # if flann is None:
-    #                 # flann = pyflann.FLANN()
-    #                 # flann.build_index(centers[:num_used], **flann_params)
-    #             # # Distance from the sample data to current centers
-    #             # # (this call takes 98% of the time.)
-    #             # sx2_cidx, sx2_cdist = flann.nn_index(
-    #                 # sx_to_data, 1, checks=flann_params['checks'])
-    #         # else:
-    #             # # Dont use flann when number of centers is small
-    #             # # vt.L2(sx_to_data, centers[:num_used])
-    #             # import sklearn
-    #             # dists = sklearn.metrics.pairwise.euclidean_distances(
-    #                 # sx_to_data, centers[:num_used])
-
-    #         # # Choose unused sample with probability proportional to the squared
-    #         # # distance to the closest existing center
-    #         # rand_vals = rng.random_sample()
-    #         # sx2_cumdist = sx2_cdist.cumsum()
-    #         # sx2_cumprob = sx2_cumdist / sx2_cumdist[-1]
-    #         # chosen_sx = np.searchsorted(sx2_cumprob, rand_vals)
-    #         # if do_sampling:
-    #             # chosen_datax = sx_to_didx[chosen_sx]
-    #         # else:
-    #             # chosen_datax = chosen_sx
-
-    #         # # Remove the chosen index from unused indices
-    #         # is_unused[chosen_datax] = False
-    #         # chosen_data = data[chosen_datax]
-    #         # centers[num_used] = chosen_data
-    #         # num_used += 1
-    #         # num_unused -= 1
-
-    #         # if flann_on:
-    #             # # Append new center to data and flann index
-    #             # flann.add_points(chosen_data)
-
-    # # except KeyboardInterrupt:
-    #     # print('\n\n')
-    #     # raise
-
-    # # center_indices = np.where(~is_unused)[0]
-    # # # array(center_indices)
-    # # centers = data.take(center_indices, axis=0)
-    # # print('len(center_indices) = %r' % len(center_indices))
-    # # print('len(set(center_indices)) = %r' % len(set(center_indices)))
-    # return centers
+    from vtool.other import ensure_rng
+    rng = ensure_rng(rng)
+    if num_procs is None:
+        num_procs = multiprocessing.cpu_count()
+    if flann_params is None:
+        flann_params = {'algorithm': 'kdtree', 'trees': 4, 'checks': 32}
+
+    if num_samples is not None and num_samples < len(data):
+        # sorted indices keep memmapped reads sequential
+        sample_dxs = np.sort(rng.choice(len(data), num_samples, replace=False))
+        data = np.asarray(data[sample_dxs])
+    num_data = len(data)
+
+    if verbose:
+        print('akmeans++ (k-means||) on %r points. K=%r, num_rounds=%r' % (
+            num_data, K, num_rounds))
+
+    if num_data <= K:
+        if verbose:
+            print('Warning, K is not smaller than the number of datapoints')
+        return np.array(data[0:K])
+
+    # Oversampling factor (expected number of candidates per round)
+    ell = oversample * K
+    # Distance from every point to its closest candidate
+    min_dists = np.full(num_data, np.inf, dtype=np.float64)
+    min_cxs = np.zeros(num_data, dtype=np.int64)
+
+    # Choose the first candidate uniformly
+    cand_dxs = [rng.randint(num_data)]
+    new_dxs = np.array(cand_dxs)
+    _update_min_sqrd_dists(data, data[new_dxs], 0, min_dists, min_cxs,
+                           flann_params, num_procs)
+    round_iter = range(num_rounds)
+    if verbose:
+        round_iter = ut.ProgIter(round_iter, nTotal=num_rounds,
+                                 lbl='k-means|| rounds: ')
+    for count in round_iter:
+        cost = min_dists.sum()
+        if cost == 0:
+            break
+        # Sample each point independently proportional to its distance
+        probs = np.minimum(1.0, ell * min_dists / cost)
+        new_dxs = np.where(rng.random_sample(num_data) < probs)[0]
+        if len(new_dxs) == 0:
+            continue
+        _update_min_sqrd_dists(data, data[new_dxs], len(cand_dxs), min_dists,
+                               min_cxs, flann_params, num_procs)
+        cand_dxs.extend(new_dxs.tolist())
+
+    cand_dxs = np.array(cand_dxs)
+    # Weight each candidate by the number of points closest to it
+    cand_weights = np.bincount(min_cxs, minlength=len(cand_dxs)).astype(np.float64)
+    if verbose:
+        print('k-means|| reducing %r candidates to K=%r' % (len(cand_dxs), K))
+
+    if len(cand_dxs) <= K:
+        # Not enough candidates, fill with random unchosen points
+        flags = np.ones(num_data, dtype=np.bool_)
+        flags[cand_dxs] = False
+        extra_dxs = rng.choice(np.where(flags)[0], K - len(cand_dxs),
+                               replace=False)
+        center_dxs = np.hstack([cand_dxs, extra_dxs])
+    elif len(cand_dxs) * K <= 2 ** 30:
+        # Reduce with weighted k-means++ over the candidates
+        chosen_cxs = _weighted_kmeans_plusplus(data[cand_dxs], cand_weights,
+                                               K, rng)
+        center_dxs = cand_dxs[chosen_cxs]
+    else:
+        # Too many candidates for an exact reduction
+        chosen_cxs = _approx_weighted_kmeans_plusplus(
+            data[cand_dxs], cand_weights, K, rng, flann_params, num_procs)
+        center_dxs = cand_dxs[chosen_cxs]
+    centers = np.array(data[np.sort(center_dxs)])
+    return centers
+
+
+def _sqrd_dists_to(vecs, centers_):
+    """ Squared L2 from each row of vecs to each row of centers_ (float64) """
+    vecs_ = np.asarray(vecs, dtype=np.float64)
+    sqrd_dists = (
+        (vecs_ ** 2).sum(axis=1)[:, None] - 2 * vecs_.dot(centers_.T) +
+        (centers_ ** 2).sum(axis=1)[None, :])
+    np.maximum(sqrd_dists, 0, out=sqrd_dists)
+    return sqrd_dists
+
+
+def _update_min_sqrd_dists(data, new_centers, offset, min_dists, min_cxs,
+                           flann_params, num_procs=1, chunksize=4096,
+                           flann_thresh=1024):
+    """
+    Lowers min_dists and min_cxs (inplace) with the squared distance from each
+    datapoint to its closest new center (whose index starts at offset).
+
+    A FLANN index over the new centers is used when there are many of them,
+    otherwise distances are exact. Chunks of data are processed in a thread
+    pool (numpy releases the GIL for the distance computations).
+    """
+    if len(new_centers) > flann_thresh:
+        import pyflann
+        flann = pyflann.FLANN()
+        flann.build_index(new_centers, **flann_params)
+        for start in range(0, len(data), chunksize):
+            sl_ = slice(start, start + chunksize)
+            new_cxs, new_dists = flann.nn_index(
+                np.asarray(data[sl_], dtype=new_centers.dtype), 1,
+                checks=flann_params.get('checks', 32))
+            new_cxs = new_cxs.ravel()
+            new_dists = new_dists.ravel().astype(np.float64)
+            flags = new_dists < min_dists[sl_]
+            min_dists[sl_][flags] = new_dists[flags]
+            min_cxs[sl_][flags] = new_cxs[flags] + offset
+        return
+    centers_ = np.asarray(new_centers, dtype=np.float64)
+
+    def _update_chunk(start):
+        sl_ = slice(start, start + chunksize)
+        sqrd_dists = _sqrd_dists_to(data[sl_], centers_)
+        new_cxs = sqrd_dists.argmin(axis=1)
+        new_dists = sqrd_dists[np.arange(len(new_cxs)), new_cxs]
+        flags = new_dists < min_dists[sl_]
+        min_dists[sl_][flags] = new_dists[flags]
+        min_cxs[sl_][flags] = new_cxs[flags] + offset
+
+    starts = list(range(0, len(data), chunksize))
+    if num_procs > 1 and len(starts) > 1:
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(min(num_procs, len(starts)))
+        try:
+            pool.map(_update_chunk, starts)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for start in starts:
+            _update_chunk(start)
+
+
+def _weighted_kmeans_plusplus(cands, weights, K, rng):
+    """
+    Chooses K rows of cands with weighted k-means++ and returns their indices
+    """
+    cands_ = np.asarray(cands, dtype=np.float64)
+    chosen = np.zeros(len(cands_), dtype=np.bool_)
+    chosen_cxs = np.empty(K, dtype=np.int64)
+    chosen_cxs[0] = rng.choice(len(cands_), p=weights / weights.sum())
+    chosen[chosen_cxs[0]] = True
+    min_dists = _sqrd_dists_to(cands_, cands_[chosen_cxs[0:1]])[:, 0]
+    for count in range(1, K):
+        probs = weights * min_dists
+        probs[chosen] = 0
+        total = probs.sum()
+        if total > 0:
+            cx = np.searchsorted(probs.cumsum(), rng.random_sample() * total)
+            cx = min(cx, len(probs) - 1)
+        else:
+            cx = 0
+        if chosen[cx]:
+            # all remaining candidates are duplicates of chosen ones
+            cx = np.where(~chosen)[0][0]
+        chosen_cxs[count] = cx
+        chosen[cx] = True
+        np.minimum(min_dists, _sqrd_dists_to(cands_, cands_[cx:cx + 1])[:, 0],
+                   out=min_dists)
+    return chosen_cxs
+
+
+def _approx_weighted_kmeans_plusplus(cands, weights, K, rng, flann_params,
+                                     num_procs=1, num_batches=64):
+    """
+    Approximate weighted k-means++ for candidate sets too large for
+    _weighted_kmeans_plusplus.
+
+    Centers are chosen in num_batches batches. Each batch is sampled without
+    replacement proportional to weight times the squared distance to the
+    closest center chosen so far, and the distances are then lowered with a
+    FLANN index over the batch.
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from vtool.clustering2 import *  # NOQA
+        >>> from vtool.clustering2 import _approx_weighted_kmeans_plusplus
+        >>> rng = np.random.RandomState(0)
+        >>> blob_centers = rng.randint(0, 255, (10, 16))
+        >>> cands = np.vstack([rng.randn(100, 16) + c for c in blob_centers])
+        >>> weights = np.ones(len(cands))
+        >>> flann_params = {'algorithm': 'kdtree', 'trees': 4, 'checks': 32}
+        >>> chosen_cxs = _approx_weighted_kmeans_plusplus(
+        >>>     cands, weights, 10, rng, flann_params, num_batches=5)
+        >>> assert len(np.unique(chosen_cxs)) == 10
+        >>> # the first center is alone in its batch, so later batches are
+        >>> # drawn towards uncovered blobs
+        >>> result = ut.repr2(len(np.unique(chosen_cxs // 100)) >= 8)
+        >>> print(result)
+        True
+    """
+    num_cands = len(cands)
+    cands = np.asarray(cands)
+    chosen = np.zeros(num_cands, dtype=np.bool_)
+    chosen_cxs = np.empty(K, dtype=np.int64)
+    min_dists = np.full(num_cands, np.inf, dtype=np.float64)
+    # the closest center is tracked but not needed here
+    min_cxs = np.zeros(num_cands, dtype=np.int64)
+    # The first center is chosen alone so the first batch is spread out
+    batch_sizes = [1] + [len(part) for part in
+                         np.array_split(np.arange(K - 1),
+                                        min(num_batches, max(K - 1, 1)))]
+    num_chosen = 0
+    for batch_size in batch_sizes:
+        if batch_size == 0:
+            continue
+        if num_chosen == 0:
+            probs = weights.astype(np.float64)
+        else:
+            probs = weights * min_dists
+        probs[chosen] = 0
+        nonzero_cxs = np.where(probs > 0)[0]
+        num_take = min(batch_size, len(nonzero_cxs))
+        if num_take > 0:
+            batch_cxs = rng.choice(nonzero_cxs, num_take, replace=False,
+                                   p=probs[nonzero_cxs] / probs[nonzero_cxs].sum())
+        else:
+            batch_cxs = np.empty(0, dtype=np.int64)
+        if num_take < batch_size:
+            # remaining candidates are duplicates of chosen ones
+            flags = ~chosen
+            flags[batch_cxs] = False
+            batch_cxs = np.hstack([batch_cxs,
+                                   np.where(flags)[0][0:batch_size - num_take]])
+        chosen[batch_cxs] = True
+        chosen_cxs[num_chosen:num_chosen + batch_size] = batch_cxs
+        num_chosen += batch_size
+        _update_min_sqrd_dists(cands, cands[batch_cxs], 0, min_dists, min_cxs,
+                               flann_params, num_procs, flann_thresh=0)
+    return chosen_cxs
+
+
+class ChunkedData(ut.NiceRepr):
+    """
+    Read-only row-wise concatenation of 2D arrays (e.g. memmapped
+    per-file descriptors) without copying them into one array. Supports the
+    indexing akmeans needs: row slices, arrays of row indices, and take.
+
+    CommandLine:
+        python -m vtool.clustering2 --test-ChunkedData
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from vtool.clustering2 import *  # NOQA
+        >>> rng = np.random.RandomState(0)
+        >>> arr_list = [rng.randint(0, 255, (num, 4)).astype(np.uint8)
+        >>>             for num in [3, 0, 5, 2]]
+        >>> data = ChunkedData(arr_list)
+        >>> flat = np.vstack(arr_list)
+        >>> assert np.all(data[2:9] == flat[2:9])
+        >>> assert np.all(data[[9, 0, 4, 4]] == flat[[9, 0, 4, 4]])
+        >>> assert np.all(data.take([7, 1], axis=0) == flat[[7, 1]])
+        >>> assert np.all(data[-1] == flat[-1])
+        >>> result = str(data)
+        >>> print(result)
+        <ChunkedData(shape=(10, 4), nChunks=4)>
+    """
+
+    def __init__(chunked, arr_list):
+        chunked.arr_list = list(arr_list)
+        chunked.offsets = np.cumsum([0] + [len(arr) for arr in chunked.arr_list])
+        chunked.dtype = chunked.arr_list[0].dtype
+        chunked.shape = (int(chunked.offsets[-1]),) + chunked.arr_list[0].shape[1:]
+        for arr in chunked.arr_list:
+            assert arr.dtype == chunked.dtype, 'inconsistent dtype'
+            assert arr.shape[1:] == chunked.shape[1:], 'inconsistent shape'
+
+    @classmethod
+    def from_fpaths(cls, fpath_list):
+        """ Memory maps each .npy file in fpath_list """
+        return cls([np.load(fpath, mmap_mode='r') for fpath in fpath_list])
+
+    def __nice__(chunked):
+        return 'shape=%r, nChunks=%d' % (chunked.shape, len(chunked.arr_list))
+
+    def __len__(chunked):
+        return chunked.shape[0]
+
+    @property
+    def ndim(chunked):
+        return len(chunked.shape)
+
+    @property
+    def nbytes(chunked):
+        return sum(arr.nbytes for arr in chunked.arr_list)
+
+    def __getitem__(chunked, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(chunked))
+            if step != 1:
+                return chunked.take(np.arange(start, stop, step))
+            part_list = []
+            for arr, offset in zip(chunked.arr_list, chunked.offsets):
+                lo = max(start, offset)
+                hi = min(stop, offset + len(arr))
+                if lo < hi:
+                    part_list.append(np.asarray(arr[lo - offset:hi - offset]))
+            if len(part_list) == 0:
+                return np.empty((0,) + chunked.shape[1:], dtype=chunked.dtype)
+            return np.concatenate(part_list, axis=0)
+        elif isinstance(index, (int, np.integer)):
+            return chunked.take([index])[0]
+        else:
+            return chunked.take(index)
+
+    def take(chunked, indices, axis=0):
+        assert axis == 0, 'can only take rows'
+        rows = np.asarray(indices, dtype=np.int64).ravel()
+        rows = np.where(rows < 0, rows + len(chunked), rows)
+        chunkxs = np.searchsorted(chunked.offsets, rows, side='right') - 1
+        out = np.empty((len(rows),) + chunked.shape[1:], dtype=chunked.dtype)
+        for chunkx in np.unique(chunkxs):
+            flags = chunkxs == chunkx
+            arr = chunked.arr_list[chunkx]
+            out[flags] = arr[rows[flags] - chunked.offsets[chunkx]]
+        return out
 
 
 def get_akmeans_cfgstr(data, nCentroids, max_iters=5, initmethod='akmeans++', flann_params={},
-                       use_data_hash=True, cfgstr='', akmeans_cfgstr=None):
+                       use_data_hash=True, cfgstr='', akmeans_cfgstr=None,
+                       fingerprint='full', content_id=None, source_fpath=None):
+    """
+    fingerprint, content_id, and source_fpath determine how data is
+    identified (see nearest_neighbors.get_data_fingerprint). The default
+    hashes all of the data.
+    """
     if akmeans_cfgstr is None:
         # compute a hashstr based on the data
         cfgstr += '_nC=%d,nIter=%d,init=%s' % (nCentroids, max_iters, initmethod)
         akmeans_cfgstr = nntool.get_flann_cfgstr(data, flann_params,
-                                                 cfgstr, use_data_hash)
+                                                 cfgstr, use_data_hash,
+                                                 fingerprint=fingerprint,
+                                                 content_id=content_id,
+                                                 source_fpath=source_fpath)
     return akmeans_cfgstr
 
 
@@ -439,9 +699,21 @@ def assert_centroids(centroids, data, nCentroids, clip_centroids):
 def cached_akmeans(data, nCentroids, max_iters=5, flann_params={},
                    cache_dir='default', force_recomp=False, use_data_hash=True,
                    cfgstr='', refine=False, akmeans_cfgstr=None, use_cache=True,
-                   appname='vtool',  initmethod='akmeans++', clip_centroids=True):
+                   appname='vtool',  initmethod='akmeans++', clip_centroids=True,
+                   fingerprint='full', content_id=None, source_fpath=None,
+                   use_checkpoint=True):
     """ precompute aproximate kmeans with builtin caching
 
+    fingerprint, content_id, and source_fpath control how data is identified
+    in the cache key (see nearest_neighbors.get_data_fingerprint). For large
+    vocabularies fingerprint='sample' or a content_id avoids hashing all of
+    the data before a cache hit can be confirmed.
+
+    data may be a np.memmap or a ChunkedData (use a fingerprint other than
+    'full' for a ChunkedData). If use_checkpoint is True, progress is
+    checkpointed in cache_dir and an interrupted computation with the same
+    cfgstr resumes where it left off.
+
     Example:
         >>> import numpy as np
         >>> np.random.seed(42)
@@ -478,7 +750,10 @@ def cached_akmeans(data, nCentroids, max_iters=5, flann_params={},
     # Build a cfgstr if the full one is not specified
     akmeans_cfgstr = get_akmeans_cfgstr(data, nCentroids, max_iters,
                                         initmethod, flann_params,
-                                        use_data_hash, cfgstr, akmeans_cfgstr) + initmethod
+                                        use_data_hash, cfgstr, akmeans_cfgstr,
+                                        fingerprint=fingerprint,
+                                        content_id=content_id,
+                                        source_fpath=source_fpath) + initmethod
     try:
         # Try and load a previous centroiding
         if not use_cache or force_recomp:
@@ -526,10 +801,18 @@ def cached_akmeans(data, nCentroids, max_iters=5, flann_params={},
     #    centroids = flann.kmeans(data, nCentroids, max_iterations=max_iters)
     #    print('The true finish time is: ' + ut.get_timestamp('printable'))
     #else:
-    centroids = akmeans(data, nCentroids, max_iters, initmethod, flann_params)
+    if use_checkpoint:
+        checkpoint_fpath = join(cache_dir, CLUSTERS_FNAME + '_checkpoint_' +
+                                ut.hashstr27(akmeans_cfgstr) + '.npz')
+    else:
+        checkpoint_fpath = None
+    centroids = akmeans(data, nCentroids, max_iters, initmethod, flann_params,
+                        checkpoint_fpath=checkpoint_fpath)
     assert_centroids(centroids, data, nCentroids, clip_centroids)
     print('[akmeans.precompute] save and return')
     ut.save_cache(cache_dir, CLUSTERS_FNAME, akmeans_cfgstr, centroids)
+    if checkpoint_fpath is not None and exists(checkpoint_fpath):
+        os.remove(checkpoint_fpath)
     print('L___ END CACHED AKMEANS')
     return centroids
 
@@ -549,7 +832,9 @@ def tune_flann2(data):
 
 
 def akmeans(data, nCentroids, max_iters=5, initmethod='akmeans++',
-            flann_params={}, ave_unchanged_thresh=0, ave_unchanged_iterwin=10, monitor=False):
+            flann_params={}, ave_unchanged_thresh=0, ave_unchanged_iterwin=10, monitor=False,
+            batch_size=None, rng=None, checkpoint_fpath=None,
+            rebuild_tol=.25):
     """
     Approximiate K-Means (using FLANN)
 
@@ -560,18 +845,38 @@ def akmeans(data, nCentroids, max_iters=5, initmethod='akmeans++',
 
     Args:
         data - np.array with rows of data.
+        batch_size - if specified use mini-batch updates
+            (see minibatch_akmeans_iterations)
+        checkpoint_fpath - periodically save (and resume from) the state of
+            the iterations in this file
+        rebuild_tol - centroid drift (relative to the centroid spacing)
+            tolerated before the centroid index must be rebuilt
     """
     # Setup iterations
-    centroids = initialize_centroids(nCentroids, data, initmethod)
+    state = None
+    if checkpoint_fpath is not None and batch_size is None:
+        # A compatible checkpoint overwrites the centroids, so do not spend
+        # time seeding them
+        centroids_shape = (nCentroids, data.shape[1])
+        state = load_akmeans_checkpoint(checkpoint_fpath, data.shape[0],
+                                        centroids_shape,
+                                        (ave_unchanged_iterwin,))
+    if state is not None:
+        centroids = np.array(state['centroids'])
+    else:
+        centroids = initialize_centroids(nCentroids, data, initmethod, rng=rng)
     return akmeans_iterations(data, centroids, max_iters, flann_params,
                               ave_unchanged_thresh, ave_unchanged_iterwin,
-                              monitor=monitor)
+                              monitor=monitor, batch_size=batch_size, rng=rng,
+                              checkpoint_fpath=checkpoint_fpath,
+                              checkpoint_state=state,
+                              rebuild_tol=rebuild_tol)
 
 
-def initialize_centroids(nCentroids, data, initmethod='akmeans++'):
+def initialize_centroids(nCentroids, data, initmethod='akmeans++', rng=None):
     """ Initializes centroids to random datapoints """
     if initmethod == 'akmeans++':
-        centroids = np.copy(akmeans_plusplus_init(data, nCentroids))
+        centroids = np.copy(akmeans_plusplus_init(data, nCentroids, rng=rng))
     elif initmethod == 'random':
         nData = data.shape[0]
         datax_rand = np.arange(0, nData, dtype=np.int32)
@@ -623,13 +928,35 @@ def refine_akmeans(data, centroids, max_iters=5,
 
 def akmeans_iterations(data, centroids, max_iters, flann_params,
                        ave_unchanged_thresh=0, ave_unchanged_iterwin=10,
-                       monitor=False):
+                       monitor=False, batch_size=None, rng=None,
+                       chunksize=2 ** 14, checkpoint_fpath=None,
+                       checkpoint_secs=300, rebuild_tol=.25, max_dirty=1024,
+                       checkpoint_state=None):
     """
     Helper function which continues the iterations of akmeans
 
     Objective:
         argmin_{S} sum(sum(L2(x, u[i]) for x in S_i) for i in range(k))
 
+    If batch_size is specified, each of the max_iters iterations is a
+    mini-batch update (see minibatch_akmeans_iterations) instead of a pass
+    over all of the data.
+
+    Each pass streams over blocks of chunksize rows, so data may be a
+    np.memmap or a ChunkedData. If checkpoint_fpath is specified the state
+    of the current pass is saved there every checkpoint_secs seconds and an
+    existing checkpoint is resumed from (possibly mid-iteration). If the
+    checkpoint was already loaded (see load_akmeans_checkpoint) pass it as
+    checkpoint_state so it is not read again. The checkpoint holds the
+    positions the centroid index was built over, so with an exact index
+    (e.g. {'algorithm': 'linear'}) a resumed run gives the same centroids as
+    an uninterrupted one. With an approximate index FLANN may answer a few
+    lookups differently after the index is rebuilt.
+
+    rebuild_tol and max_dirty control how often the centroid index is rebuilt
+    (see CentroidAssignmentEngine). rebuild_tol=0 rebuilds it every time a
+    centroid moves.
+
     CommandLine:
         python -m vtool.clustering2 akmeans_iterations --show
 
@@ -655,12 +982,39 @@ def akmeans_iterations(data, centroids, max_iters, flann_params,
         >>> plot_centroids(data, centroids)
         >>> ut.show_if_requested()
     """
+    if batch_size is not None:
+        return minibatch_akmeans_iterations(data, centroids, max_iters,
+                                            flann_params, batch_size, rng=rng,
+                                            monitor=monitor)
     nData = data.shape[0]
     nCentroids = centroids.shape[0]
     # Initialize assignments
     datax2_centroidx_old = -np.ones(nData, dtype=np.int32)
     # Keep track of how many points have changed over an iteration window
     win2_unchanged = np.zeros(ave_unchanged_iterwin, dtype=centroids.dtype) + len(data)
+    # The centroid index and assignment bounds persist across iterations
+    engine = CentroidAssignmentEngine(centroids, flann_params,
+                                      rebuild_tol=rebuild_tol,
+                                      max_dirty=max_dirty,
+                                      chunksize=chunksize)
+    start_count = 0
+    # First row of an interrupted pass
+    resume_start = 0
+    state = checkpoint_state
+    if state is None and checkpoint_fpath is not None:
+        state = load_akmeans_checkpoint(checkpoint_fpath, nData,
+                                        centroids.shape, win2_unchanged.shape)
+    if state is not None:
+        print('[akmeans] resuming iteration %d at row %d' % (
+            state['count'], state['start']))
+        start_count = int(state['count'])
+        resume_start = int(state['start'])
+        centroids[:] = state['centroids']
+        sums = state['sums']
+        counts = state['counts']
+        datax2_centroidx_old = state['datax2_centroidx_old']
+        win2_unchanged = state['win2_unchanged']
+        engine.set_state(state)
 
     if monitor:
         history = ut.ddict(list)
@@ -677,11 +1031,33 @@ def akmeans_iterations(data, centroids, max_iters, flann_params,
     ) % (data.shape, nCentroids, max_iters,
          ave_unchanged_thresh, ave_unchanged_iterwin))
     sys.stdout.flush()
-    for count in ut.ProgIter(range(0, max_iters), nTotal=max_iters, lbl='Akmeans: '):
-        # 1) Assign each datapoint to the nearest centroid
-        datax2_centroidx, dists = approximate_assignments(centroids, data, 1, flann_params)
+    checkpoint_tt = ut.tic()
+    for count in ut.ProgIter(range(start_count, max_iters),
+                             nTotal=max_iters - start_count, lbl='Akmeans: '):
+        # 1) Assign each block of datapoints to the nearest centroid and
+        # accumulate the block into the centroid sums
+        if resume_start == 0:
+            if count > 0:
+                engine.update_centroids(centroids)
+            sums = np.zeros(centroids.shape, dtype=np.float64)
+            counts = np.zeros(nCentroids, dtype=np.int64)
+        engine.begin_pass(nData)
+        for start in range(resume_start, nData, chunksize):
+            block = np.asarray(data[start:start + chunksize])
+            blockx2_centroidx, _ = engine.assign_block(start, block)
+            accumulate_centroid_sums(block, blockx2_centroidx, nCentroids,
+                                     sums, counts)
+            checkpoint_due = (checkpoint_fpath is not None and
+                              ut.toc(checkpoint_tt) > checkpoint_secs)
+            if checkpoint_due:
+                save_akmeans_checkpoint(
+                    checkpoint_fpath, count, start + chunksize, centroids,
+                    sums, counts, datax2_centroidx_old, win2_unchanged, engine)
+                checkpoint_tt = ut.tic()
+        resume_start = 0
+        datax2_centroidx, dists = engine.end_pass()
         # 2) Compute new centroids (inplace) based on assignments
-        centroids = compute_centroids(data, centroids, datax2_centroidx)
+        centroids = _assign_centroid_means(centroids, sums, counts)
         # 3) Convergence Check: which datapoints changed membership?
         num_changed = (datax2_centroidx_old != datax2_centroidx).sum()
         win2_unchanged[count % ave_unchanged_iterwin] = num_changed
@@ -691,6 +1067,8 @@ def akmeans_iterations(data, centroids, max_iters, flann_params,
             history['epoch_num'].append(count + 1)
             history['loss'].append(loss)
             history['ave_unchanged'].append(ave_unchanged)
+            history['assign_time'].append(engine.iter_stats[-1]['assign_time'])
+            history['num_requeried'].append(engine.iter_stats[-1]['num_requeried'])
             # import plottool as pt
             # pt.multi_plot('epoch_num', history, fnum=1)
             # pt.update()
@@ -705,6 +1083,129 @@ def akmeans_iterations(data, centroids, max_iters, flann_params,
         return centroids
 
 
+def save_akmeans_checkpoint(checkpoint_fpath, count, start, centroids, sums,
+                            counts, datax2_centroidx_old, win2_unchanged,
+                            engine):
+    """
+    Saves the state of an akmeans pass that has processed rows [0, start) of
+    iteration count. Writes to a temporary file first so an interruption
+    never leaves a partial checkpoint.
+    """
+    state = engine.get_state()
+    state.update({
+        'count': np.array(count),
+        'start': np.array(start),
+        'centroids': centroids,
+        'sums': sums,
+        'counts': counts,
+        'datax2_centroidx_old': datax2_centroidx_old,
+        'win2_unchanged': win2_unchanged,
+    })
+    tmp_fpath = checkpoint_fpath + '.%d.tmp' % (os.getpid(),)
+    with open(tmp_fpath, 'wb') as file_:
+        np.savez(file_, **state)
+    if ut.WIN32 and exists(checkpoint_fpath):
+        os.remove(checkpoint_fpath)
+    os.rename(tmp_fpath, checkpoint_fpath)
+
+
+def load_akmeans_checkpoint(checkpoint_fpath, nData, centroids_shape,
+                            win_shape):
+    """
+    Returns the state saved by save_akmeans_checkpoint or None if there is
+    no compatible checkpoint.
+    """
+    if not exists(checkpoint_fpath):
+        return None
+    try:
+        with np.load(checkpoint_fpath) as npz:
+            state = {key: npz[key] for key in npz.files}
+    except (IOError, ValueError) as ex:
+        ut.printex(ex, 'unreadable akmeans checkpoint', iswarning=True)
+        return None
+    is_compatible = (len(state['datax2_centroidx_old']) == nData and
+                     state['centroids'].shape == centroids_shape and
+                     state['win2_unchanged'].shape == win_shape)
+    if not is_compatible:
+        print('[akmeans] ignoring incompatible checkpoint')
+        return None
+    return state
+
+
+def minibatch_akmeans_iterations(data, centroids, max_iters, flann_params,
+                                 batch_size=10000, rng=None, monitor=False):
+    """
+    Mini-batch approximate k-means.
+
+    Each iteration assigns a random batch of rows to their approximate
+    nearest centroid and moves each centroid towards the mean of its batch
+    points with a learning rate of 1 / (number of points it has seen).
+    Only one batch is read at a time, so data can be a memmap of more
+    descriptors than fit in memory. Batch rows are drawn with replacement
+    and deduplicated, so a batch may hold slightly fewer than batch_size
+    rows.
+
+    References:
+        Sculley. Web-scale k-means clustering. WWW 2010.
+
+    CommandLine:
+        python -m vtool.clustering2 --test-minibatch_akmeans_iterations
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from vtool.clustering2 import *  # NOQA
+        >>> rng = np.random.RandomState(42)
+        >>> # three well separated blobs
+        >>> blob_centers = np.array([[0, 0], [10, 10], [-10, 10]])
+        >>> data = np.vstack([rng.randn(500, 2) + c for c in blob_centers])
+        >>> centroids = data[[0, 500, 1000]] + 1
+        >>> centroids = minibatch_akmeans_iterations(data, centroids, 20, {},
+        >>>                                          batch_size=100, rng=rng)
+        >>> result = ut.repr2(np.round(centroids).astype(np.int32).tolist())
+        >>> print(result)
+        [[0, 0], [10, 10], [-10, 10]]
+    """
+    from vtool.other import ensure_rng
+    rng = ensure_rng(rng)
+    nData = data.shape[0]
+    nCentroids = centroids.shape[0]
+    batch_size = min(batch_size, nData)
+    # accumulate in float so small updates are not lost to rounding
+    centroids_ = centroids.astype(np.float64)
+    centroidx2_count = np.zeros(nCentroids, dtype=np.int64)
+    engine = CentroidAssignmentEngine(centroids, flann_params)
+    if monitor:
+        history = ut.ddict(list)
+    for count in ut.ProgIter(range(0, max_iters), nTotal=max_iters,
+                             lbl='Minibatch akmeans: '):
+        # sampling without replacement is O(nData) per batch; np.unique
+        # drops repeats and returns sorted indexes, which read memmapped
+        # data sequentially
+        batchxs = np.unique(rng.randint(0, nData, batch_size))
+        batch = np.asarray(data[batchxs])
+        if count > 0:
+            engine.update_centroids(centroids_)
+        batchx2_centroidx, dists = engine.query(batch)
+        sums, counts = accumulate_centroid_sums(batch, batchx2_centroidx,
+                                                nCentroids)
+        nonempty = counts > 0
+        centroidx2_count += counts
+        # c += (sum(x) - n * c) / total_n
+        centroids_[nonempty] += (
+            (sums[nonempty] - counts[nonempty][:, None] * centroids_[nonempty]) /
+            centroidx2_count[nonempty][:, None])
+        if monitor:
+            history['epoch_num'].append(count + 1)
+            history['loss'].append(np.sqrt(dists).mean())
+    if np.issubdtype(centroids.dtype, np.integer):
+        centroids_ = np.round(centroids_)
+    centroids[:] = centroids_
+    if monitor:
+        return centroids, history
+    else:
+        return centroids
+
+
 class AnnoyWraper(object):
     """
     flann-like interface to annnoy
@@ -757,10 +1258,484 @@ def approximate_assignments(seachedvecs, queryvecs, K, flann_params):
     return qx2_sx, qdist2_sdist
 
 
+def _smallest_k_sorted(dists, idxs, K):
+    """ The K smallest entries of each row of dists (and idxs), sorted """
+    rowxs = np.arange(len(dists))[:, None]
+    if dists.shape[1] > K:
+        partx = np.argpartition(dists, K - 1, axis=1)[:, 0:K]
+        dists = dists[rowxs, partx]
+        idxs = idxs[rowxs, partx]
+    sortx = dists.argsort(axis=1, kind='mergesort')
+    return idxs[rowxs, sortx], dists[rowxs, sortx]
+
+
+class CentroidAssignmentEngine(ut.NiceRepr):
+    """
+    Keeps one approximate nearest neighbor index over the centroids alive
+    across akmeans iterations.
+
+    Centroids that have drifted from their indexed position by more than
+    rebuild_tol times the median spacing between neighboring centroids
+    (measured when the index is built) are marked dirty and compared against
+    every query by brute force. The index is rebuilt only when more than
+    max_dirty_frac of the centroids (or more than max_dirty centroids) are
+    dirty.
+
+    The remaining (clean) centroids are looked up in the stale index.
+    Candidates returned by the index are rescored against the current
+    centroids, and no other clean centroid can be closer than the distance
+    to the farthest returned (indexed) candidate minus the largest drift of
+    any clean centroid. Rows where that bound does not prove the nearest
+    centroid are looked up again with more neighbors (and finally by brute
+    force), so an exact index gives exact assignments. Hamerly-style bounds
+    (an upper bound on the distance to the assigned centroid and a lower
+    bound on the distance to the second nearest) are kept for the assigned
+    data so only points whose bounds overlap after the centroids move are
+    looked up again.
+
+    Per-iteration statistics and timings are appended to engine.iter_stats.
+
+    References:
+        Hamerly. Making k-means even faster. SDM 2010.
+
+    CommandLine:
+        python -m vtool.clustering2 --test-CentroidAssignmentEngine
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from vtool.clustering2 import *  # NOQA
+        >>> rng = np.random.RandomState(42)
+        >>> data = rng.randn(2000, 4).astype(np.float32)
+        >>> centroids = data[0:40].copy()
+        >>> engine = CentroidAssignmentEngine(centroids, {'algorithm': 'linear'})
+        >>> for count in range(8):
+        >>>     datax2_centroidx, dists = engine.assign(data)
+        >>>     # agrees with exhaustive assignment even with a stale index
+        >>>     sqrd_dists = ((data[:, None, :] - engine.centroids[None, :, :]) ** 2).sum(-1)
+        >>>     assert np.all(datax2_centroidx == sqrd_dists.argmin(axis=1))
+        >>>     assert np.all(dists >= sqrd_dists.min(axis=1) - 1e-4)
+        >>>     centroids = compute_centroids(data, centroids, datax2_centroidx)
+        >>>     engine.update_centroids(centroids)
+        >>> num_checked_list = ut.get_list_column(engine.iter_stats, 'num_checked')
+        >>> assert num_checked_list[0] == len(data)
+        >>> assert num_checked_list[-1] < len(data)
+        >>> # the index is not rebuilt every iteration
+        >>> result = ut.repr2(engine.num_builds < len(engine.iter_stats))
+        >>> print(result)
+        True
+    """
+
+    def __init__(engine, centroids, flann_params={}, rebuild_tol=.25,
+                 max_dirty_frac=.1, max_dirty=1024, chunksize=2 ** 14,
+                 dirty_block_elems=2 ** 22, max_index_neighbors=32,
+                 verbose=False):
+        engine.flann_params = flann_params
+        engine.rebuild_tol = rebuild_tol
+        engine.max_dirty_frac = max_dirty_frac
+        engine.max_dirty = max_dirty
+        engine.chunksize = chunksize
+        # Max number of query-by-dirty-centroid distances held at once
+        engine.dirty_block_elems = dirty_block_elems
+        # Rows that need more index neighbors than this are brute forced
+        engine.max_index_neighbors = max_index_neighbors
+        engine.verbose = verbose
+        engine.index_dtype = centroids.dtype
+        engine.centroids = np.array(centroids, dtype=np.float64)
+        engine.indexed_centroids = None
+        engine.centroid_spacing = 0.0
+        engine.dirtyxs = np.empty(0, dtype=np.int32)
+        # Largest distance of a clean centroid from its indexed position
+        engine.max_clean_drift = 0.0
+        engine.flann = None
+        engine.num_builds = 0
+        engine.iter_stats = []
+        # Bounds for the most recently assigned data
+        engine.assigns = None
+        engine.upper = None
+        engine.lower = None
+        engine.fresh = True
+        # Total movement of each centroid since the last assignment
+        engine.shift = np.zeros(len(centroids), dtype=np.float64)
+        engine._update_time = 0
+        engine._rebuilt = False
+        engine._build_index()
+
+    def __nice__(engine):
+        return 'nCentroids=%d, nDirty=%d, num_builds=%d' % (
+            len(engine.centroids), len(engine.dirtyxs), engine.num_builds)
+
+    def _build_index(engine, indexed_centroids=None):
+        import pyflann
+        if engine.verbose:
+            print('[akmeans.engine] building centroid index')
+        if indexed_centroids is None:
+            indexed_centroids = engine.centroids.astype(engine.index_dtype)
+        engine.flann = pyflann.FLANN()
+        engine.flann.build_index(indexed_centroids, **engine.flann_params)
+        # Drift is measured from the values actually in the index
+        engine.indexed_centroids = indexed_centroids.astype(np.float64)
+        engine.dirtyxs = np.empty(0, dtype=np.int32)
+        engine.num_builds += 1
+        engine.centroid_spacing = engine._estimate_spacing()
+        engine._update_drift()
+
+    def _update_drift(engine):
+        drift = np.sqrt(((engine.centroids - engine.indexed_centroids) ** 2).sum(axis=1))
+        clean_flags = np.ones(len(drift), dtype=np.bool_)
+        clean_flags[engine.dirtyxs] = False
+        clean_drift = drift[clean_flags]
+        engine.max_clean_drift = float(clean_drift.max()) if len(clean_drift) else 0.0
+        return drift
+
+    def _estimate_spacing(engine, num_samples=1024):
+        """
+        Median distance from a sample of indexed centroids to their nearest
+        other centroid. Sets the scale of rebuild_tol.
+        """
+        nCentroids = len(engine.indexed_centroids)
+        if nCentroids < 2:
+            return 0.0
+        samplexs = np.unique(np.linspace(0, nCentroids - 1,
+                                         min(nCentroids, num_samples)).astype(np.int64))
+        sample = engine.indexed_centroids[samplexs].astype(engine.index_dtype)
+        checks = engine.flann_params.get('checks', 1028)
+        _, sqrd_dists = engine.flann.nn_index(sample, 2, checks=checks)
+        sqrd_dists = np.asarray(sqrd_dists, dtype=np.float64).reshape(len(sample), 2)
+        return float(np.median(np.sqrt(np.maximum(sqrd_dists[:, 1], 0))))
+
+    def _max_num_dirty(engine):
+        return min(engine.max_dirty_frac * len(engine.centroids),
+                   engine.max_dirty)
+
+    def update_centroids(engine, centroids):
+        """
+        Informs the engine that the centroids moved. Returns the distance
+        each centroid moved.
+        """
+        tt = ut.tic()
+        centroids = np.array(centroids, dtype=np.float64)
+        delta = np.sqrt(((centroids - engine.centroids) ** 2).sum(axis=1))
+        engine.shift += delta
+        engine.centroids = centroids
+        engine.dirtyxs = np.empty(0, dtype=np.int32)
+        drift = engine._update_drift()
+        drift_tol = engine.rebuild_tol * engine.centroid_spacing
+        dirtyxs = np.where(drift > drift_tol)[0].astype(np.int32)
+        engine._rebuilt = len(dirtyxs) > engine._max_num_dirty()
+        if engine._rebuilt:
+            engine._build_index()
+        else:
+            engine.dirtyxs = dirtyxs
+            engine._update_drift()
+        engine._update_time += ut.toc(tt)
+        return delta
+
+    def _nearest2(engine, vecs):
+        """
+        Returns the indices and distances of the two nearest centroids to each
+        vector, and a lower bound on the distance to the second nearest.
+
+        Rows whose nearest centroid is not proven by the stale index bound
+        are looked up again with more neighbors and finally by brute force.
+        """
+        nCentroids = len(engine.centroids)
+        K = min(2, nCentroids)
+        assigns = np.empty(len(vecs), dtype=np.int32)
+        upper = np.empty(len(vecs), dtype=np.float64)
+        lower = np.empty(len(vecs), dtype=np.float64)
+        for start in range(0, len(vecs), engine.chunksize):
+            chunk = np.asarray(vecs[start:start + engine.chunksize])
+            chunk_ = chunk.astype(np.float64)
+            todo = np.arange(len(chunk))
+            num_neighbors = K
+            while len(todo) > 0:
+                if num_neighbors <= engine.max_index_neighbors:
+                    best_idxs, best_dists, bound = engine._index_candidates(
+                        chunk[todo], chunk_[todo], num_neighbors, K)
+                else:
+                    best_idxs, best_dists, bound = engine._brute_candidates(
+                        chunk_[todo], K)
+                dist1 = np.sqrt(best_dists[:, 0])
+                if K > 1:
+                    dist2 = np.minimum(np.sqrt(best_dists[:, 1]), bound)
+                else:
+                    dist2 = np.full(len(todo), np.inf)
+                safe = dist1 <= bound
+                rowxs = todo[safe] + start
+                assigns[rowxs] = best_idxs[safe, 0]
+                upper[rowxs] = dist1[safe]
+                lower[rowxs] = dist2[safe]
+                todo = todo[~safe]
+                num_neighbors *= 4
+        return assigns, upper, lower
+
+    def _index_candidates(engine, chunk, chunk_, num_neighbors, K):
+        """
+        Looks up num_neighbors indexed centroids and merges in the dirty
+        centroids.
+
+        Returns:
+            tuple: (best_idxs, best_dists, bound) - the K best candidates by
+                current squared distance (sorted), and a lower bound on the
+                distance to any clean centroid that was not a candidate
+        """
+        nCentroids = len(engine.centroids)
+        num_neighbors = min(num_neighbors, nCentroids)
+        checks = engine.flann_params.get('checks', 1028)
+        idxs, _ = engine.flann.nn_index(chunk.astype(engine.index_dtype),
+                                        num_neighbors, checks=checks)
+        idxs = idxs.reshape(len(chunk), num_neighbors).astype(np.int32)
+        cand_dists = np.empty(idxs.shape, dtype=np.float64)
+        stale_dists = np.empty(idxs.shape, dtype=np.float64)
+        for kx in range(num_neighbors):
+            cand_dists[:, kx] = ((chunk_ - engine.centroids[idxs[:, kx]]) ** 2).sum(axis=1)
+            stale_dists[:, kx] = ((chunk_ - engine.indexed_centroids[idxs[:, kx]]) ** 2).sum(axis=1)
+        if num_neighbors == nCentroids:
+            bound = np.full(len(chunk), np.inf)
+        else:
+            # Every other indexed centroid is at least as far as the farthest
+            # candidate was when it was indexed (the slack absorbs rounding
+            # of the query in the index dtype)
+            stale_kth = np.sqrt(stale_dists.max(axis=1))
+            bound = (stale_kth * (1 - 1e-6) - 1e-6 -
+                     engine.max_clean_drift)
+        best_idxs, best_dists = _smallest_k_sorted(cand_dists, idxs, K)
+        if len(engine.dirtyxs) > 0:
+            best_idxs, best_dists = engine._merge_centroids(
+                chunk_, best_idxs, best_dists, engine.dirtyxs, idxs)
+        return best_idxs, best_dists, bound
+
+    def _brute_candidates(engine, chunk_, K):
+        """ Compares chunk_ with every centroid """
+        best_idxs = np.zeros((len(chunk_), K), dtype=np.int32)
+        best_dists = np.full((len(chunk_), K), np.inf)
+        allxs = np.arange(len(engine.centroids), dtype=np.int32)
+        best_idxs, best_dists = engine._merge_centroids(
+            chunk_, best_idxs, best_dists, allxs)
+        bound = np.full(len(chunk_), np.inf)
+        return best_idxs, best_dists, bound
+
+    def _merge_centroids(engine, chunk_, best_idxs, best_dists, cxs,
+                         exclude_idxs=None):
+        """
+        Merges the squared distances to the centroids cxs into the K best
+        (sorted) candidates of each row. Centroids are scored in sub-blocks
+        with the dot product form so at most dirty_block_elems distances are
+        held at once. Entries of exclude_idxs are already candidates.
+        """
+        K = best_idxs.shape[1]
+        block_size = max(1, engine.dirty_block_elems // max(1, len(chunk_)))
+        for dstart in range(0, len(cxs), block_size):
+            block_cxs = cxs[dstart:dstart + block_size]
+            block_dists = _sqrd_dists_to(chunk_, engine.centroids[block_cxs])
+            if exclude_idxs is not None:
+                for kx in range(exclude_idxs.shape[1]):
+                    block_dists[block_cxs[None, :] == exclude_idxs[:, kx:kx + 1]] = np.inf
+            cand_dists = np.hstack([best_dists, block_dists])
+            cand_idxs = np.hstack([best_idxs,
+                                   np.tile(block_cxs, (len(chunk_), 1))])
+            best_idxs, best_dists = _smallest_k_sorted(cand_dists, cand_idxs, K)
+        return best_idxs, best_dists
+
+    def query(engine, vecs):
+        """
+        Returns the nearest centroid and squared distance for each vector
+        without using or modifying the stored bounds.
+        """
+        assigns, dist1, _ = engine._nearest2(vecs)
+        return assigns, dist1 ** 2
+
+    def begin_pass(engine, nData):
+        """
+        Starts a pass of assign_block calls over nData rows. The first pass
+        (or a pass over a different number of rows) looks up every row.
+        """
+        engine._pass_tt = ut.tic()
+        engine._pass_stats = {'num_checked': 0, 'num_requeried': 0}
+        if engine.assigns is None or len(engine.assigns) != nData:
+            engine.assigns = np.zeros(nData, dtype=np.int32)
+            engine.upper = np.zeros(nData, dtype=np.float64)
+            engine.lower = np.zeros(nData, dtype=np.float64)
+            engine.fresh = True
+
+    def assign_block(engine, start, block):
+        """
+        Assigns the rows data[start:start + len(block)] == block. Only rows
+        whose Hamerly bounds overlap are looked up again.
+
+        Returns:
+            tuple: (blockx2_centroidx, squared distances)
+        """
+        sl_ = slice(start, start + len(block))
+        assigns = engine.assigns[sl_]
+        upper = engine.upper[sl_]
+        lower = engine.lower[sl_]
+        if engine.fresh:
+            assigns[:], upper[:], lower[:] = engine._nearest2(block)
+            num_checked = num_requeried = len(block)
+        else:
+            shift = engine.shift
+            # Hamerly: the lower bound shrinks by the largest movement of any
+            # centroid other than the assigned one
+            if len(shift) > 1:
+                top2x = shift.argsort()[::-1][0:2]
+                max_other = np.full(len(block), shift[top2x[0]])
+                max_other[assigns == top2x[0]] = shift[top2x[1]]
+            else:
+                max_other = np.zeros(len(block))
+            upper += shift[assigns]
+            lower -= max_other
+            checkxs = np.where(upper > lower)[0]
+            num_checked = len(checkxs)
+            num_requeried = 0
+            if num_checked > 0:
+                # Tighten the upper bound before doing a full lookup
+                check_vecs = np.asarray(block[checkxs], dtype=np.float64)
+                diffs = check_vecs - engine.centroids[assigns[checkxs]]
+                upper[checkxs] = np.sqrt((diffs ** 2).sum(axis=1))
+                requeryxs = checkxs[upper[checkxs] > lower[checkxs]]
+                num_requeried = len(requeryxs)
+                if num_requeried > 0:
+                    assigns_, upper_, lower_ = engine._nearest2(block[requeryxs])
+                    assigns[requeryxs] = assigns_
+                    upper[requeryxs] = upper_
+                    lower[requeryxs] = lower_
+        engine._pass_stats['num_checked'] += num_checked
+        engine._pass_stats['num_requeried'] += num_requeried
+        return assigns.copy(), upper ** 2
+
+    def end_pass(engine):
+        """
+        Finishes a pass and records its statistics
+
+        Returns:
+            tuple: (datax2_centroidx, squared distances) - distances of rows
+                that were not looked up again are upper bounds
+        """
+        engine.shift[:] = 0
+        engine.fresh = False
+        stats = {
+            'update_time': engine._update_time,
+            'assign_time': ut.toc(engine._pass_tt),
+            'rebuilt': engine._rebuilt,
+            'num_dirty': len(engine.dirtyxs),
+        }
+        stats.update(engine._pass_stats)
+        engine.iter_stats.append(stats)
+        engine._update_time = 0
+        engine._rebuilt = False
+        return engine.assigns.copy(), engine.upper ** 2
+
+    def assign(engine, data):
+        """
+        Assigns each row of data to its (approximate) nearest centroid,
+        streaming over blocks of chunksize rows (data may be a memmap).
+
+        Returns:
+            tuple: (datax2_centroidx, squared distances) - distances of rows
+                that were not looked up again are upper bounds
+        """
+        nData = len(data)
+        engine.begin_pass(nData)
+        for start in range(0, nData, engine.chunksize):
+            block = np.asarray(data[start:start + engine.chunksize])
+            engine.assign_block(start, block)
+        return engine.end_pass()
+
+    def get_state(engine):
+        """ Returns the arrays needed to resume a pass (see set_state) """
+        return {
+            'engine_centroids': engine.centroids,
+            'engine_assigns': engine.assigns,
+            'engine_upper': engine.upper,
+            'engine_lower': engine.lower,
+            'engine_shift': engine.shift,
+            'engine_fresh': np.array(engine.fresh),
+            'engine_indexed_centroids': engine.indexed_centroids.astype(engine.index_dtype),
+            'engine_dirtyxs': engine.dirtyxs,
+        }
+
+    def set_state(engine, state):
+        """
+        Restores a state from get_state. The index is rebuilt over the same
+        (possibly stale) centroid positions and the same centroids are dirty,
+        so with an exact index the resumed lookups match the original run.
+        """
+        engine.centroids = np.array(state['engine_centroids'], dtype=np.float64)
+        engine.assigns = np.array(state['engine_assigns'])
+        engine.upper = np.array(state['engine_upper'])
+        engine.lower = np.array(state['engine_lower'])
+        engine.shift = np.array(state['engine_shift'])
+        engine.fresh = bool(state['engine_fresh'])
+        engine._build_index(np.array(state['engine_indexed_centroids']))
+        engine.dirtyxs = np.array(state['engine_dirtyxs'], dtype=np.int32)
+        engine._update_drift()
+
+
+def accumulate_centroid_sums(data, datax2_centroidx, nCentroids, sums=None,
+                             counts=None, chunksize=2 ** 16):
+    r"""
+    Scatters data into per-centroid, per-dimension sums and counts in a
+    single pass over the rows of data (in chunks, so data may be a memmap).
+
+    Args:
+        data (ndarray): rows of data
+        datax2_centroidx (ndarray): centroid assigned to each row
+        nCentroids (int): number of centroids
+        sums (ndarray): float64 (nCentroids, dim) accumulator (default zeros)
+        counts (ndarray): int64 (nCentroids,) accumulator (default zeros)
+
+    Returns:
+        tuple: (sums, counts)
+
+    CommandLine:
+        python -m vtool.clustering2 --test-accumulate_centroid_sums
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from vtool.clustering2 import *  # NOQA
+        >>> rng = np.random.RandomState(42)
+        >>> data = rng.randint(0, 255, (100, 8)).astype(np.uint8)
+        >>> datax2_centroidx = rng.randint(0, 5, 100)
+        >>> sums, counts = accumulate_centroid_sums(data, datax2_centroidx, 6,
+        >>>                                         chunksize=30)
+        >>> for centroidx in range(6):
+        >>>     flags = datax2_centroidx == centroidx
+        >>>     assert counts[centroidx] == flags.sum()
+        >>>     assert np.allclose(sums[centroidx], data[flags].sum(axis=0))
+        >>> result = ut.repr2(counts.tolist())
+        >>> print(result)
+        [18, 16, 16, 22, 28, 0]
+    """
+    dim = data.shape[1]
+    if sums is None:
+        sums = np.zeros((nCentroids, dim), dtype=np.float64)
+    if counts is None:
+        counts = np.zeros(nCentroids, dtype=np.int64)
+    for start in range(0, len(data), chunksize):
+        chunk = np.asarray(data[start:start + chunksize], dtype=np.float64)
+        chunk_idxs = datax2_centroidx[start:start + chunksize]
+        counts += np.bincount(chunk_idxs, minlength=nCentroids)
+        for dimx in range(dim):
+            sums[:, dimx] += np.bincount(chunk_idxs, weights=chunk[:, dimx],
+                                         minlength=nCentroids)
+    return sums, counts
+
+
+def _assign_centroid_means(centroids, sums, counts):
+    """ Sets non-empty centroids to sums / counts (inplace) """
+    nonempty = counts > 0
+    means = sums[nonempty] / counts[nonempty][:, None]
+    if np.issubdtype(centroids.dtype, np.integer):
+        means = np.round(means)
+    centroids[nonempty] = means
+    return centroids
+
+
 def compute_centroids(data, centroids, datax2_centroidx):
     """
-    Computes centroids given datax assignments
-    TODO: maybe use the grouping code instad of the LR algorithm
+    Computes centroids given datax assignments. Each centroid becomes the
+    per-dimension mean of its datapoints. Empty centroids are unchanged.
 
     >>> from vtool.clustering2 import *  # NOQA
     >>> import numpy as np
@@ -773,32 +1748,10 @@ def compute_centroids(data, centroids, datax2_centroidx):
     >>> (datax2_centroidx, _) = approximate_assignments(centroids, data, 1, flann_params)
     >>> out = compute_centroids(data, centroids, datax2_centroidx)
     """
-    # if True:
-    unique_groups, groupxs = group_indices(datax2_centroidx)
-    for centroidx, xs in zip(unique_groups, groupxs):
-        # Inplace modification of centroid
-        centroids[centroidx] = data.take(xs, axis=0).mean()
-    # else:
-    #     nData = data.shape[0]
-    #     nCentroids = centroids.shape[0]
-    #     # sort data by centroid
-    #     datax_sortx = datax2_centroidx.argsort()
-    #     datax_sort  = datax2_centroidx[datax_sortx]
-    #     # group datapoints by centroid using a sliding grouping algorithm
-    #     centroidx2_dataLRx = [None] * nCentroids
-    #     _L = 0
-    #     for _R in range(nData + 1):  # Slide R
-    #         if _R == nData or datax_sort[_L] != datax_sort[_R]:
-    #             centroidx2_dataLRx[datax_sort[_L]] = (_L, _R)
-    #             _L = _R
-    #     # Compute the centers of each group (centroid) of datapoints
-    #     for centroidx, dataLRx in enumerate(centroidx2_dataLRx):
-    #         if dataLRx is None:
-    #             continue  # ON EMPTY CLUSTER
-    #         (_L, _R) = dataLRx
-    #         # The centroid center is the mean of its datapoints
-    #         centroids[centroidx] = np.mean(data[datax_sortx[_L:_R]], axis=0)
-    #         #centroids[centroidx] = np.array(np.round(centroids[centroidx]), dtype=np.uint8)
+    sums, counts = accumulate_centroid_sums(data, datax2_centroidx,
+                                            len(centroids))
+    # Inplace modification of centroids
+    centroids = _assign_centroid_means(centroids, sums, counts)
     return centroids
 
 
@@ -13,6 +13,10 @@ TEMP_VEC_DTYPE = np.float64
 
 TAU = 2 * np.pi  # References: tauday.com
 
+# Largest uint8 vector length whose squared distances are exact in float32
+# (2 * 255 ** 2 * dim < 2 ** 24)
+UINT8_FLOAT32_MAX_DIM = 129
+
 
 def testdata_hist():
     import vtool as vt
@@ -275,6 +279,125 @@ def L2_sqrd(hist1, hist2, dtype=TEMP_VEC_DTYPE):
     return ((np.asarray(hist1, dtype) - np.asarray(hist2, dtype)) ** 2).sum(-1)  # this is faster
 
 
+def knn_L2_sqrd(vecs1, vecs2, K, max_tile_bytes=2 ** 24):
+    r"""
+    Exact K nearest neighbors in vecs1 of each row of vecs2 under squared L2.
+
+    Distances are computed as |a|^2 + |b|^2 - 2ab over tiles of at most
+    max_tile_bytes, so memory is bounded independent of the number of
+    vectors, and the K best of each tile are found with a partial sort.
+    uint8 vectors (e.g. SIFT) with at most UINT8_FLOAT32_MAX_DIM dimensions
+    are multiplied as float32. This is exact because 2 * 255 ** 2 * dim stays
+    below 2 ** 24, so every partial sum is an exactly representable integer.
+    Other inputs use float64. Neighbors at equal distances are ordered by
+    index: when ties straddle the K-th place the lowest indices are kept.
+
+    Args:
+        vecs1 (ndarray): database vectors
+        vecs2 (ndarray): query vectors
+        K (int): number of neighbors (at most len(vecs1))
+        max_tile_bytes (int): memory bound of one distance tile
+
+    Returns:
+        tuple: (fx2_to_fx1, fx2_to_dist_sqrd) - int32 indices and squared
+            distances (float32 for uint8 input of at most
+            UINT8_FLOAT32_MAX_DIM dims) with shape (len(vecs2), K)
+
+    CommandLine:
+        python -m vtool.distance --test-knn_L2_sqrd
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from vtool.distance import *  # NOQA
+        >>> rng = np.random.RandomState(0)
+        >>> vecs1 = rng.randint(0, 255, (300, 128)).astype(np.uint8)
+        >>> vecs2 = rng.randint(0, 255, (200, 128)).astype(np.uint8)
+        >>> vecs1[7] = vecs1[3]  # a tie
+        >>> vecs2[0] = vecs1[3]
+        >>> fx2_to_fx1, fx2_to_dist_sqrd = knn_L2_sqrd(vecs1, vecs2, K=3,
+        >>>                                            max_tile_bytes=4096)
+        >>> dist_sqrd = L2_sqrd(vecs2[:, None, :], vecs1[None, :, :])
+        >>> sortx = dist_sqrd.argsort(axis=1, kind='mergesort')[:, 0:3]
+        >>> assert np.all(fx2_to_fx1 == sortx)
+        >>> assert np.all(fx2_to_dist_sqrd == np.sort(dist_sqrd, axis=1)[:, 0:3])
+        >>> print(fx2_to_fx1[0].tolist())
+        [3, 7, 135]
+        >>> # more ties than K inside one column tile keep the lowest indices
+        >>> vecs1[[20, 70]] = vecs1[3]
+        >>> fx2_to_fx1, _ = knn_L2_sqrd(vecs1, vecs2[0:1], K=2,
+        >>>                             max_tile_bytes=256)
+        >>> print(fx2_to_fx1[0].tolist())
+        [3, 7]
+        >>> # long uint8 vectors fall back to float64 and stay exact
+        >>> vecs1 = rng.randint(0, 255, (50, 300)).astype(np.uint8)
+        >>> vecs2 = np.full((4, 300), 255, dtype=np.uint8)
+        >>> fx2_to_fx1, fx2_to_dist_sqrd = knn_L2_sqrd(vecs1, vecs2, K=2)
+        >>> dist_sqrd = L2_sqrd(vecs2[:, None, :], vecs1[None, :, :])
+        >>> assert np.all(fx2_to_dist_sqrd == np.sort(dist_sqrd, axis=1)[:, 0:2])
+        >>> print(fx2_to_dist_sqrd.dtype)
+        float64
+    """
+    num1, num2 = len(vecs1), len(vecs2)
+    assert K <= num1, 'K=%r is larger than the number of vectors=%r' % (K, num1)
+    if vecs1.dtype == np.uint8 and vecs1.shape[1] <= UINT8_FLOAT32_MAX_DIM:
+        dtype = np.float32
+    else:
+        dtype = np.float64
+    vecs1_ = np.asarray(vecs1, dtype=dtype)
+    norms1 = (vecs1_ ** 2).sum(axis=1)
+    fx2_to_fx1 = np.empty((num2, K), dtype=np.int32)
+    fx2_to_dist_sqrd = np.empty((num2, K), dtype=dtype)
+    itemsize = np.dtype(dtype).itemsize
+    # Tile over columns (vecs1) only when one row of all of vecs1 is too big
+    cols_per_tile = max(K, min(num1, max_tile_bytes // itemsize))
+    rows_per_tile = max(1, max_tile_bytes // (itemsize * cols_per_tile))
+    for start2 in range(0, num2, rows_per_tile):
+        sl2 = slice(start2, start2 + rows_per_tile)
+        rows_ = np.asarray(vecs2[sl2], dtype=dtype)
+        norms2 = (rows_ ** 2).sum(axis=1)
+        best_idx = None
+        best_dist = None
+        for start1 in range(0, num1, cols_per_tile):
+            sl1 = slice(start1, start1 + cols_per_tile)
+            tile = rows_.dot(vecs1_[sl1].T)
+            tile *= -2
+            tile += norms2[:, None]
+            tile += norms1[None, sl1]
+            np.maximum(tile, 0, out=tile)
+            tile_idx = np.arange(sl1.start, min(sl1.stop, num1), dtype=np.int32)
+            if best_idx is not None:
+                # merge the running best with this tile. Earlier tiles have
+                # lower indices, so the columns stay in index order.
+                tile = np.hstack([best_dist, tile])
+                tile_idx = np.hstack([best_idx, np.tile(tile_idx, (len(tile), 1))])
+            else:
+                tile_idx = np.tile(tile_idx, (len(tile), 1))
+            if tile.shape[1] > K:
+                tile, tile_idx = _stable_smallest_k(tile, tile_idx, K)
+            best_dist, best_idx = tile, tile_idx
+        # order by distance. The stable sort keeps ties in index order.
+        rowxs = np.arange(len(best_dist))[:, None]
+        dist_order = best_dist.argsort(axis=1, kind='mergesort')
+        fx2_to_fx1[sl2] = best_idx[rowxs, dist_order]
+        fx2_to_dist_sqrd[sl2] = best_dist[rowxs, dist_order]
+    return fx2_to_fx1, fx2_to_dist_sqrd
+
+
+def _stable_smallest_k(dists, idxs, K):
+    """
+    Selects the K smallest entries of each row of dists (with more than K
+    columns). Ties at the K-th place are broken by column order and the
+    selected entries keep their column order.
+    """
+    kth_dist = np.partition(dists, K - 1, axis=1)[:, K - 1:K]
+    is_less = dists < kth_dist
+    is_tie = dists == kth_dist
+    num_missing = K - is_less.sum(axis=1)
+    is_kept = is_less | (is_tie & (is_tie.cumsum(axis=1) <= num_missing[:, None]))
+    return (dists[is_kept].reshape(len(dists), K),
+            idxs[is_kept].reshape(len(dists), K))
+
+
 def understanding_pseudomax_props(mode=2):
     """
     Function showing some properties of distances between normalized pseudomax vectors
@@ -10,6 +10,7 @@ TODO:
 from __future__ import absolute_import, division, print_function
 from six.moves import zip, range
 import six
+import numpy as np
 from PIL.ExifTags import TAGS, GPSTAGS
 import PIL.ExifTags  # NOQA
 from PIL import Image
@@ -175,6 +176,13 @@ def get_exist(data, key):
     return None
 
 
+def _rational_to_float(value):
+    """ Older Pillow gives (numer, denom) tuples, newer gives IFDRational """
+    if isinstance(value, tuple):
+        return float(value[0]) / float(value[1])
+    return float(value)
+
+
 def convert_degrees(value):
     """
     Helper function to convert the GPS coordinates stored in the EXIF to degress in float format
@@ -182,17 +190,9 @@ def convert_degrees(value):
     References:
         http://en.wikipedia.org/wiki/Geographic_coordinate_conversion
     """
-    d0 = value[0][0]
-    d1 = value[0][1]
-    d = float(d0) / float(d1)
-
-    m0 = value[1][0]
-    m1 = value[1][1]
-    m = float(m0) / float(m1)
-
-    s0 = value[2][0]
-    s1 = value[2][1]
-    s = float(s0) / float(s1)
+    d = _rational_to_float(value[0])
+    m = _rational_to_float(value[1])
+    s = _rational_to_float(value[2])
 
     degrees_float = d + (m / 60.0) + (s / 3600.0)
     return degrees_float
@@ -415,6 +415,129 @@ def parse_exif_unixtime(image_fpath):
     return unixtime
 
 
+# Columns returned by read_image_metadata_list. Invalid values are -1 (or 0
+# for an unknown orientation) to agree with get_lat_lon and get_unixtime.
+IMAGE_METADATA_DTYPE = np.dtype([
+    ('width', np.int32),
+    ('height', np.int32),
+    ('orient', np.int16),
+    ('lat', np.float64),
+    ('lon', np.float64),
+    ('unixtime', np.float64),
+    ('valid', np.bool_),
+])
+
+
+def read_image_metadata(image_fpath):
+    r"""
+    Reads the size, orientation, gps, and time of an image in one pass.
+
+    Only the file header and the EXIF segment are parsed; PIL does not decode
+    pixel data until it is accessed, and the file handle is closed before
+    returning.
+
+    Args:
+        image_fpath (str):
+
+    Returns:
+        tuple: (width, height, orient, lat, lon, unixtime, valid) in the
+            order of IMAGE_METADATA_DTYPE. If the file cannot be read valid
+            is False and the other fields are their invalid values. Malformed
+            gps or time tags only invalidate those fields.
+
+    CommandLine:
+        python -m vtool.exif --test-read_image_metadata
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from vtool.exif import *  # NOQA
+        >>> image_fpath = ut.grab_file_url('http://images.summitpost.org/original/769474.JPG')
+        >>> width, height, orient, lat, lon, unixtime, valid = read_image_metadata(image_fpath)
+        >>> print('size = %r' % ((width, height),))
+        >>> print(np.array_str(np.array((lat, lon)), precision=3))
+        >>> print('unixtime = %r' % (unixtime,))
+        size = (3648, 2736)
+        [ 41.89   12.486]
+        unixtime = 1325351249
+    """
+    # Any error reading one file (PIL and get_exif_dict raise many types)
+    # invalidates only that file
+    try:
+        with Image.open(image_fpath) as pil_img:
+            width, height = pil_img.size
+            exif_dict = get_exif_dict(pil_img)
+        orient = exif_dict.get(ORIENTATION_CODE, 0)
+        if orient not in ORIENTATION_DICT:
+            orient = 0
+    except Exception:
+        return (-1, -1, 0, -1.0, -1.0, -1.0, False)
+    try:
+        lat, lon = get_lat_lon(exif_dict)
+    except Exception:
+        # e.g. ZeroDivisionError from a rational with a zero denominator
+        lat, lon = -1.0, -1.0
+    try:
+        unixtime = get_unixtime(exif_dict)
+    except Exception:
+        unixtime = -1
+    if unixtime is None:
+        unixtime = -1
+    return (width, height, orient, lat, lon, unixtime, True)
+
+
+def read_image_metadata_list(gpath_list, num_threads=None):
+    r"""
+    Bulk version of read_image_metadata that probes files on a thread pool.
+
+    Args:
+        gpath_list (list): image file paths
+        num_threads (int): defaults to the number of cpus
+
+    Returns:
+        ndarray: structured array with dtype IMAGE_METADATA_DTYPE and one row
+            per path
+
+    CommandLine:
+        python -m vtool.exif --test-read_image_metadata_list
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from vtool.exif import *  # NOQA
+        >>> dpath = ut.ensure_app_resource_dir('vtool', 'tests')
+        >>> corrupt_fpath = ut.unixjoin(dpath, 'corrupt_exif.jpg')
+        >>> ut.write_to(corrupt_fpath, b'\xff\xd8\xff\xe1garbage', mode='wb')
+        >>> gpath_list = [ut.grab_test_imgpath('carl.jpg'),
+        >>>               ut.grab_test_imgpath('lena.png'),
+        >>>               'does/not/exist.jpg', corrupt_fpath]
+        >>> meta = read_image_metadata_list(gpath_list, num_threads=2)
+        >>> assert meta.dtype == IMAGE_METADATA_DTYPE
+        >>> result = ut.repr2(meta['valid'].tolist())
+        >>> print(result)
+        >>> assert meta['width'][1] == 512 and meta['height'][1] == 512
+        [True, True, False, False]
+    """
+    gpath_list = list(gpath_list)
+    meta = np.empty(len(gpath_list), dtype=IMAGE_METADATA_DTYPE)
+    if len(gpath_list) == 0:
+        return meta
+    if num_threads is None:
+        import multiprocessing
+        num_threads = multiprocessing.cpu_count()
+    num_threads = min(num_threads, len(gpath_list))
+    if num_threads <= 1:
+        meta[:] = [read_image_metadata(gpath) for gpath in gpath_list]
+    else:
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(num_threads)
+        try:
+            chunksize = max(1, len(gpath_list) // (4 * num_threads))
+            meta[:] = pool.map(read_image_metadata, gpath_list, chunksize)
+        finally:
+            pool.terminate()
+            pool.join()
+    return meta
+
+
 if __name__ == '__main__':
     """
     CommandLine:
@@ -1,10 +1,21 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, print_function, division
+import os
+import hashlib
 import utool as ut
 import six
+import numpy as np
+from os.path import exists, join
 (print, rrr, profile) = ut.inject2(__name__, '[feat]')
 
 
+# Bump to invalidate every entry of the on-disk feature cache
+FEAT_CACHE_VERSION = 1
+# The on-disk feature cache is opt-in. It is never evicted and cached
+# features are returned as read-only memmaps.
+USE_FEAT_CACHE = ut.get_argflag('--cache-feats')
+
+
 def extract_feature_from_patch(patch):
     import pyhesaff
     import numpy as np
@@ -82,6 +93,167 @@ def extract_features(img_or_fpath, feat_type='hesaff+sift', **kwargs):
     return (kpts, vecs)
 
 
+def get_feat_cache_dpath(appname='vtool'):
+    """ Default directory of the on-disk feature cache """
+    return ut.ensure_app_resource_dir(appname, 'feat_cache')
+
+
+def get_content_hash(img_or_fpath, blocksize=2 ** 20):
+    r"""
+    Hashes the bytes of an image file (without decoding it) or the pixels,
+    shape, and dtype of an image array.
+
+    Returns:
+        str: sha1 hexdigest
+
+    CommandLine:
+        python -m vtool.features --test-get_content_hash
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from vtool.features import *  # NOQA
+        >>> img = np.zeros((2, 3), dtype=np.uint8)
+        >>> hash1 = get_content_hash(img)
+        >>> hash2 = get_content_hash(img.reshape(3, 2))
+        >>> assert hash1 != hash2
+        >>> result = ut.repr2(hash1 == get_content_hash(img.copy()))
+        >>> print(result)
+        True
+    """
+    hasher = hashlib.sha1()
+    if isinstance(img_or_fpath, six.string_types):
+        with open(img_or_fpath, 'rb') as file_:
+            for block in iter(lambda: file_.read(blocksize), b''):
+                hasher.update(block)
+    else:
+        img = np.ascontiguousarray(img_or_fpath)
+        hasher.update(repr((img.shape, img.dtype.str)).encode('utf8'))
+        hasher.update(img.tobytes())
+    return hasher.hexdigest()
+
+
+def get_feat_cfgstr(feat_type='hesaff+sift', **kwargs):
+    r"""
+    Hashes the parameters of extract_features. The pyhesaff version and
+    FEAT_CACHE_VERSION are included so cached features are recomputed when
+    the detector changes.
+
+    Returns:
+        str: feat_cfgstr
+    """
+    try:
+        import pyhesaff
+        hesaff_version = getattr(pyhesaff, '__version__', None)
+    except ImportError:
+        hesaff_version = None
+    cfg_items = sorted(kwargs.items()) + [
+        ('feat_type', feat_type),
+        ('hesaff_version', hesaff_version),
+        ('cache_version', FEAT_CACHE_VERSION),
+    ]
+    feat_cfgstr = hashlib.sha1(repr(cfg_items).encode('utf8')).hexdigest()[0:16]
+    return feat_cfgstr
+
+
+def _feat_cache_fpaths(content_hash, feat_cfgstr, cache_dpath):
+    prefix = join(cache_dpath, content_hash + '_' + feat_cfgstr)
+    kpts_fpath = prefix + '_kpts.npy'
+    vecs_fpath = prefix + '_vecs.npy'
+    return kpts_fpath, vecs_fpath
+
+
+def load_cached_features(content_hash, feat_cfgstr, cache_dpath=None,
+                         mmap_mode='r'):
+    r"""
+    Returns:
+        tuple: (kpts, vecs) memory mapped from the feature cache, or None if
+            they have not been cached. Processes mapping the same entry share
+            its pages through the OS cache.
+    """
+    if cache_dpath is None:
+        cache_dpath = get_feat_cache_dpath()
+    kpts_fpath, vecs_fpath = _feat_cache_fpaths(content_hash, feat_cfgstr,
+                                                cache_dpath)
+    # vecs are written before kpts, so kpts marks a complete entry
+    if not exists(kpts_fpath):
+        return None
+    try:
+        kpts = np.load(kpts_fpath, mmap_mode=mmap_mode)
+        vecs = np.load(vecs_fpath, mmap_mode=mmap_mode)
+    except ValueError:
+        # older numpy cannot memory map arrays without any data
+        kpts = np.load(kpts_fpath)
+        vecs = np.load(vecs_fpath)
+    return kpts, vecs
+
+
+def save_cached_features(content_hash, feat_cfgstr, kpts, vecs,
+                         cache_dpath=None):
+    r"""
+    Writes kpts and vecs into the feature cache as .npy files.
+
+    Each file is written under a temporary name and renamed into place, so
+    concurrent workers never load a partially written entry.
+    """
+    if cache_dpath is None:
+        cache_dpath = get_feat_cache_dpath()
+    ut.ensuredir(cache_dpath)
+    kpts_fpath, vecs_fpath = _feat_cache_fpaths(content_hash, feat_cfgstr,
+                                                cache_dpath)
+    for fpath, arr in [(vecs_fpath, vecs), (kpts_fpath, kpts)]:
+        tmp_fpath = fpath + '.%d.tmp' % (os.getpid(),)
+        with open(tmp_fpath, 'wb') as file_:
+            np.save(file_, np.ascontiguousarray(arr))
+        if ut.WIN32 and exists(fpath):
+            # another worker already wrote the same content
+            os.remove(tmp_fpath)
+        else:
+            os.rename(tmp_fpath, fpath)
+
+
+def extract_features_cached(img_or_fpath, feat_type='hesaff+sift',
+                            cache_dpath=None, mmap_mode='r', **kwargs):
+    r"""
+    extract_features backed by a content-addressed on-disk cache. Entries are
+    keyed on the image content (see get_content_hash) and the feature
+    parameters (see get_feat_cfgstr).
+
+    Args:
+        img_or_fpath (str or ndarray): image or image file path
+        cache_dpath (str): defaults to get_feat_cache_dpath()
+        mmap_mode (str): how cached features are loaded (see np.load)
+
+    Returns:
+        tuple : (kpts, vecs)
+
+    CommandLine:
+        python -m vtool.features --test-extract_features_cached
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from vtool.features import *  # NOQA
+        >>> img_fpath = ut.grab_test_imgpath('easy1.png')
+        >>> cache_dpath = ut.ensure_app_resource_dir('vtool', 'test_feat_cache')
+        >>> ut.delete(cache_dpath)
+        >>> ut.ensuredir(cache_dpath)
+        >>> kpts1, vecs1 = extract_features_cached(img_fpath, cache_dpath=cache_dpath)
+        >>> kpts2, vecs2 = extract_features_cached(img_fpath, cache_dpath=cache_dpath)
+        >>> assert isinstance(kpts2, np.memmap)
+        >>> assert np.all(kpts1 == kpts2) and np.all(vecs1 == vecs2)
+    """
+    if cache_dpath is None:
+        cache_dpath = get_feat_cache_dpath()
+    content_hash = get_content_hash(img_or_fpath)
+    feat_cfgstr = get_feat_cfgstr(feat_type, **kwargs)
+    feats = load_cached_features(content_hash, feat_cfgstr, cache_dpath,
+                                 mmap_mode)
+    if feats is None:
+        feats = extract_features(img_or_fpath, feat_type, **kwargs)
+        save_cached_features(content_hash, feat_cfgstr, feats[0], feats[1],
+                             cache_dpath)
+    return feats
+
+
 def get_extract_features_default_params():
     r"""
     Returns:
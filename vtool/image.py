@@ -60,6 +60,21 @@ try:
 except AttributeError:
     LINE_AA = cv2.CV_AA
 
+try:
+    # Flags that let libjpeg decode directly at 1/2, 1/4, or 1/8 scale
+    IMREAD_REDUCED_FLAGS = {
+        (2, False): cv2.IMREAD_REDUCED_COLOR_2,
+        (4, False): cv2.IMREAD_REDUCED_COLOR_4,
+        (8, False): cv2.IMREAD_REDUCED_COLOR_8,
+        (2, True): cv2.IMREAD_REDUCED_GRAYSCALE_2,
+        (4, True): cv2.IMREAD_REDUCED_GRAYSCALE_4,
+        (8, True): cv2.IMREAD_REDUCED_GRAYSCALE_8,
+    }
+except AttributeError:
+    IMREAD_REDUCED_FLAGS = {}
+
+JPEG_EXTENSIONS = ['.jpg', '.jpeg', '.jpe']
+
 #cv2.BORDER_CONSTANT     cv2.BORDER_REFLECT      cv2.BORDER_REPLICATE
 #cv2.BORDER_DEFAULT      cv2.BORDER_REFLECT101   cv2.BORDER_TRANSPARENT
 #cv2.BORDER_ISOLATED     cv2.BORDER_REFLECT_101  cv2.BORDER_WRAP
@@ -242,7 +257,7 @@ def montage(img_list, dsize, rng=np.random, method='random', return_debug=False)
 
 
 def imread(img_fpath, grayscale=False, orient=False, flags=None,
-           force_pil=None, delete_if_corrupted=False):
+           force_pil=None, delete_if_corrupted=False, max_dsize=None):
     r"""
     Wrapper around the opencv imread function. Handles remote uris.
 
@@ -253,6 +268,13 @@ def imread(img_fpath, grayscale=False, orient=False, flags=None,
         flags (None): opencv flags (default = None)
         force_pil (bool): (default = None)
         delete_if_corrupted (bool): (default = False)
+        max_dsize (tuple): if specified, images larger than this (w, h) are
+            shrunk to fit as in :func:`resize_to_maxdims`. Local JPEGs are
+            decoded directly at 1/2, 1/4, or 1/8 resolution before the final
+            resize, which is much faster and uses less memory than a full
+            decode. Smaller images are never enlarged. The final size is
+            taken in the orientation the image was decoded in, so EXIF
+            rotated images are not squashed. (default = None)
 
     Returns:
         ndarray: imgBGR
@@ -320,6 +342,35 @@ def imread(img_fpath, grayscale=False, orient=False, flags=None,
         >>> import plottool as pt
         >>> pt.imshow(imgBGR)
         >>> ut.show_if_requested()
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from vtool.image import *  # NOQA
+        >>> img_fpath = ut.grab_test_imgpath('carl.jpg')
+        >>> max_dsize = (64, 64)
+        >>> imgBGR1 = resize_to_maxdims(imread(img_fpath), max_dsize,
+        >>>                             interpolation='area')
+        >>> imgBGR2 = imread(img_fpath, max_dsize=max_dsize)
+        >>> imgBGR3 = imread(img_fpath, max_dsize=max_dsize, force_pil=True)
+        >>> imgBGR4 = imread(img_fpath, max_dsize=(5000, 5000), grayscale=True)
+        >>> assert imgBGR1.shape == imgBGR2.shape == imgBGR3.shape
+        >>> assert imgBGR4.shape == imread(img_fpath, grayscale=True).shape
+        >>> # The reduced decode is close to shrinking the full image
+        >>> diff = np.abs(imgBGR1.astype(np.float32) - imgBGR2).mean()
+        >>> assert diff < 10, diff
+        >>> # A 600x300 JPEG that EXIF rotates by 90 degrees
+        >>> from PIL import Image
+        >>> dpath = ut.ensure_app_resource_dir('vtool', 'tests')
+        >>> rot_fpath = ut.unixjoin(dpath, 'exif_orient6.jpg')
+        >>> exif_ = Image.Exif()
+        >>> exif_[0x0112] = 6
+        >>> Image.new('RGB', (600, 300)).save(rot_fpath, exif=exif_.tobytes())
+        >>> imgBGR5 = imread(rot_fpath, max_dsize=(100, 100))
+        >>> imgBGR6 = imread(rot_fpath, max_dsize=(100, 100), orient='auto')
+        >>> full6 = imread(rot_fpath, orient='auto')
+        >>> assert imgBGR6.shape == resize_to_maxdims(full6, (100, 100)).shape
+        >>> print(imgBGR5.shape)
+        (100, 50, 3)
     """
     path, ext = splitext(img_fpath)
     orient_ = 'auto' if orient in ['auto', 'on', True] else False
@@ -329,6 +380,10 @@ def imread(img_fpath, grayscale=False, orient=False, flags=None,
     elif img_fpath.startswith('s3://'):
         imgBGR = imread_remote_s3(img_fpath, grayscale=grayscale, orient=orient, use_pil=use_pil, flags=flags)
     else:
+        img_size, dsize, reduce_factor = None, None, 1
+        if max_dsize is not None:
+            img_size, dsize, reduce_factor = _reduced_decode_plan(img_fpath,
+                                                                  max_dsize)
         try:
             if use_pil:
                 # If we want to open with auto orient, only open once with PIL
@@ -337,6 +392,9 @@ def imread(img_fpath, grayscale=False, orient=False, flags=None,
                 #pil_img = Image.open(img_fpath)
                 #print("USE PIL")
                 with Image.open(img_fpath) as pil_img:
+                    if dsize is not None:
+                        # Lets the JPEG decoder skip unneeded DCT coefficients
+                        pil_img.draft('RGB', dsize)
                     imgBGR = _fix_orient_pil_img(pil_img, grayscale=grayscale,
                                                  orient=orient_)
                 #with Image.open(img_fpath) as pil_img: # breaks?
@@ -345,6 +403,9 @@ def imread(img_fpath, grayscale=False, orient=False, flags=None,
                 #print("USE OPENCV")
                 if flags is None:
                     flags = cv2.IMREAD_GRAYSCALE if grayscale else IMREAD_COLOR
+                    if ext.lower() in JPEG_EXTENSIONS:
+                        flags = IMREAD_REDUCED_FLAGS.get(
+                            (reduce_factor, bool(grayscale)), flags)
                 # TODO cv2.IMREAD_UNCHANGED
                 imgBGR = cv2.imread(img_fpath, flags=flags)
 
@@ -384,9 +445,78 @@ def imread(img_fpath, grayscale=False, orient=False, flags=None,
         if not isinstance(orient, bool) and orient in exif.ORIENTATION_DICT:
             print('[vt.imread] Applying orientation %r' % (orient, ))
             imgBGR = _fix_orientation(imgBGR, orient)
+        if dsize is not None:
+            # The decoder may have applied the EXIF orientation, so the final
+            # size is computed in the orientation of the decoded image
+            full_size = _decoded_full_size(get_size(imgBGR), img_size)
+            dsize = resized_dims_and_ratio(full_size, max_dsize)[0]
+            if get_size(imgBGR) != dsize:
+                imgBGR = cv2.resize(imgBGR, dsize, interpolation=cv2.INTER_AREA)
     return imgBGR
 
 
+def _reduced_decode_plan(img_fpath, max_dsize):
+    """
+    Reads only the image header to determine the final size of an image read
+    with ``max_dsize`` and the largest power of two the decoder can shrink by
+    without dropping below that size. Sizes are in the stored (not EXIF
+    rotated) orientation, see _decoded_full_size.
+
+    Returns:
+        tuple: (img_size, dsize, reduce_factor) - dsize is None if no
+            shrinking is needed
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from vtool.image import *  # NOQA
+        >>> from vtool.image import _reduced_decode_plan
+        >>> img_fpath = ut.grab_test_imgpath('carl.jpg')
+        >>> img_size = open_image_size(img_fpath)
+        >>> max_dsize = (img_size[0] // 5, None)
+        >>> (img_size_, dsize, reduce_factor) = _reduced_decode_plan(img_fpath, max_dsize)
+        >>> assert reduce_factor == 4 and img_size_ == img_size
+        >>> assert dsize == resized_dims_and_ratio(img_size, max_dsize)[0]
+        >>> assert _reduced_decode_plan(img_fpath, img_size) == (None, None, 1)
+    """
+    try:
+        with Image.open(img_fpath) as pil_img:
+            img_size = pil_img.size
+    except Exception:
+        # Let the full read report the error
+        return None, None, 1
+    dsize, ratio = resized_dims_and_ratio(img_size, max_dsize)
+    if ratio >= 1.0:
+        return None, None, 1
+    reduce_factor = 1
+    for factor in [2, 4, 8]:
+        if factor * ratio <= 1.0:
+            reduce_factor = factor
+    return img_size, dsize, reduce_factor
+
+
+def _decoded_full_size(decoded_size, img_size):
+    """
+    Returns the stored image size (w, h) transposed if the decoded (possibly
+    reduced) image was rotated by 90 degrees, i.e. its aspect ratio is closer
+    to (h, w) than to (w, h).
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from vtool.image import *  # NOQA
+        >>> from vtool.image import _decoded_full_size
+        >>> result = ut.repr2([_decoded_full_size((75, 150), (600, 300)),
+        >>>                    _decoded_full_size((150, 75), (600, 300))])
+        >>> print(result)
+        [(300, 600), (600, 300)]
+    """
+    (w, h), (W, H) = decoded_size, img_size
+    aspect_err = abs(np.log((w * H) / (h * W)))
+    transposed_err = abs(np.log((w * W) / (h * H)))
+    if transposed_err < aspect_err:
+        return (H, W)
+    return img_size
+
+
 def imread_remote_s3(img_fpath, **kwargs):
     import io
     try:
@@ -438,6 +568,147 @@ def _imread_bytesio(image_stream, use_pil=False, flags=None, **kwargs):
     return imgBGR
 
 
+def _imread_many_worker(gpath, kwargs):
+    """ reads a single image, returning the exception instead of raising """
+    try:
+        return imread(gpath, **kwargs), None
+    except Exception as ex:
+        return None, ex
+
+
+def _bounded_pool_imap(func, num_tasks, num_threads=None, prefetch=None,
+                       ordered=True):
+    """
+    Calls func(taskx) for each taskx in range(num_tasks) on a thread pool and
+    yields (taskx, result).
+
+    At most ``prefetch`` tasks are running or waiting to be consumed at any
+    time, including the one currently yielded. An exception raised by func
+    is re-raised in the consuming thread. Shared by :func:`imread_many` and
+    :func:`vtool.chip.generate_chips`.
+
+    Args:
+        func (func): called with the task index
+        num_tasks (int): number of tasks
+        num_threads (int): defaults to the number of cpus. If 1 tasks are run
+            serially in the calling thread.
+        prefetch (int): window size (default = 2 * num_threads)
+        ordered (bool): if True results are yielded in task order, otherwise
+            in the order they finish. (default = True)
+    """
+    import collections
+    import sys
+    from six.moves import queue
+    if num_threads is None:
+        import multiprocessing
+        num_threads = multiprocessing.cpu_count()
+    num_threads = max(1, min(num_threads, num_tasks))
+    if prefetch is None:
+        prefetch = 2 * num_threads
+    prefetch = max(prefetch, num_threads)
+    if num_threads == 1:
+        for taskx in range(num_tasks):
+            yield taskx, func(taskx)
+        return
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(num_threads)
+    try:
+        next_taskx = 0
+        if ordered:
+            # Results are consumed in submission order from a fixed window
+            pending = collections.deque()
+            for taskx in range(num_tasks):
+                # The result being yielded counts against the window
+                while next_taskx < num_tasks and len(pending) < prefetch:
+                    pending.append(pool.apply_async(func, (next_taskx,)))
+                    next_taskx += 1
+                yield taskx, pending.popleft().get()
+        else:
+            # Tasks push (taskx, result, exc_info) as soon as they finish
+            done_queue = queue.Queue()
+
+            def _task(taskx):
+                # Always report back, or the consumer would wait forever
+                try:
+                    done_queue.put((taskx, func(taskx), None))
+                except Exception:
+                    done_queue.put((taskx, None, sys.exc_info()))
+
+            num_pending = 0
+            for _ in range(num_tasks):
+                while next_taskx < num_tasks and num_pending < prefetch:
+                    pool.apply_async(_task, (next_taskx,))
+                    next_taskx += 1
+                    num_pending += 1
+                taskx, result, exc_info = done_queue.get()
+                num_pending -= 1
+                if exc_info is not None:
+                    six.reraise(*exc_info)
+                yield taskx, result
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def imread_many(gpath_list, num_threads=None, ordered=True, prefetch=None,
+                **kwargs):
+    r"""
+    Decodes many images on a thread pool and yields them as they are ready.
+
+    OpenCV and PIL release the GIL while decoding, so threads overlap both
+    the disk I/O and the decode of neighboring files. At most ``prefetch``
+    images are in flight (decoded but not yet consumed) at any time, which
+    bounds memory when iterating over very large collections. A file that
+    cannot be read does not stop the batch; its exception is returned in
+    place of the image.
+
+    Args:
+        gpath_list (list): image file paths
+        num_threads (int): number of decode threads. Defaults to the number
+            of cpus. If 1 images are read serially in the calling thread.
+        ordered (bool): if True results are yielded in the order of
+            gpath_list, otherwise in the order they finish. (default = True)
+        prefetch (int): maximum number of pending reads.
+            (default = 2 * num_threads)
+        **kwargs: passed to :func:`imread`
+
+    Yields:
+        tuple: (gx, imgBGR, ex) - the index into gpath_list, the image (or
+            None if it failed), and the exception raised while reading (or
+            None if it succeeded).
+
+    CommandLine:
+        python -m vtool.image --test-imread_many
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from vtool.image import *  # NOQA
+        >>> img_fpath = ut.grab_test_imgpath('lena.png')
+        >>> gpath_list = [img_fpath, 'does/not/exist.png', img_fpath] * 3
+        >>> result_list = list(imread_many(gpath_list, num_threads=2, prefetch=3))
+        >>> gx_list = [gx for gx, img, ex in result_list]
+        >>> failed = [gx for gx, img, ex in result_list if ex is not None]
+        >>> shapes = set([img.shape for gx, img, ex in result_list if ex is None])
+        >>> print('gx_list = %r' % (gx_list,))
+        >>> print('failed = %r' % (failed,))
+        >>> print('shapes = %r' % (shapes,))
+        >>> unordered = list(imread_many(gpath_list, ordered=False, grayscale=True))
+        >>> assert sorted([gx for gx, img, ex in unordered]) == gx_list
+        >>> assert [img.ndim for gx, img, ex in unordered if ex is None] == [2] * 6
+        gx_list = [0, 1, 2, 3, 4, 5, 6, 7, 8]
+        failed = [1, 4, 7]
+        shapes = {(512, 512, 3)}
+    """
+    gpath_list = list(gpath_list)
+
+    def _read(gx):
+        return _imread_many_worker(gpath_list[gx], kwargs)
+    for gx, (imgBGR, ex) in _bounded_pool_imap(_read, len(gpath_list),
+                                               num_threads, prefetch,
+                                               ordered):
+        yield gx, imgBGR, ex
+
+
 def _fix_orient_pil_img(pil_img, grayscale=False, orient=False):
     if orient == 'auto':
         exif_dict = exif.get_exif_dict(pil_img)
@@ -647,8 +918,8 @@ def open_image_size(image_fpath):
         assert t3 < t4
     """
     try:
-        pil_img = Image.open(image_fpath)
-        size = pil_img.size
+        with Image.open(image_fpath) as pil_img:
+            size = pil_img.size
     except IOError as ex:
         print('ERROR: Failed open image size')
         ut.checkpath(image_fpath, verbose=True)
@@ -657,9 +928,16 @@ def open_image_size(image_fpath):
     return size
 
 
-def get_gpathlist_sizes(gpath_list):
-    """ reads the size of each image in gpath_list """
-    gsize_list = [open_image_size(gpath) for gpath in gpath_list]
+def get_gpathlist_sizes(gpath_list, num_threads=None):
+    """ reads the size of each image in gpath_list from the file headers """
+    meta = exif.read_image_metadata_list(gpath_list, num_threads=num_threads)
+    if not np.all(meta['valid']):
+        invalid_gpaths = ut.compress(gpath_list, ~meta['valid'])
+        for gpath in invalid_gpaths:
+            ut.checkpath(gpath, verbose=True)
+        raise IOError('Failed open image size of %d images. First is %s' % (
+            len(invalid_gpaths), invalid_gpaths[0]))
+    gsize_list = list(zip(meta['width'].tolist(), meta['height'].tolist()))
     return gsize_list
 
 
@@ -1643,7 +1921,7 @@ def resize_worker(tup):
     #print('[preproc] writing thumbnail: %r' % new_gfpath)
     #if not exists(new_gfpath):
     #    return new_gfpath
-    img = imread(gfpath)
+    img = imread(gfpath, max_dsize=new_size)
     new_img = resize(img, new_size)
     imwrite(new_gfpath, new_img)
     return new_gfpath
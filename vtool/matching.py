@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, division, print_function
 import utool as ut
+import multiprocessing
 import numpy as np
 from collections import namedtuple
 (print, rrr, profile) = ut.inject2(__name__)
@@ -16,6 +17,11 @@ PSEUDO_MAX_DIST_SQRD = 2 * (PSEUDO_MAX_VEC_COMPONENT ** 2)
 PSEUDO_MAX_DIST = np.sqrt(2) * (PSEUDO_MAX_VEC_COMPONENT)
 
 
+# Exact nearest neighbors are used (nn_backend='auto') when the number of
+# descriptor pairs is at most this (e.g. two chips with 2k features)
+EXACT_NN_MAX_PAIRS = 2000 * 2000
+
+
 class MatchingError(Exception):
     pass
 
@@ -27,11 +33,13 @@ VSONE_DEFAULT_CONFIG = [
     ut.ParamInfo('symmetric', False),
     ut.ParamInfo('K', 1, min_=1),
     ut.ParamInfo('Knorm', 1, min_=1),
-    ut.ParamInfo('sv_on', True)
+    ut.ParamInfo('sv_on', True),
+    ut.ParamInfo('nn_backend', 'auto', valid_values=['auto', 'exact', 'flann']),
 
     #ut.ParamInfo('affine_invariance', True),
     #ut.ParamInfo('rotation_invariance', False),
 ]
+VSONE_PARAM_KEYS = [pi.varname for pi in VSONE_DEFAULT_CONFIG]
 
 
 @ut.reloadable_class
@@ -123,13 +131,22 @@ class PairwiseMatch(ut.NiceRepr):
             verbose = True
 
         num_neighbors = K + Knorm
+        nn_backend = choose_nn_backend(len(annot1['vecs']),
+                                       len(annot2['vecs']),
+                                       cfgdict.get('nn_backend', 'auto'))
 
         # Search for nearest neighbors
-        fx2_to_fx1, fx2_to_dist = normalized_nearest_neighbors(
-            annot1['flann'], annot2['vecs'], num_neighbors, checks)
+        if nn_backend == 'exact':
+            fx2_to_fx1, fx2_to_dist = exact_normalized_nearest_neighbors(
+                annot1['vecs'], annot2['vecs'], num_neighbors)
+        else:
+            fx2_to_fx1, fx2_to_dist = normalized_nearest_neighbors(
+                annot1['flann'], annot2['vecs'], num_neighbors, checks)
         if symmetric:
-            fx1_to_fx2, fx1_to_dist = normalized_nearest_neighbors(
-                annot2['flann'], annot1['vecs'], num_neighbors, checks)
+            # annot2's index is built lazily (once) only for the flann backend
+            flann2 = annot2['flann'] if nn_backend == 'flann' else None
+            fx1_to_fx2 = reverse_candidate_neighbors(
+                fx2_to_fx1, K, annot1['vecs'], annot2['vecs'], flann2, checks)
             valid_flags = flag_symmetric_matches(fx2_to_fx1, fx1_to_fx2, K)
         else:
             valid_flags = np.ones((len(fx2_to_fx1), K), dtype=np.bool)
@@ -209,6 +226,10 @@ class PairwiseMatch(ut.NiceRepr):
         match_.H_12 = H_12
         return match_
 
+    def to_table(match):
+        """ Returns the current matches as a compact MatchTable """
+        return MatchTable.from_pairwise(match)
+
     def show(match, ax=None, show_homog=False):
         import plottool as pt
         annot1 = match.annot1
@@ -227,6 +248,10 @@ class PairwiseMatch(ut.NiceRepr):
         return ax, xywh1, xywh2
 
     def make_pairwise_constlen_feature(match, main_key):
+        """
+        SeeAlso:
+            make_pairwise_constlen_features - faster for many matches
+        """
         main_key = 'ratio'
         import pandas as pd
         local_feats = pd.DataFrame(match.measures)
@@ -262,6 +287,354 @@ class PairwiseMatch(ut.NiceRepr):
         return feat
 
 
+def make_pairwise_constlen_features(match_list, main_key='ratio', ntop=10):
+    r"""
+    Batch version of PairwiseMatch.make_pairwise_constlen_feature. Builds the
+    features of all matches as one dense float32 matrix using segmented
+    numpy reductions over the concatenated measures of every match.
+
+    Matches are ranked within each pair by descending main_key. Pairs with
+    fewer than ntop matches have nan in the missing top-n columns, and std is
+    nan for pairs with fewer than two matches (like pandas).
+
+    Args:
+        match_list (list): PairwiseMatch objects with the same measure keys
+        main_key (str): measure used to rank the top-n matches
+        ntop (int): number of top matches whose measures are features
+
+    Returns:
+        tuple: (X, header) - (len(match_list), len(header)) float32 feature
+            matrix and the column names in the order of
+            make_pairwise_constlen_feature
+
+    CommandLine:
+        python -m vtool.matching --test-make_pairwise_constlen_features
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from vtool.matching import *  # NOQA
+        >>> rng = np.random.RandomState(0)
+        >>> match_list = []
+        >>> for num in [0, 1, 3, 12]:
+        >>>     match = PairwiseMatch()
+        >>>     match.measures = ut.odict([('match_dist', rng.rand(num)),
+        >>>                                ('ratio', rng.rand(num))])
+        >>>     match.global_measures = {'yaw': (rng.rand(), rng.rand())}
+        >>>     match_list.append(match)
+        >>> X, header = make_pairwise_constlen_features(match_list, ntop=2)
+        >>> # top ratios of the last pair
+        >>> assert np.allclose(X[3, 4:6], np.sort(match_list[3].measures['ratio'])[::-1][0:2])
+        >>> assert np.allclose(X[2, 11], np.std(match_list[2].measures['ratio'], ddof=1))
+        >>> assert np.all(np.isnan(X[0, 2:6])) and X[0, 6] == 0
+        >>> result = ut.repr2((header, X.shape), nl=1)
+        >>> print(result)
+        (
+            ['yaw_1', 'yaw_2', 'match_dist0', 'match_dist1', 'ratio0', 'ratio1', 'sum_match_dist', 'sum_ratio', 'mean_match_dist', 'mean_ratio', 'std_match_dist', 'std_ratio', 'n_total'],
+            (4, 13),
+        )
+    """
+    num_pairs = len(match_list)
+    if num_pairs == 0:
+        return np.empty((0, 0), dtype=np.float32), []
+    measure_keys = list(match_list[0].measures.keys())
+    lens = np.array([len(match.measures[main_key]) for match in match_list],
+                    dtype=np.int64)
+    offsets = np.hstack([[0], np.cumsum(lens)[:-1]])
+    segids = np.repeat(np.arange(num_pairs), lens)
+    nonempty = lens > 0
+    measure_cols = {
+        key: np.hstack([np.asarray(match.measures[key], dtype=np.float64)
+                        for match in match_list]) if lens.sum() > 0 else
+        np.empty(0)
+        for key in measure_keys
+    }
+
+    header = []
+    col_list = []
+
+    # Global measures of both annotations
+    global_measures = match_list[0].global_measures
+    if global_measures:
+        for key in global_measures.keys():
+            v1s = np.array([match.global_measures[key][0] for match in match_list],
+                           dtype=np.float64)
+            v2s = np.array([match.global_measures[key][1] for match in match_list],
+                           dtype=np.float64)
+            if v1s.ndim > 1:
+                for i in range(v1s.shape[1]):
+                    header.extend([key + str(i) + '_1', key + str(i) + '_2'])
+                    col_list.extend([v1s[:, i], v2s[:, i]])
+            else:
+                header.extend([key + '_1', key + '_2'])
+                col_list.extend([v1s, v2s])
+
+    # Rank within each pair by descending main_key (ties by descending index)
+    ranks = np.arange(len(segids)) - np.repeat(offsets, lens)
+    sortx = np.lexsort((-ranks, -measure_cols[main_key], segids))
+    # segids are already grouped, so sorting leaves each segment in place
+    keep = ranks < ntop
+    keep_idxs = sortx[keep]
+    for key in measure_keys:
+        topn = np.full((num_pairs, ntop), np.nan)
+        topn[segids[keep], ranks[keep]] = measure_cols[key][keep_idxs]
+        header.extend([key + str(count) for count in range(ntop)])
+        col_list.extend(topn.T)
+
+    # Segmented sums, means, and standard deviations
+    sums = {}
+    means = {}
+    for key in measure_keys:
+        sums[key] = np.zeros(num_pairs)
+        if nonempty.any():
+            sums[key][nonempty] = np.add.reduceat(measure_cols[key],
+                                                  offsets[nonempty])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            means[key] = sums[key] / lens
+    stds = {}
+    for key in measure_keys:
+        devs = measure_cols[key] - np.repeat(means[key], lens)
+        sqrd_sums = np.zeros(num_pairs)
+        if nonempty.any():
+            sqrd_sums[nonempty] = np.add.reduceat(devs ** 2, offsets[nonempty])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            stds[key] = np.sqrt(sqrd_sums / (lens - 1))
+        stds[key][lens < 2] = np.nan
+    for prefix, stat in [('sum_', sums), ('mean_', means), ('std_', stds)]:
+        for key in measure_keys:
+            header.append(prefix + key)
+            col_list.append(stat[key])
+    header.append('n_total')
+    col_list.append(lens)
+
+    X = np.empty((num_pairs, len(header)), dtype=np.float32)
+    for colx, col in enumerate(col_list):
+        X[:, colx] = col
+    return X, header
+
+
+@ut.reloadable_class
+class MatchTable(ut.NiceRepr):
+    """
+    Compact columnar storage of the feature matches between two annotations.
+
+    Matches are never copied when they are filtered. Instead a single
+    boolean active column is updated in place (see apply_ratio_test,
+    apply_sver, and filter_active). fm is int32, scores and measures are
+    float32. Tables can be saved to npz or exposed as buffers and rebuilt
+    without copying (see as_buffers and from_buffers).
+
+    CommandLine:
+        python -m vtool.matching --test-MatchTable
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from vtool.matching import *  # NOQA
+        >>> kpts1, vecs1, kpts2_list, vecs2_list, dlen_sqrd2_list = testdata_onevsmany()
+        >>> kpts2, vecs2, dlen_sqrd2 = kpts2_list[0], vecs2_list[0], dlen_sqrd2_list[0]
+        >>> fx2_to_fx1, fx2_to_dist = exact_normalized_nearest_neighbors(vecs1, vecs2, 2)
+        >>> fm, match_dist, fx1_norm, norm_dist = assign_unconstrained_matches(
+        >>>     fx2_to_fx1, fx2_to_dist, 1, 1)
+        >>> ratio = match_dist / norm_dist
+        >>> table = MatchTable(fm, 1 - ratio, {'ratio': ratio}, meta={'aid1': 1, 'aid2': 2})
+        >>> fm_data = table.fm
+        >>> table.apply_ratio_test(.625)
+        >>> table.apply_sver(kpts1, kpts2, dlen_sqrd2)
+        >>> assert table.fm is fm_data
+        >>> # same matches as vsone_feature_matching
+        >>> matches, _ = vsone_feature_matching(kpts1, vecs1, kpts2, vecs2, dlen_sqrd2,
+        >>>                                     {'nn_backend': 'exact'}, verbose=False)
+        >>> assert np.all(table.get_active('fm') == matches['RAT+SV'][0].fm)
+        >>> # the keypoints only translate: no rotation, scale ratio of one
+        >>> assert np.allclose(table.get_active('sver_err_ori'), 0)
+        >>> assert np.allclose(table.get_active('sver_err_scale'), 1)
+        >>> # zero copy round trip
+        >>> header, buffers = table.as_buffers()
+        >>> table2 = MatchTable.from_buffers(header, buffers)
+        >>> assert np.shares_memory(table2.fm, table.fm)
+        >>> # read-only buffers (e.g. received bytes) can still be filtered
+        >>> table4 = MatchTable.from_buffers(header, [buf.tobytes() for buf in buffers])
+        >>> table4.apply_ratio_test(.5)
+        >>> assert np.all(table4.active == (table.active & (table.measures['ratio'] < .5)))
+        >>> # npz round trip
+        >>> fpath = ut.unixjoin(ut.ensure_app_resource_dir('vtool', 'tests'), 'table.npz')
+        >>> table.save(fpath)
+        >>> table3 = MatchTable.load(fpath)
+        >>> assert np.all(table3.active == table.active)
+        >>> assert table3.meta == table.meta
+        >>> result = str(table)
+        >>> print(result)
+        <MatchTable(150 / 170, nbytes=4930)>
+    """
+
+    def __init__(table, fm, fs, measures=None, active=None, H_12=None,
+                 meta=None):
+        num = len(fm)
+        table.fm = np.ascontiguousarray(fm, dtype=np.int32).reshape(num, 2)
+        table.fs = np.ascontiguousarray(fs, dtype=np.float32).reshape(num)
+        if measures is None:
+            measures = {}
+        table.measures = ut.odict([
+            (key, np.ascontiguousarray(val, dtype=np.float32).reshape(num))
+            for key, val in measures.items()])
+        if active is None:
+            active = np.ones(num, dtype=np.bool_)
+        table.active = np.ascontiguousarray(active, dtype=np.bool_).reshape(num)
+        table.H_12 = H_12
+        table.meta = {} if meta is None else meta
+
+    @classmethod
+    def from_pairwise(cls, match):
+        """ Converts the current matches of a PairwiseMatch """
+        meta = {}
+        if match.annot1 is not None and 'aid' in match.annot1:
+            meta['aid1'] = match.annot1['aid']
+            meta['aid2'] = match.annot2['aid']
+        return cls(match.fm, match.fs, match.measures, H_12=match.H_12,
+                   meta=meta)
+
+    def __nice__(table):
+        return '%d / %d, nbytes=%d' % (table.num_active, len(table.active),
+                                       table.nbytes)
+
+    def __len__(table):
+        return table.num_active
+
+    @property
+    def num_active(table):
+        return int(np.count_nonzero(table.active))
+
+    @property
+    def nbytes(table):
+        return (table.fm.nbytes + table.fs.nbytes + table.active.nbytes +
+                sum(val.nbytes for val in table.measures.values()))
+
+    def get_active(table, key):
+        """ Returns a column ('fm', 'fs', or a measure) of the active rows """
+        if key == 'fm':
+            col = table.fm
+        elif key == 'fs':
+            col = table.fs
+        else:
+            col = table.measures[key]
+        return col.compress(table.active, axis=0)
+
+    def filter_active(table, flags):
+        """ Deactivates the active rows where flags (one per active row) is False """
+        table.active[table.active] = flags
+        return table
+
+    def apply_ratio_test(table, ratio_thresh=.625):
+        flags = np.less(table.measures['ratio'], ratio_thresh)
+        np.logical_and(table.active, flags, out=table.active)
+        return table
+
+    def apply_sver(table, kpts1, kpts2, dlen_sqrd2, cfgdict={}):
+        """
+        Spatially verifies the active matches. Verification errors are
+        stored in the sver_err_xy, sver_err_ori, and sver_err_scale measures
+        (nan for rows that were not verified).
+        """
+        from vtool import spatial_verification as sver
+        sver_xy_thresh = cfgdict.get('sver_xy_thresh', .01)
+        refine_method  = cfgdict.get('refine_method', 'homog')
+        activexs = np.flatnonzero(table.active)
+        svtup = sver.spatially_verify_kpts(
+            kpts1, kpts2, table.fm.take(activexs, axis=0), sver_xy_thresh,
+            dlen_sqrd2=dlen_sqrd2,
+            match_weights=table.fs.take(activexs).astype(np.float64),
+            refine_method=refine_method)
+        table.active[activexs] = False
+        if svtup is None:
+            table.H_12 = np.eye(3)
+            return table
+        (inliers, errors, H_12) = svtup[0:3]
+        table.active[activexs.take(inliers)] = True
+        table.H_12 = H_12
+        # refined errors are ordered (xy, ori, scale)
+        for key, error in zip(['sver_err_xy', 'sver_err_ori', 'sver_err_scale'],
+                              errors):
+            if error is None:
+                continue
+            if key not in table.measures:
+                table.measures[key] = np.full(len(table.active), np.nan,
+                                              dtype=np.float32)
+            table.measures[key][activexs] = error
+        return table
+
+    def compact(table):
+        """ Returns a new table containing only the active rows """
+        measures = ut.odict([(key, val.compress(table.active))
+                             for key, val in table.measures.items()])
+        return MatchTable(table.get_active('fm'), table.get_active('fs'),
+                          measures, H_12=table.H_12, meta=table.meta.copy())
+
+    def _columns(table):
+        columns = ut.odict([('fm', table.fm), ('fs', table.fs),
+                            ('active', table.active)])
+        for key, val in table.measures.items():
+            columns['measure_' + key] = val
+        if table.H_12 is not None:
+            columns['H_12'] = np.asarray(table.H_12)
+        return columns
+
+    def as_buffers(table):
+        """
+        Returns a json serializable header and a list of flat uint8 arrays
+        that share memory with the columns.
+        """
+        columns = table._columns()
+        header = {
+            'columns': [(key, val.dtype.str, val.shape)
+                        for key, val in columns.items()],
+            'meta': table.meta,
+        }
+        buffers = [np.ascontiguousarray(val).reshape(-1).view(np.uint8)
+                   for val in columns.values()]
+        return header, buffers
+
+    @classmethod
+    def from_buffers(cls, header, buffers):
+        """
+        Wraps buffers from as_buffers (or any objects exposing the same
+        bytes) without copying fm and fs. The active column, and measures in
+        read-only buffers, are copied because filtering and verification
+        write to them.
+        """
+        columns = {}
+        for (key, dtype_str, shape), buf in zip(header['columns'], buffers):
+            col = np.frombuffer(buf, dtype=np.dtype(dtype_str)).reshape(shape)
+            if key == 'active' or (key.startswith('measure_') and
+                                   not col.flags.writeable):
+                col = col.copy()
+            columns[key] = col
+        return cls._from_columns(columns, header['meta'])
+
+    @classmethod
+    def _from_columns(cls, columns, meta):
+        measures = ut.odict([
+            (key[len('measure_'):], val) for key, val in columns.items()
+            if key.startswith('measure_')])
+        return cls(columns['fm'], columns['fs'], measures,
+                   active=columns['active'], H_12=columns.get('H_12', None),
+                   meta=meta)
+
+    def save(table, fpath):
+        """ Saves the table to an (uncompressed) npz file """
+        import json
+        columns = table._columns()
+        columns['meta'] = np.array(json.dumps(table.meta))
+        with open(fpath, 'wb') as file_:
+            np.savez(file_, **columns)
+
+    @classmethod
+    def load(cls, fpath):
+        import json
+        with np.load(fpath) as npz:
+            columns = ut.odict([(key, npz[key]) for key in npz.files])
+        meta = json.loads(str(columns.pop('meta')))
+        return cls._from_columns(columns, meta)
+
+
 class SingleMatch(ut.NiceRepr):
 
     def __init__(self, matches, metadata):
@@ -293,12 +666,15 @@ class SingleMatch(ut.NiceRepr):
         self.__dict__.update(state_dict)
 
 
-def vsone_image_fpath_matching(rchip_fpath1, rchip_fpath2, cfgdict={}, metadata_=None):
+def vsone_image_fpath_matching(rchip_fpath1, rchip_fpath2, cfgdict={},
+                               metadata_=None, use_cache=None):
     r"""
     Args:
         rchip_fpath1 (str):
         rchip_fpath2 (str):
         cfgdict (dict): (default = {})
+        use_cache (bool): use the on-disk feature cache (see
+            ensure_metadata_feats)
 
     CommandLine:
         python -m vtool --tf vsone_image_fpath_matching --show
@@ -331,6 +707,8 @@ def vsone_image_fpath_matching(rchip_fpath1, rchip_fpath2, cfgdict={}, metadata_
         metadata.update(metadata_)
     annot1['rchip_fpath'] = rchip_fpath1
     annot2['rchip_fpath'] = rchip_fpath2
+    ensure_metadata_feats(annot1, cfgdict=cfgdict, use_cache=use_cache)
+    ensure_metadata_feats(annot2, cfgdict=cfgdict, use_cache=use_cache)
     match =  vsone_matching(metadata, cfgdict)
     return match
 
@@ -350,7 +728,8 @@ def ensure_metadata_vsone(annot1, annot2, cfgdict={}):
     pass
 
 
-def ensure_metadata_feats(annot, suffix='', cfgdict={}):
+def ensure_metadata_feats(annot, suffix='', cfgdict={}, use_cache=None,
+                          cache_dpath=None):
     r"""
     Adds feature evaluation keys to a lazy dictionary
 
@@ -358,6 +737,13 @@ def ensure_metadata_feats(annot, suffix='', cfgdict={}):
         annot (utool.LazyDict):
         suffix (str): (default = '')
         cfgdict (dict): (default = {})
+        use_cache (bool): look up features in the on-disk feature cache
+            before extracting them (default = vt.features.USE_FEAT_CACHE,
+            which is off unless --cache-feats is given).
+            When the chip comes from rchip_fpath a cache hit does not read
+            the chip at all.
+        cache_dpath (str): feature cache directory
+            (default = vt.features.get_feat_cache_dpath())
 
     CommandLine:
         python -m vtool.matching --exec-ensure_metadata_feats
@@ -369,19 +755,40 @@ def ensure_metadata_feats(annot, suffix='', cfgdict={}):
         >>> annot = ut.LazyDict({'rchip_fpath': rchip_fpath})
         >>> suffix = ''
         >>> cfgdict = {}
-        >>> ensure_metadata_feats(annot, suffix, cfgdict)
+        >>> ensure_metadata_feats(annot, suffix, cfgdict, use_cache=False)
         >>> assert len(annot._stored_results) == 1
         >>> annot['kpts']
         >>> assert len(annot._stored_results) == 4
         >>> annot['vecs']
         >>> assert len(annot._stored_results) == 5
+
+    Example1:
+        >>> # ENABLE_DOCTEST
+        >>> from vtool.matching import *  # NOQA
+        >>> rchip_fpath = ut.grab_test_imgpath('easy1.png')
+        >>> cache_dpath = ut.ensure_app_resource_dir('vtool', 'test_feat_cache')
+        >>> ut.delete(cache_dpath)
+        >>> ut.ensuredir(cache_dpath)
+        >>> annot1 = ut.LazyDict({'rchip_fpath': rchip_fpath})
+        >>> annot2 = ut.LazyDict({'rchip_fpath': rchip_fpath})
+        >>> ensure_metadata_feats(annot1, use_cache=True, cache_dpath=cache_dpath)
+        >>> ensure_metadata_feats(annot2, use_cache=True, cache_dpath=cache_dpath)
+        >>> assert np.all(annot1['kpts'] == annot2['kpts'])
+        >>> # The second annot was loaded from the cache without reading the chip
+        >>> assert 'rchip' in annot1._stored_results
+        >>> assert 'rchip' not in annot2._stored_results
     """
     import vtool as vt
+    import vtool.features as vtfeat
     rchip_key = 'rchip' + suffix
     _feats_key = '_feats' + suffix
     kpts_key = 'kpts' + suffix
     vecs_key = 'vecs' + suffix
     rchip_fpath_key = 'rchip_fpath' + suffix
+    if use_cache is None:
+        use_cache = vtfeat.USE_FEAT_CACHE
+    # If the chip is read from rchip_fpath, the file itself can be hashed
+    hash_fpath = rchip_key not in annot
 
     if rchip_key not in annot:
         def eval_rchip1():
@@ -391,8 +798,25 @@ def ensure_metadata_feats(annot, suffix='', cfgdict={}):
 
     if kpts_key not in annot or vecs_key not in annot:
         def eval_feats():
-            rchip = annot[rchip_key]
-            _feats = vt.extract_features(rchip, **cfgdict)
+            if not use_cache:
+                rchip = annot[rchip_key]
+                _feats = vt.extract_features(rchip, **cfgdict)
+                return _feats
+            # matching parameters do not change the features
+            feat_cfgdict = {key: val for key, val in cfgdict.items()
+                            if key not in VSONE_PARAM_KEYS}
+            feat_cfgstr = vtfeat.get_feat_cfgstr(**feat_cfgdict)
+            if hash_fpath:
+                content_hash = vtfeat.get_content_hash(annot[rchip_fpath_key])
+            else:
+                content_hash = vtfeat.get_content_hash(annot[rchip_key])
+            _feats = vtfeat.load_cached_features(content_hash, feat_cfgstr,
+                                                 cache_dpath)
+            if _feats is None:
+                rchip = annot[rchip_key]
+                _feats = vt.extract_features(rchip, **cfgdict)
+                vtfeat.save_cached_features(content_hash, feat_cfgstr,
+                                            _feats[0], _feats[1], cache_dpath)
             return _feats
 
         def eval_kpts():
@@ -426,7 +850,8 @@ def ensure_metadata_flann(annot, cfgdict):
     if 'flann' not in annot:
         def eval_flann():
             vecs = annot['vecs']
-            _flann = vt.flann_cache(vecs, flann_params=flann_params, verbose=False)
+            _flann = vt.flann_cache(vecs, flann_params=flann_params,
+                                    verbose=False, use_memcache=True)
             return _flann
         annot.set_lazy_func('flann', eval_flann)
     return annot
@@ -502,25 +927,32 @@ def vsone_feature_matching(kpts1, vecs1, kpts2, vecs2, dlen_sqrd2, cfgdict={},
     K              = cfgdict.get('K', 1)
     Knorm          = cfgdict.get('Knorm', 1)
     checks = cfgdict.get('checks', 800)
+    nn_backend = choose_nn_backend(len(vecs1), len(vecs2),
+                                   cfgdict.get('nn_backend', 'auto'))
     if verbose is None:
         verbose = True
 
     flann_params = {'algorithm': 'kdtree', 'trees': 8}
-    if flann1 is None:
-        flann1 = vt.flann_cache(vecs1, flann_params=flann_params,
-                                verbose=verbose)
-    if symmetric:
-        if flann2 is None:
-            flann2 = vt.flann_cache(vecs2, flann_params=flann_params,
-                                    verbose=verbose)
+    if nn_backend == 'flann':
+        if flann1 is None:
+            flann1 = vt.flann_cache(vecs1, flann_params=flann_params,
+                                    verbose=verbose, use_memcache=True)
+        if symmetric:
+            if flann2 is None:
+                flann2 = vt.flann_cache(vecs2, flann_params=flann_params,
+                                        verbose=verbose, use_memcache=True)
     try:
         num_neighbors = K + Knorm
         # Search for nearest neighbors
-        fx2_to_fx1, fx2_to_dist = normalized_nearest_neighbors(
-            flann1, vecs2, num_neighbors, checks)
+        if nn_backend == 'exact':
+            fx2_to_fx1, fx2_to_dist = exact_normalized_nearest_neighbors(
+                vecs1, vecs2, num_neighbors)
+        else:
+            fx2_to_fx1, fx2_to_dist = normalized_nearest_neighbors(
+                flann1, vecs2, num_neighbors, checks)
         if symmetric:
-            fx1_to_fx2, fx1_to_dist = normalized_nearest_neighbors(
-                flann2, vecs1, K, checks)
+            fx1_to_fx2 = reverse_candidate_neighbors(
+                fx2_to_fx1, K, vecs1, vecs2, flann2, checks)
 
         if symmetric:
             valid_flags = flag_symmetric_matches(fx2_to_fx1, fx1_to_fx2, K)
@@ -598,6 +1030,201 @@ def vsone_feature_matching(kpts1, vecs1, kpts2, vecs2, dlen_sqrd2, cfgdict={},
     return matches, output_metdata
 
 
+def testdata_onevsmany(num_annots=4, num_feats=300, seed=0):
+    """
+    Query keypoints and descriptors plus database annotations that each
+    contain a noisy, translated subset of the query features.
+    """
+    rng = np.random.RandomState(seed)
+    xy1 = rng.rand(num_feats, 2) * 200
+    shape1 = np.tile([[4.0, 0.0, 4.0, 0.0]], (num_feats, 1))
+    kpts1 = np.hstack([xy1, shape1]).astype(np.float32)
+    vecs1 = rng.randint(0, 64, (num_feats, 128)).astype(np.uint8)
+    kpts2_list, vecs2_list, dlen_sqrd2_list = [], [], []
+    for count in range(num_annots):
+        subx = rng.choice(num_feats, num_feats // 2, replace=False)
+        kpts2 = kpts1[subx].copy()
+        kpts2[:, 0] += 10 * count
+        noise = rng.randint(0, 2, (len(subx), 128))
+        vecs2 = (vecs1[subx] + noise).astype(np.uint8)
+        # distractors
+        kpts2 = np.vstack([kpts2, kpts1[0:20] + [[100, 50, 0, 0, 0, 0]]])
+        vecs2 = np.vstack([vecs2, rng.randint(0, 64, (20, 128)).astype(np.uint8)])
+        kpts2_list.append(kpts2.astype(np.float32))
+        vecs2_list.append(vecs2)
+        dlen_sqrd2_list.append(300 ** 2 + 300 ** 2)
+    return kpts1, vecs1, kpts2_list, vecs2_list, dlen_sqrd2_list
+
+
+def onevsmany_feature_matching(kpts1, vecs1, kpts2_list, vecs2_list,
+                               dlen_sqrd2_list, cfgdict={}, flann1=None,
+                               num_procs=None, verbose=None):
+    r"""
+    Matches one query annotation (1) against many database annotations (2)
+    with the same logic as vsone_feature_matching.
+
+    The query index is built once, the descriptors of all database
+    annotations are stacked (see nearest_neighbors.invertible_stack) and
+    searched in one call, the ratio test is applied to all of the stacked
+    matches at once, and spatial verification of each pair is run in a
+    thread pool.
+
+    Args:
+        kpts1 (ndarray[float32_t, ndim=2]): query keypoints
+        vecs1 (ndarray[uint8_t, ndim=2]): query SIFT descriptors
+        kpts2_list (list): keypoints of each database annotation
+        vecs2_list (list): descriptors of each database annotation
+        dlen_sqrd2_list (list): squared chip diagonal of each database annot
+        cfgdict (dict): see VSONE_DEFAULT_CONFIG (symmetric is not supported)
+        flann1 (pyflann.FLANN): index of vecs1 (built if not given)
+        num_procs (int): number of threads used for search and verification
+
+    Returns:
+        tuple: (match_list, H_list, stage_times)
+            match_list - MatchTup3 of the final stage (RAT+SV if sv_on else
+                ORIG, as in vsone_feature_matching) for each database
+                annotation. A MatchingError in one pair only empties the
+                matches of that pair.
+            H_list - verified homography for each database annotation
+            stage_times - seconds spent in each stage
+
+    CommandLine:
+        python -m vtool.matching --test-onevsmany_feature_matching
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from vtool.matching import *  # NOQA
+        >>> import pyflann
+        >>> kpts1, vecs1, kpts2_list, vecs2_list, dlen_sqrd2_list = testdata_onevsmany()
+        >>> flann1 = pyflann.FLANN()
+        >>> flann1.build_index(vecs1, algorithm='kdtree', trees=8)
+        >>> cfgdict = {'nn_backend': 'flann'}
+        >>> match_list, H_list, stage_times = onevsmany_feature_matching(
+        >>>     kpts1, vecs1, kpts2_list, vecs2_list, dlen_sqrd2_list, cfgdict,
+        >>>     flann1=flann1, verbose=False)
+        >>> # same result as matching each pair separately
+        >>> for count, match in enumerate(match_list):
+        >>>     matches, metadata = vsone_feature_matching(
+        >>>         kpts1, vecs1, kpts2_list[count], vecs2_list[count],
+        >>>         dlen_sqrd2_list[count], cfgdict, flann1=flann1, verbose=False)
+        >>>     fm, fs, fm_norm = matches['RAT+SV'][0]
+        >>>     assert np.all(match.fm == fm) and np.all(match.fs == fs)
+        >>>     assert np.all(match.fm_norm == fm_norm)
+        >>> # without spatial verification there is no ratio test either
+        >>> cfgdict2 = {'nn_backend': 'flann', 'sv_on': False}
+        >>> match_list2 = onevsmany_feature_matching(
+        >>>     kpts1, vecs1, kpts2_list, vecs2_list, dlen_sqrd2_list, cfgdict2,
+        >>>     flann1=flann1, verbose=False)[0]
+        >>> matches, metadata = vsone_feature_matching(
+        >>>     kpts1, vecs1, kpts2_list[0], vecs2_list[0], dlen_sqrd2_list[0],
+        >>>     cfgdict2, flann1=flann1, verbose=False)
+        >>> assert np.all(match_list2[0].fm == matches['ORIG'].fm)
+        >>> assert np.allclose(match_list2[0].fs, matches['ORIG'].fs, atol=1e-6)
+        >>> result = ut.repr2(([len(match.fm) for match in match_list],
+        >>>                    list(stage_times.keys())))
+        >>> print(result)
+        ([150, 150, 150, 150], ['build_index', 'knn', 'ratio', 'sver'])
+    """
+    from multiprocessing.pool import ThreadPool
+    from vtool import nearest_neighbors as nntool
+    import vtool as vt
+    sv_on = cfgdict.get('sv_on', True)
+    sver_xy_thresh = cfgdict.get('sver_xy_thresh', .01)
+    ratio_thresh   = cfgdict.get('ratio_thresh', .625)
+    refine_method  = cfgdict.get('refine_method', 'homog')
+    symmetric      = cfgdict.get('symmetric', False)
+    K              = cfgdict.get('K', 1)
+    Knorm          = cfgdict.get('Knorm', 1)
+    checks = cfgdict.get('checks', 800)
+    assert not symmetric, 'use vsone_feature_matching for symmetric matching'
+    if verbose is None:
+        verbose = True
+    if num_procs is None:
+        num_procs = multiprocessing.cpu_count()
+    num_pairs = len(vecs2_list)
+    stage_times = ut.odict()
+
+    tt = ut.tic()
+    flann_params = {'algorithm': 'kdtree', 'trees': 8}
+    if flann1 is None:
+        flann1 = vt.flann_cache(vecs1, flann_params=flann_params,
+                                verbose=verbose, use_memcache=True)
+    stage_times['build_index'] = ut.toc(tt)
+
+    try:
+        # Search for nearest neighbors of all database features at once
+        tt = ut.tic()
+        num_neighbors = K + Knorm
+        idx2_vec, idx2_pairx, idx2_fx = nntool.invertible_stack(
+            vecs2_list, list(range(num_pairs)))
+        idx2_to_fx1, idx2_to_dist = normalized_nearest_neighbors(
+            flann1, idx2_vec, num_neighbors, checks, num_threads=num_procs)
+        stage_times['knn'] = ut.toc(tt)
+
+        # Assign matches and apply the ratio test to the stacked matches
+        tt = ut.tic()
+        assigntup = assign_unconstrained_matches(idx2_to_fx1, idx2_to_dist, K,
+                                                 Knorm)
+        fm_flat, match_dist, fx1_norm, norm_dist = assigntup
+        ratio_on = sv_on
+        if not ratio_on:
+            # keep every match (the ORIG stage of vsone_feature_matching)
+            ratio_thresh = np.inf
+        fm_flat, fs_flat, fm_norm_flat = ratio_test(
+            fm_flat, fx1_norm, match_dist, norm_dist, ratio_thresh)
+        # Matches are ordered by stacked index, so each pair is contiguous
+        pairx_flat = np.asarray(idx2_pairx).take(fm_flat.T[1])
+        fx2_flat = np.asarray(idx2_fx, dtype=fm_flat.dtype).take(fm_flat.T[1])
+        fm_flat = np.vstack((fm_flat.T[0], fx2_flat)).T
+        fm_norm_flat = np.vstack((fm_norm_flat.T[0], fx2_flat)).T
+        splitxs = np.searchsorted(pairx_flat, np.arange(1, num_pairs))
+        fm_RAT_list = np.split(fm_flat, splitxs)
+        fs_RAT_list = np.split(fs_flat, splitxs)
+        fm_norm_RAT_list = np.split(fm_norm_flat, splitxs)
+        stage_times['ratio'] = ut.toc(tt)
+
+        tt = ut.tic()
+        if sv_on:
+            def _verify_pair(pairx):
+                try:
+                    return match_spatial_verification(
+                        kpts1, kpts2_list[pairx], fm_RAT_list[pairx],
+                        fs_RAT_list[pairx], fm_norm_RAT_list[pairx],
+                        sver_xy_thresh, dlen_sqrd2_list[pairx], refine_method)
+                except MatchingError:
+                    return _empty_match_tup3() + (np.eye(3),)
+            if num_procs > 1 and num_pairs > 1:
+                pool = ThreadPool(min(num_procs, num_pairs))
+                try:
+                    svout_list = pool.map(_verify_pair, range(num_pairs))
+                finally:
+                    pool.close()
+                    pool.join()
+            else:
+                svout_list = [_verify_pair(pairx) for pairx in range(num_pairs)]
+            match_list = [MatchTup3(*svout[0:3]) for svout in svout_list]
+            H_list = [svout[3] for svout in svout_list]
+        else:
+            match_list = [MatchTup3(*tup) for tup in
+                          zip(fm_RAT_list, fs_RAT_list, fm_norm_RAT_list)]
+            H_list = [np.eye(3)] * num_pairs
+        stage_times['sver'] = ut.toc(tt)
+    except MatchingError:
+        # The query itself cannot be matched (e.g. too few query features)
+        match_list = [_empty_match_tup3() for _ in range(num_pairs)]
+        H_list = [np.eye(3) for _ in range(num_pairs)]
+    if verbose:
+        print('[matching] onevsmany stage_times = %s' % (
+            ut.repr2(stage_times, precision=4),))
+    return match_list, H_list, stage_times
+
+
+def _empty_match_tup3():
+    fm_ERR = np.empty((0, 2), dtype=np.int32)
+    fs_ERR = np.empty((0, 1), dtype=np.float32)
+    return MatchTup3(fm_ERR, fs_ERR, fm_ERR)
+
+
 def match_spatial_verification(kpts1, kpts2, fm, fs, fm_norm, sver_xy_thresh,
                                dlen_sqrd2, refine_method):
     from vtool import spatial_verification as sver
@@ -624,12 +1251,27 @@ def empty_neighbors(num_vecs=0, K=0):
     return fx2_to_fx1, _fx2_to_dist_sqrd
 
 
-def normalized_nearest_neighbors(flann, vecs2, K, checks=800):
+def normalized_nearest_neighbors(flann, vecs2, K, checks=800, num_threads=1,
+                                 chunksize=2048):
     """
     uses flann index to return nearest neighbors with distances normalized
     between 0 and 1 using sifts uint8 trick
+
+    Args:
+        flann (pyflann.FLANN): index of vecs1
+        vecs2 (ndarray): query vectors
+        K (int): number of neighbors
+        checks (int): flann search checks
+        num_threads (int): if more than one, chunks of chunksize query
+            vectors are searched concurrently in a thread pool (pyflann
+            releases the GIL during the search). If None, one thread per
+            cpu is used. Defaults to 1.
+        chunksize (int): number of query vectors per chunk
+
+    Returns:
+        tuple: (fx2_to_fx1, fx2_to_dist) - int32 neighbor indices and float32
+            normalized distances with shape (len(vecs2), K)
     """
-    import vtool as vt
     if K == 0:
         (fx2_to_fx1, _fx2_to_dist_sqrd) = empty_neighbors(len(vecs2), 0)
     elif len(vecs2) == 0:
@@ -639,12 +1281,132 @@ def normalized_nearest_neighbors(flann, vecs2, K, checks=800):
         raise MatchingError('not enough database features')
         #(fx2_to_fx1, _fx2_to_dist_sqrd) = empty_neighbors(len(vecs2), 0)
     else:
+        if num_threads is None:
+            num_threads = multiprocessing.cpu_count()
+        if num_threads > 1 and len(vecs2) > chunksize:
+            return _sharded_normalized_nearest_neighbors(
+                flann, vecs2, K, checks, num_threads, chunksize)
         fx2_to_fx1, _fx2_to_dist_sqrd = flann.nn_index(vecs2, num_neighbors=K, checks=checks)
-    _fx2_to_dist = np.sqrt(_fx2_to_dist_sqrd.astype(np.float64))
-    # normalized dist
-    fx2_to_dist = np.divide(_fx2_to_dist, PSEUDO_MAX_DIST)
-    fx2_to_fx1 = vt.atleast_nd(fx2_to_fx1, 2)
-    fx2_to_dist = vt.atleast_nd(fx2_to_dist, 2)
+    fx2_to_fx1 = np.asarray(fx2_to_fx1, dtype=np.int32).reshape(len(vecs2), K)
+    fx2_to_dist = np.empty((len(vecs2), K), dtype=np.float32)
+    _normalize_dist_sqrd(_fx2_to_dist_sqrd, fx2_to_dist)
+    return fx2_to_fx1, fx2_to_dist
+
+
+def choose_nn_backend(num_vecs1, num_vecs2, nn_backend='auto'):
+    """
+    Resolves nn_backend='auto' to 'exact' when brute force search over all
+    num_vecs1 * num_vecs2 descriptor pairs is cheaper than building and
+    searching a FLANN index, and to 'flann' otherwise.
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from vtool.matching import *  # NOQA
+        >>> result = ut.repr2([choose_nn_backend(1500, 2000),
+        >>>                    choose_nn_backend(10000, 8000),
+        >>>                    choose_nn_backend(10000, 8000, 'exact')])
+        >>> print(result)
+        ['exact', 'flann', 'exact']
+    """
+    if nn_backend == 'auto':
+        if num_vecs1 * num_vecs2 <= EXACT_NN_MAX_PAIRS:
+            nn_backend = 'exact'
+        else:
+            nn_backend = 'flann'
+    assert nn_backend in ['exact', 'flann'], 'unknown nn_backend=%r' % (nn_backend,)
+    return nn_backend
+
+
+def exact_normalized_nearest_neighbors(vecs1, vecs2, K):
+    """
+    Exact version of normalized_nearest_neighbors that searches vecs1 by
+    brute force (see vtool.distance.knn_L2_sqrd) instead of with a FLANN
+    index. Results are deterministic.
+
+    CommandLine:
+        python -m vtool.matching --test-exact_normalized_nearest_neighbors
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from vtool.matching import *  # NOQA
+        >>> import vtool as vt
+        >>> rng = np.random.RandomState(0)
+        >>> vecs1 = rng.randint(0, 255, (100, 128)).astype(np.uint8)
+        >>> vecs2 = rng.randint(0, 255, (50, 128)).astype(np.uint8)
+        >>> fx2_to_fx1, fx2_to_dist = exact_normalized_nearest_neighbors(vecs1, vecs2, 2)
+        >>> dists = vt.L2_sift(vecs2, vecs1[fx2_to_fx1.T[0]])
+        >>> assert np.allclose(fx2_to_dist.T[0], dists)
+        >>> result = ut.repr2((str(fx2_to_dist.dtype), fx2_to_dist.shape))
+        >>> print(result)
+        ('float32', (50, 2))
+    """
+    from vtool import distance
+    if K == 0:
+        (fx2_to_fx1, _fx2_to_dist_sqrd) = empty_neighbors(len(vecs2), 0)
+    elif len(vecs2) == 0:
+        (fx2_to_fx1, _fx2_to_dist_sqrd) = empty_neighbors(0, K)
+    elif K > len(vecs1):
+        raise MatchingError('not enough database features')
+    else:
+        fx2_to_fx1, _fx2_to_dist_sqrd = distance.knn_L2_sqrd(vecs1, vecs2, K)
+    fx2_to_fx1 = np.asarray(fx2_to_fx1, dtype=np.int32)
+    fx2_to_dist = np.empty((len(vecs2), K), dtype=np.float32)
+    _normalize_dist_sqrd(_fx2_to_dist_sqrd, fx2_to_dist)
+    return fx2_to_fx1, fx2_to_dist
+
+
+def _normalize_dist_sqrd(dist_sqrd, out):
+    """ writes sqrt(dist_sqrd) / PSEUDO_MAX_DIST into out without temporaries """
+    np.sqrt(np.asarray(dist_sqrd).reshape(out.shape), out=out)
+    np.divide(out, PSEUDO_MAX_DIST, out=out)
+    return out
+
+
+def _sharded_normalized_nearest_neighbors(flann, vecs2, K, checks, num_threads,
+                                          chunksize):
+    """
+    Searches chunks of vecs2 concurrently and writes the results into
+    preallocated outputs.
+
+    CommandLine:
+        python -m vtool.matching --test-_sharded_normalized_nearest_neighbors
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from vtool.matching import *  # NOQA
+        >>> import pyflann
+        >>> rng = np.random.RandomState(0)
+        >>> vecs1 = rng.randint(0, 255, (1000, 128)).astype(np.uint8)
+        >>> vecs2 = rng.randint(0, 255, (5000, 128)).astype(np.uint8)
+        >>> flann = pyflann.FLANN()
+        >>> flann.build_index(vecs1, algorithm='linear')
+        >>> fx2_to_fx1, fx2_to_dist = normalized_nearest_neighbors(
+        >>>     flann, vecs2, 2, num_threads=1)
+        >>> fx2_to_fx1_, fx2_to_dist_ = normalized_nearest_neighbors(
+        >>>     flann, vecs2, 2, num_threads=4, chunksize=512)
+        >>> assert np.all(fx2_to_fx1 == fx2_to_fx1_)
+        >>> assert np.all(fx2_to_dist == fx2_to_dist_)
+        >>> assert fx2_to_dist_.dtype == np.float32
+    """
+    from multiprocessing.pool import ThreadPool
+    num_vecs = len(vecs2)
+    fx2_to_fx1 = np.empty((num_vecs, K), dtype=np.int32)
+    fx2_to_dist = np.empty((num_vecs, K), dtype=np.float32)
+    slices = [slice(start, start + chunksize)
+              for start in range(0, num_vecs, chunksize)]
+
+    def _search_chunk(sl_):
+        idxs, dists_sqrd = flann.nn_index(vecs2[sl_], num_neighbors=K,
+                                          checks=checks)
+        fx2_to_fx1[sl_] = np.reshape(idxs, fx2_to_fx1[sl_].shape)
+        _normalize_dist_sqrd(dists_sqrd, fx2_to_dist[sl_])
+
+    pool = ThreadPool(min(num_threads, len(slices)))
+    try:
+        pool.map(_search_chunk, slices)
+    finally:
+        pool.close()
+        pool.join()
     return fx2_to_fx1, fx2_to_dist
 
 
@@ -898,6 +1660,60 @@ def flag_symmetric_matches(fx2_to_fx1, fx1_to_fx2, K=2):
     return is_symmetric
 
 
+def reverse_candidate_neighbors(fx2_to_fx1, K, vecs1, vecs2, flann2=None,
+                                checks=800):
+    """
+    Computes the reverse neighbors needed by flag_symmetric_matches. Only the
+    features of image1 that appear in the top K forward neighbors are
+    searched for, the rows of all other features are -1.
+
+    Args:
+        fx2_to_fx1 (ndarray): forward neighbors (image2 to image1)
+        K (int): number of neighbors used for symmetry
+        vecs1 (ndarray): descriptors of image1
+        vecs2 (ndarray): descriptors of image2
+        flann2 (pyflann.FLANN): index of vecs2. If None the exact backend is
+            used.
+
+    Returns:
+        ndarray: fx1_to_fx2
+
+    CommandLine:
+        python -m vtool.matching --test-reverse_candidate_neighbors
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from vtool.matching import *  # NOQA
+        >>> rng = np.random.RandomState(0)
+        >>> vecs1 = rng.randint(0, 255, (500, 128)).astype(np.uint8)
+        >>> vecs2 = rng.randint(0, 255, (100, 128)).astype(np.uint8)
+        >>> K = 2
+        >>> fx2_to_fx1, _ = exact_normalized_nearest_neighbors(vecs1, vecs2, K + 1)
+        >>> fx1_to_fx2 = reverse_candidate_neighbors(fx2_to_fx1, K, vecs1, vecs2)
+        >>> # same flags as a full reverse search
+        >>> fx1_to_fx2_full, _ = exact_normalized_nearest_neighbors(vecs2, vecs1, K)
+        >>> flags = flag_symmetric_matches(fx2_to_fx1, fx1_to_fx2, K)
+        >>> flags_full = flag_symmetric_matches(fx2_to_fx1, fx1_to_fx2_full, K)
+        >>> assert np.all(flags == flags_full)
+        >>> num_searched = (fx1_to_fx2.T[0] >= 0).sum()
+        >>> result = 'searched %d / %d' % (num_searched, len(vecs1))
+        >>> print(result)
+        searched 143 / 500
+    """
+    cand_fx1 = np.unique(fx2_to_fx1.T[:K].T)
+    fx1_to_fx2 = np.full((len(vecs1), K), -1, dtype=np.int32)
+    if len(cand_fx1) > 0:
+        cand_vecs1 = vecs1.take(cand_fx1, axis=0)
+        if flann2 is None:
+            cand_to_fx2, _ = exact_normalized_nearest_neighbors(
+                vecs2, cand_vecs1, K)
+        else:
+            cand_to_fx2, _ = normalized_nearest_neighbors(
+                flann2, cand_vecs1, K, checks)
+        fx1_to_fx2[cand_fx1] = cand_to_fx2
+    return fx1_to_fx2
+
+
 def unconstrained_ratio_match(flann, vecs2, unc_ratio_thresh=.625,
                               fm_dtype=np.int32, fs_dtype=np.float32):
     """ Lowes ratio matching
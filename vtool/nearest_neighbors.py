@@ -4,8 +4,14 @@ Wrapper around flann (with caching)
 python -c "import vtool, doctest; print(doctest.testmod(vtool.nearest_neighbors))"
 """
 from __future__ import absolute_import, division, print_function
-from os.path import exists, normpath, join
+from os.path import exists, normpath, join, dirname, basename, splitext
+import os
 import sys
+import json
+import hashlib
+import threading
+import collections
+import six
 import utool as ut
 import numpy as np
 (print, rrr, profile) = ut.inject2(__name__)
@@ -201,9 +207,204 @@ def get_flann_params_cfgstr(flann_params):
     return flann_valsig
 
 
+FINGERPRINT_METHODS = ['full', 'sample', 'chunked']
+
+
+def _sample_digest(data, num_samples=4096):
+    """
+    hashes the dtype and evenly strided rows (always including the first and
+    last)
+    """
+    num_rows = len(data)
+    sample_rows = np.unique(np.linspace(0, num_rows - 1,
+                                        min(num_rows, num_samples)).astype(np.int64))
+    sample = np.ascontiguousarray(data.take(sample_rows, axis=0))
+    hasher = hashlib.md5(data.dtype.str.encode('utf8'))
+    hasher.update(sample.tobytes())
+    return hasher.hexdigest()
+
+
+def _chunked_digest(data, chunk_nbytes=2 ** 24, num_threads=None):
+    """
+    hashes blocks of rows in a thread pool (hashlib releases the GIL) and
+    then hashes the concatenated block digests.
+    """
+    import multiprocessing
+    from multiprocessing.pool import ThreadPool
+    num_rows = len(data)
+    row_nbytes = max(1, data.nbytes // max(1, num_rows))
+    chunk_rows = max(1, chunk_nbytes // row_nbytes)
+    slices = [slice(start, start + chunk_rows)
+              for start in range(0, num_rows, chunk_rows)]
+
+    def _block_digest(sl):
+        block = np.ascontiguousarray(data[sl])
+        return hashlib.md5(block.data).digest()
+    if len(slices) <= 1:
+        block_digests = [_block_digest(sl) for sl in slices]
+    else:
+        if num_threads is None:
+            num_threads = min(len(slices), multiprocessing.cpu_count())
+        pool = ThreadPool(num_threads)
+        try:
+            block_digests = pool.map(_block_digest, slices)
+        finally:
+            pool.close()
+            pool.join()
+    return hashlib.md5(b''.join(block_digests)).hexdigest()
+
+
+def _read_fingerprint_sidecar(source_fpath):
+    """ returns the fingerprints remembered for source_fpath (if current) """
+    sidecar_fpath = source_fpath + '.fingerprint.json'
+    if not exists(sidecar_fpath):
+        return {}
+    try:
+        with open(sidecar_fpath, 'r') as file_:
+            sidecar = json.load(file_)
+    except ValueError:
+        return {}
+    stat = os.stat(source_fpath)
+    if sidecar.get('mtime') != stat.st_mtime or sidecar.get('size') != stat.st_size:
+        return {}
+    return sidecar.get('fingerprints', {})
+
+
+def _write_fingerprint_sidecar(source_fpath, fingerprints):
+    sidecar_fpath = source_fpath + '.fingerprint.json'
+    stat = os.stat(source_fpath)
+    sidecar = {'mtime': stat.st_mtime, 'size': stat.st_size,
+               'fingerprints': fingerprints}
+    tmp_fpath = sidecar_fpath + '.%d.tmp' % (os.getpid(),)
+    with open(tmp_fpath, 'w') as file_:
+        json.dump(sidecar, file_)
+    if ut.WIN32 and exists(sidecar_fpath):
+        os.remove(sidecar_fpath)
+    os.rename(tmp_fpath, sidecar_fpath)
+
+
+def get_data_fingerprint(data, fingerprint='full', content_id=None,
+                         source_fpath=None, lbl='_DPTS'):
+    r"""
+    Identifies data in cache keys without necessarily hashing all of it.
+
+    Args:
+        data (ndarray): data to fingerprint
+        fingerprint (str or func): method used to hash the data
+            'full' - hashes all data (ut.hashstr_arr27, the original keys)
+            'sample' - hashes up to 4096 evenly strided rows, shape, and
+                dtype. Constant time, but blind to changes between the
+                sampled rows.
+            'chunked' - hashes all data in blocks using a thread pool
+            or a function mapping data to a string
+        content_id (str): caller supplied identifier of the data contents.
+            Nothing is hashed if it is given.
+        source_fpath (str): file the data was loaded from. The fingerprint is
+            remembered in a sidecar file (source_fpath + '.fingerprint.json')
+            and reused while the mtime and size of the file are unchanged.
+            Fingerprints from lambdas and nested functions are not
+            remembered because their names are not unique.
+        lbl (str): label prefix
+
+    Returns:
+        str: data_hashstr
+
+    CommandLine:
+        python -m vtool.nearest_neighbors --test-get_data_fingerprint
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from vtool.nearest_neighbors import *  # NOQA
+        >>> rng = np.random.RandomState(1)
+        >>> dpts = rng.randint(0, 255, (10, 128)).astype(np.uint8)
+        >>> # the number of threads does not change the fingerprint
+        >>> from vtool.nearest_neighbors import _chunked_digest
+        >>> digest1 = _chunked_digest(dpts, chunk_nbytes=256, num_threads=1)
+        >>> digest2 = _chunked_digest(dpts, chunk_nbytes=256, num_threads=3)
+        >>> assert digest1 == digest2
+        >>> result = ut.repr2([
+        >>>     get_data_fingerprint(dpts, 'full'),
+        >>>     get_data_fingerprint(dpts, 'sample'),
+        >>>     get_data_fingerprint(dpts, 'chunked'),
+        >>>     get_data_fingerprint(dpts, content_id='vocab_v1'),
+        >>> ], nl=1)
+        >>> print(result)
+        [
+            '_DPTS((10,128)xxaotseonmfjkzcr)',
+            '_DPTS((10,128)sample=mndssyoolsnqdxdu)',
+            '_DPTS((10,128)chunked=rowyfizxqgtfotjf)',
+            '_DPTS(id=vocab_v1)',
+        ]
+
+    Example1:
+        >>> # ENABLE_DOCTEST
+        >>> from vtool.nearest_neighbors import *  # NOQA
+        >>> dpath = ut.ensure_app_resource_dir('vtool', 'test_fingerprint')
+        >>> source_fpath = join(dpath, 'dpts.npy')
+        >>> np.save(source_fpath, np.arange(256, dtype=np.uint8).reshape(2, 128))
+        >>> ut.delete(source_fpath + '.fingerprint.json')
+        >>> dpts = np.load(source_fpath)
+        >>> fp1 = get_data_fingerprint(dpts, source_fpath=source_fpath)
+        >>> assert exists(source_fpath + '.fingerprint.json')
+        >>> # The data is not hashed again while the file is unchanged
+        >>> fp2 = get_data_fingerprint(None, source_fpath=source_fpath)
+        >>> assert fp1 == fp2
+        >>> # Different lambdas are never confused with each other
+        >>> fp3 = get_data_fingerprint(dpts, lambda x: 'a', source_fpath=source_fpath)
+        >>> fp4 = get_data_fingerprint(dpts, lambda x: 'b', source_fpath=source_fpath)
+        >>> assert fp3 != fp4
+        >>> # The sample fingerprint depends on the dtype
+        >>> fp5 = get_data_fingerprint(dpts, 'sample')
+        >>> fp6 = get_data_fingerprint(dpts.view(np.int8), 'sample')
+        >>> assert fp5 != fp6
+    """
+    if content_id is not None:
+        return '%s(%s)' % (lbl, 'id=' + content_id)
+    if isinstance(fingerprint, six.string_types):
+        method = fingerprint
+        sidecar_key = method
+    else:
+        method = getattr(fingerprint, '__name__', 'custom')
+        qualname = getattr(fingerprint, '__qualname__', method)
+        sidecar_key = '%s.%s' % (getattr(fingerprint, '__module__', ''), qualname)
+        if '<' in qualname or not hasattr(fingerprint, '__name__'):
+            # <lambda> and <locals> names would collide in the sidecar
+            sidecar_key = None
+    use_sidecar = source_fpath is not None and sidecar_key is not None
+    if use_sidecar:
+        # Reuse the fingerprint from the last time this file was seen
+        fingerprints = _read_fingerprint_sidecar(source_fpath)
+        if sidecar_key in fingerprints:
+            return fingerprints[sidecar_key]
+    if fingerprint == 'full':
+        data_hashstr = ut.hashstr_arr27(data, lbl)
+    else:
+        if fingerprint == 'sample':
+            digest = _sample_digest(data)
+        elif fingerprint == 'chunked':
+            digest = _chunked_digest(data)
+        elif callable(fingerprint):
+            digest = fingerprint(data)
+        else:
+            raise ValueError('Unknown fingerprint=%r. Valid values are %r' % (
+                fingerprint, FINGERPRINT_METHODS))
+        shape_str = str(data.shape).replace(' ', '')
+        data_hashstr = '%s(%s%s=%s)' % (lbl, shape_str, method,
+                                        ut.hashstr27(digest))
+    if use_sidecar:
+        fingerprints = _read_fingerprint_sidecar(source_fpath)
+        fingerprints[sidecar_key] = data_hashstr
+        _write_fingerprint_sidecar(source_fpath, fingerprints)
+    return data_hashstr
+
+
 def get_flann_cfgstr(dpts, flann_params, cfgstr='', use_params_hash=True,
-                     use_data_hash=True):
+                     use_data_hash=True, fingerprint='full', content_id=None,
+                     source_fpath=None):
     """
+    fingerprint, content_id, and source_fpath determine how dpts is
+    identified (see get_data_fingerprint).
+
 
     CommandLine:
         python -m vtool.nearest_neighbors --test-get_flann_cfgstr
@@ -227,7 +428,8 @@ def get_flann_cfgstr(dpts, flann_params, cfgstr='', use_params_hash=True,
     # Generate a unique filename for dpts and flann parameters
     if use_data_hash:
         # flann is dependent on the dpts
-        data_hashstr = ut.hashstr_arr27(dpts, '_DPTS')
+        data_hashstr = get_data_fingerprint(dpts, fingerprint, content_id,
+                                            source_fpath, '_DPTS')
         flann_cfgstr += data_hashstr
     return flann_cfgstr
 
@@ -235,16 +437,22 @@ def get_flann_cfgstr(dpts, flann_params, cfgstr='', use_params_hash=True,
 #@ut.indent_func
 def get_flann_fpath(dpts, cache_dir='default', cfgstr='', flann_params={},
                     use_params_hash=True, use_data_hash=True, appname='vtool',
-                    verbose=True):
-    """ returns filepath for flann index """
+                    verbose=True, flann_cfgstr=None):
+    """
+    returns filepath for flann index
+
+    flann_cfgstr can be given if it has already been computed by
+    get_flann_cfgstr (which hashes dpts).
+    """
     if cache_dir == 'default':
         if verbose:
             print('[flann] using default cache dir')
         cache_dir = ut.get_app_resource_dir(appname)
         ut.ensuredir(cache_dir)
-    flann_cfgstr = get_flann_cfgstr(dpts, flann_params, cfgstr,
-                                    use_params_hash=use_params_hash,
-                                    use_data_hash=use_data_hash)
+    if flann_cfgstr is None:
+        flann_cfgstr = get_flann_cfgstr(dpts, flann_params, cfgstr,
+                                        use_params_hash=use_params_hash,
+                                        use_data_hash=use_data_hash)
     if verbose:
         print('...flann_cache cfgstr = %r: ' % flann_cfgstr)
     # Append any user labels
@@ -297,13 +505,182 @@ def build_flann_index(dpts, flann_params, verbose=True, flann=None):
     return flann
 
 
+class FlannLRUCache(ut.NiceRepr):
+    r"""
+    Process level least-recently-used cache of loaded FLANN indexes keyed on
+    their flann cfgstr (see get_flann_cfgstr).
+
+    Each index is charged the bytes given to put (see
+    estimate_flann_nbytes). Least recently used indexes are dropped once the
+    total exceeds max_bytes. Cached indexes are shared, so callers must not
+    add points to them.
+
+    An index put with its data can also be found with get_by_data, which
+    takes a key without the data hash and only matches the very same data
+    array, so a hit does not hash the data again.
+
+    CommandLine:
+        python -m vtool.nearest_neighbors --test-FlannLRUCache
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from vtool.nearest_neighbors import *  # NOQA
+        >>> lru = FlannLRUCache(max_bytes=100)
+        >>> lru.put('a', 'flann_a', 40)
+        >>> lru.put('b', 'flann_b', 40)
+        >>> assert lru.get('a') == 'flann_a'
+        >>> lru.put('c', 'flann_c', 40)  # evicts b
+        >>> assert lru.get('b') is None
+        >>> lru.put('d', 'flann_d', 400)  # too big to cache
+        >>> result = str(lru)
+        >>> print(result)
+        <FlannLRUCache(2 indexes, 80/100 bytes, hits=1, misses=1, evictions=1)>
+    """
+    def __init__(lru, max_bytes):
+        lru.max_bytes = max_bytes
+        lru.nbytes = 0
+        lru.hits = 0
+        lru.misses = 0
+        lru.evictions = 0
+        lru._cache = collections.OrderedDict()
+        # (data_key, id(data)) -> key of indexes put with their data
+        lru._data_keys = {}
+        lru._lock = threading.Lock()
+
+    def __nice__(lru):
+        return '%d indexes, %d/%d bytes, hits=%d, misses=%d, evictions=%d' % (
+            len(lru._cache), lru.nbytes, lru.max_bytes, lru.hits, lru.misses,
+            lru.evictions)
+
+    def __len__(lru):
+        return len(lru._cache)
+
+    def get(lru, key):
+        """ Returns the cached index (and marks it as recently used) or None """
+        with lru._lock:
+            return lru._get(key)
+
+    def get_by_data(lru, data_key, data):
+        """
+        Returns the index that was put with data_key and this exact data
+        object or None. The data must not have been modified in place since
+        (FLANN indexes refer to their points instead of copying them, so that
+        would break the index anyway). Misses are not counted because callers
+        fall back to get.
+        """
+        with lru._lock:
+            key = lru._data_keys.get((data_key, id(data)))
+            item = lru._cache.get(key) if key is not None else None
+            if item is None or item[2] is not data:
+                return None
+            return lru._get(key)
+
+    def _get(lru, key):
+        item = lru._cache.pop(key, None)
+        if item is None:
+            lru.misses += 1
+            return None
+        lru._cache[key] = item
+        lru.hits += 1
+        return item[0]
+
+    def put(lru, key, flann, nbytes, data=None, data_key=None):
+        """
+        Caches flann charging it nbytes. If data and data_key are given the
+        index can also be found with get_by_data(data_key, data).
+        """
+        with lru._lock:
+            lru._pop(key)
+            if nbytes > lru.max_bytes:
+                return
+            if data is not None and data_key is not None:
+                data_id = (data_key, id(data))
+                lru._data_keys[data_id] = key
+            else:
+                data, data_id = None, None
+            lru._cache[key] = (flann, nbytes, data, data_id)
+            lru.nbytes += nbytes
+            while lru.nbytes > lru.max_bytes:
+                lru._pop(next(iter(lru._cache)))
+                lru.evictions += 1
+
+    def _pop(lru, key):
+        item = lru._cache.pop(key, None)
+        if item is not None:
+            lru.nbytes -= item[1]
+            data_id = item[3]
+            if data_id is not None and lru._data_keys.get(data_id) == key:
+                del lru._data_keys[data_id]
+
+    def clear(lru):
+        with lru._lock:
+            lru._cache.clear()
+            lru._data_keys.clear()
+            lru.nbytes = 0
+
+    def get_stats(lru):
+        return {
+            'num_indexes': len(lru._cache),
+            'nbytes': lru.nbytes,
+            'max_bytes': lru.max_bytes,
+            'hits': lru.hits,
+            'misses': lru.misses,
+            'evictions': lru.evictions,
+        }
+
+
+def estimate_flann_nbytes(dpts, flann_params, flann_fpath=None):
+    """
+    Estimates the memory used by a FLANN index over dpts: the points plus
+    the index structure. The structure is measured by the size of the saved
+    index (which does not hold the points) when flann_fpath exists.
+    Otherwise a kdtree is assumed to hold two nodes of 32 bytes per point
+    per tree.
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from vtool.nearest_neighbors import *  # NOQA
+        >>> dpts = np.zeros((1000, 128), dtype=np.uint8)
+        >>> flann_params = {'algorithm': 'kdtree', 'trees': 8}
+        >>> result = ut.repr2((estimate_flann_nbytes(dpts, flann_params),
+        >>>                    estimate_flann_nbytes(dpts, {'algorithm': 'linear'})))
+        >>> print(result)
+        (640000, 128000)
+    """
+    if flann_fpath is not None and exists(flann_fpath):
+        index_nbytes = os.path.getsize(flann_fpath)
+    elif flann_params.get('algorithm', 'kdtree') == 'linear':
+        index_nbytes = 0
+    else:
+        num_trees = flann_params.get('trees', 4)
+        index_nbytes = num_trees * len(dpts) * 2 * 32
+    return dpts.nbytes + index_nbytes
+
+
+# Loaded indexes shared by calls to flann_cache(use_memcache=True) in this
+# process
+FLANN_MEMCACHE = FlannLRUCache(
+    max_bytes=ut.get_argval('--flann-memcache-bytes', type_=int, default=2 ** 30))
+
+
 #@ut.indent_func
 def flann_cache(dpts, cache_dir='default', cfgstr='', flann_params={},
                 use_cache=True, save=True, use_params_hash=True,
-                use_data_hash=True, appname='vtool', verbose=None):
+                use_data_hash=True, appname='vtool', verbose=None,
+                use_memcache=False, fingerprint='full', content_id=None,
+                source_fpath=None):
     """
     Tries to load a cached flann index before doing anything
     from vtool.nn
+
+    fingerprint, content_id, and source_fpath determine how dpts is
+    identified in the cache key (see get_data_fingerprint).
+
+    If use_memcache is True indexes are first looked up in the in-memory
+    FLANN_MEMCACHE, then on disk. Such indexes are shared between callers, so
+    they must only be queried and never modified (e.g. with add_points), and
+    dpts must not be modified in place while it is cached. Passing the same
+    dpts array again finds its index without hashing dpts.
     """
     if verbose is None:
         verbose = int(ut.NOT_QUIET)
@@ -314,10 +691,38 @@ def flann_cache(dpts, cache_dir='default', cfgstr='', flann_params={},
     if len(dpts) == 0:
         raise AssertionError(
             'cannot build flann when len(dpts) == 0. (prevents a segfault)')
+    use_memcache = use_memcache and use_cache
+    if use_memcache:
+        # Key of everything but the data, which is matched by identity
+        params_cfgstr = get_flann_cfgstr(dpts, flann_params, cfgstr,
+                                         use_params_hash=use_params_hash,
+                                         use_data_hash=False)
+        flann = FLANN_MEMCACHE.get_by_data(params_cfgstr, dpts)
+        if flann is not None:
+            if verbose > 0:
+                print('...flann memcache hit: %d vectors' % (len(dpts)))
+            if verbose > 1:
+                print('L___ END FLANN INDEX ')
+            return flann
+    flann_cfgstr = get_flann_cfgstr(dpts, flann_params, cfgstr,
+                                    use_params_hash=use_params_hash,
+                                    use_data_hash=use_data_hash,
+                                    fingerprint=fingerprint,
+                                    content_id=content_id,
+                                    source_fpath=source_fpath)
+    if use_memcache:
+        # The same data may be cached under another array
+        flann = FLANN_MEMCACHE.get(flann_cfgstr)
+        if flann is not None:
+            if verbose > 0:
+                print('...flann memcache hit: %d vectors' % (len(dpts)))
+            if verbose > 1:
+                print('L___ END FLANN INDEX ')
+            return flann
     flann_fpath = get_flann_fpath(dpts, cache_dir, cfgstr, flann_params,
                                   use_params_hash=use_params_hash,
                                   use_data_hash=use_data_hash, appname=appname,
-                                  verbose=verbose)
+                                  verbose=verbose, flann_cfgstr=flann_cfgstr)
     # Load the index if it exists
     flann = pyflann.FLANN()
     flann.flann_fpath = flann_fpath
@@ -328,6 +733,10 @@ def flann_cache(dpts, cache_dir='default', cfgstr='', flann_params={},
                 print('...flann cache hit: %d vectors' % (len(dpts)))
             if verbose > 1:
                 print('L___ END FLANN INDEX ')
+            if use_memcache:
+                nbytes = estimate_flann_nbytes(dpts, flann_params, flann_fpath)
+                FLANN_MEMCACHE.put(flann_cfgstr, flann, nbytes, dpts,
+                                   params_cfgstr)
             return flann
         except Exception as ex:
             ut.printex(ex, '... cannot load index', iswarning=True)
@@ -339,6 +748,10 @@ def flann_cache(dpts, cache_dir='default', cfgstr='', flann_params={},
         print('flann.save_index(%r)' % ut.path_ndir_split(flann_fpath, n=2))
     if save:
         flann.save_index(flann_fpath)
+    if use_memcache:
+        nbytes = estimate_flann_nbytes(dpts, flann_params,
+                                       flann_fpath if save else None)
+        FLANN_MEMCACHE.put(flann_cfgstr, flann, nbytes, dpts, params_cfgstr)
     if verbose > 1:
         print('L___ END CACHED FLANN INDEX ')
     return flann
@@ -347,6 +760,9 @@ def flann_cache(dpts, cache_dir='default', cfgstr='', flann_params={},
 def flann_augment(dpts, new_dpts, cache_dir, cfgstr, new_cfgstr, flann_params,
                   use_cache=True, save=True):
     """
+    Adds points to a cached index and saves the whole index under a new
+    name. See IncrementalFlannIndex to add points without rewriting it.
+
     Example:
         >>> # DISABLE_DOCTEST
         >>> from vtool.nearest_neighbors import *  # NOQA
@@ -360,7 +776,9 @@ def flann_augment(dpts, new_dpts, cache_dir, cfgstr, new_cfgstr, flann_params,
         >>> use_cache = False
         >>> save = False
     """
-    flann = flann_cache(dpts, cache_dir, cfgstr, flann_params)
+    # points are added, so the index cannot be shared through the memcache
+    flann = flann_cache(dpts, cache_dir, cfgstr, flann_params,
+                        use_memcache=False)
     flann.add_points(new_dpts)
     if save:
         aug_dpts = np.vstack((dpts, new_dpts))
@@ -370,6 +788,252 @@ def flann_augment(dpts, new_dpts, cache_dir, cfgstr, new_cfgstr, flann_params,
     return flann
 
 
+class IncrementalFlannIndex(ut.NiceRepr):
+    r"""
+    A FLANN index that grows without rewriting itself.
+
+    New points go into small delta indexes. Queries search the base index and
+    every delta and merge their nearest neighbors. Once the deltas hold more
+    than max_delta_frac of the base points (or there are more than
+    max_num_deltas of them) all segments are compacted into a new base index,
+    in a background thread if background_compact is True.
+
+    The index is persisted as a json manifest that lists the data (.npy) and
+    index (.flann) file of each segment, so adding points only writes the new
+    delta. Returned point indexes are positions in the concatenation of all
+    added points, and do not change when the index is compacted.
+
+    Args:
+        manifest_fpath (str): manifest location. Segment files are written
+            next to it. An existing manifest is loaded.
+        flann_params (dict): parameters of every segment index
+        max_delta_frac (float): compaction threshold on the delta size
+        max_num_deltas (int): compaction threshold on the number of deltas
+        background_compact (bool): compact in a background thread
+
+    CommandLine:
+        python -m vtool.nearest_neighbors --test-IncrementalFlannIndex
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from vtool.nearest_neighbors import *  # NOQA
+        >>> import vtool.tests.dummy as dummy
+        >>> dpath = ut.ensure_app_resource_dir('vtool', 'test_incremental_flann')
+        >>> ut.delete(dpath)
+        >>> manifest_fpath = join(ut.ensuredir(dpath), 'inc_index.json')
+        >>> flann_params = {'algorithm': 'linear'}
+        >>> inc = IncrementalFlannIndex(manifest_fpath, flann_params,
+        >>>                             max_delta_frac=.5, max_num_deltas=2)
+        >>> dpts = dummy.get_dummy_dpts(100)
+        >>> inc.add_points(dpts[0:70])
+        >>> inc.add_points(dpts[70:80])
+        >>> inc.add_points(dpts[80:90])
+        >>> before = (str(inc), inc.nn_index(dpts[[5, 75, 85]], 1)[0].tolist())
+        >>> inc.add_points(dpts[90:100])  # triggers compaction
+        >>> # the manifest can be reloaded
+        >>> inc2 = IncrementalFlannIndex(manifest_fpath, flann_params)
+        >>> idxs2, dists2 = inc2.nn_index(dpts[[5, 75, 85, 95]], 1)
+        >>> after = (str(inc), idxs2.tolist())
+        >>> result = ut.repr2([before, after], nl=1)
+        >>> print(result)
+        [
+            ('<IncrementalFlannIndex(num_dpts=90, num_segments=3)>', [5, 75, 85]),
+            ('<IncrementalFlannIndex(num_dpts=100, num_segments=1)>', [5, 75, 85, 95]),
+        ]
+
+    Example1:
+        >>> # ENABLE_DOCTEST
+        >>> from vtool.nearest_neighbors import *  # NOQA
+        >>> dpath = ut.ensure_app_resource_dir('vtool', 'test_incremental_flann')
+        >>> ut.delete(dpath)
+        >>> manifest_fpath = join(ut.ensuredir(dpath), 'empty_index.json')
+        >>> inc = IncrementalFlannIndex(manifest_fpath, {'algorithm': 'linear'})
+        >>> qpts = np.zeros((2, 128), dtype=np.uint8)
+        >>> try:
+        >>>     inc.nn_index(qpts, 1)
+        >>> except AssertionError as ex:
+        >>>     result = str(ex)
+        >>> print(result)
+        cannot query an IncrementalFlannIndex with no points
+    """
+    MANIFEST_VERSION = 1
+
+    def __init__(inc, manifest_fpath, flann_params=None, max_delta_frac=.1,
+                 max_num_deltas=8, background_compact=False, verbose=False):
+        if flann_params is None:
+            flann_params = get_kdtree_flann_params()
+        inc.manifest_fpath = manifest_fpath
+        inc.dpath = dirname(manifest_fpath)
+        inc.prefix = splitext(basename(manifest_fpath))[0]
+        inc.flann_params = flann_params
+        inc.max_delta_frac = max_delta_frac
+        inc.max_num_deltas = max_num_deltas
+        inc.background_compact = background_compact
+        inc.verbose = verbose
+        # list of dicts with keys name, dpts, and flann. The first is the base.
+        inc._segments = []
+        inc._next_segx = 0
+        inc._lock = threading.RLock()
+        inc._compact_thread = None
+        if exists(manifest_fpath):
+            inc._load()
+
+    def __nice__(inc):
+        return 'num_dpts=%d, num_segments=%d' % (inc.num_dpts,
+                                                 len(inc._segments))
+
+    @property
+    def num_dpts(inc):
+        return sum(len(seg['dpts']) for seg in inc._segments)
+
+    def _segment_fpaths(inc, name):
+        dpts_fpath = join(inc.dpath, name + '.npy')
+        flann_fpath = join(inc.dpath, name + '.flann')
+        return dpts_fpath, flann_fpath
+
+    def _new_segment(inc, dpts):
+        """ builds and saves the index of a new segment """
+        with inc._lock:
+            name = '%s_seg%04d' % (inc.prefix, inc._next_segx)
+            inc._next_segx += 1
+        dpts_fpath, flann_fpath = inc._segment_fpaths(name)
+        flann = build_flann_index(dpts, inc.flann_params, verbose=inc.verbose)
+        np.save(dpts_fpath, dpts)
+        flann.save_index(flann_fpath)
+        return {'name': name, 'dpts': dpts, 'flann': flann}
+
+    def _delete_segment(inc, seg):
+        for fpath in inc._segment_fpaths(seg['name']):
+            if exists(fpath):
+                os.remove(fpath)
+
+    def _save_manifest(inc):
+        manifest = {
+            'version': inc.MANIFEST_VERSION,
+            'flann_params': inc.flann_params,
+            'next_segx': inc._next_segx,
+            'segments': [{'name': seg['name'], 'num_dpts': len(seg['dpts'])}
+                         for seg in inc._segments],
+        }
+        # replace the manifest atomically so readers never see a partial one
+        tmp_fpath = inc.manifest_fpath + '.%d.tmp' % (os.getpid(),)
+        with open(tmp_fpath, 'w') as file_:
+            json.dump(manifest, file_, indent=4)
+        if ut.WIN32 and exists(inc.manifest_fpath):
+            os.remove(inc.manifest_fpath)
+        os.rename(tmp_fpath, inc.manifest_fpath)
+
+    def _load(inc):
+        with open(inc.manifest_fpath, 'r') as file_:
+            manifest = json.load(file_)
+        assert manifest['version'] == inc.MANIFEST_VERSION, (
+            'unknown manifest version %r' % (manifest['version'],))
+        segments = []
+        for seg_info in manifest['segments']:
+            name = seg_info['name']
+            dpts_fpath, flann_fpath = inc._segment_fpaths(name)
+            dpts = np.load(dpts_fpath)
+            flann = pyflann.FLANN()
+            flann.load_index(flann_fpath, dpts)
+            segments.append({'name': name, 'dpts': dpts, 'flann': flann})
+        inc.flann_params = manifest['flann_params']
+        inc._next_segx = manifest['next_segx']
+        inc._segments = segments
+
+    def add_points(inc, new_dpts):
+        """ Indexes new_dpts in a new delta segment (compacts if needed) """
+        new_dpts = np.ascontiguousarray(new_dpts)
+        if len(new_dpts) == 0:
+            return
+        seg = inc._new_segment(new_dpts)
+        with inc._lock:
+            inc._segments.append(seg)
+            inc._save_manifest()
+        if inc.needs_compaction():
+            inc.compact(background=inc.background_compact)
+
+    def needs_compaction(inc):
+        with inc._lock:
+            if len(inc._segments) < 2:
+                return False
+            num_base = len(inc._segments[0]['dpts'])
+            deltas = inc._segments[1:]
+        num_delta = sum(len(seg['dpts']) for seg in deltas)
+        return (len(deltas) > inc.max_num_deltas or
+                num_delta > inc.max_delta_frac * num_base)
+
+    def compact(inc, background=False):
+        """ Merges all current segments into a new base segment """
+        with inc._lock:
+            if inc._compact_thread is not None and inc._compact_thread.is_alive():
+                return
+            segments = list(inc._segments)
+            if len(segments) < 2:
+                return
+            if background:
+                inc._compact_thread = threading.Thread(
+                    target=inc._compact, args=(segments,))
+                inc._compact_thread.daemon = True
+                inc._compact_thread.start()
+                return
+        inc._compact(segments)
+
+    def _compact(inc, segments):
+        if inc.verbose:
+            print('[flann] compacting %d segments' % (len(segments),))
+        all_dpts = np.vstack([seg['dpts'] for seg in segments])
+        new_base = inc._new_segment(all_dpts)
+        with inc._lock:
+            # points added while compacting stay in their own segments
+            num_old = len(segments)
+            inc._segments = [new_base] + inc._segments[num_old:]
+            inc._save_manifest()
+        for seg in segments:
+            inc._delete_segment(seg)
+
+    def wait_for_compaction(inc):
+        thread = inc._compact_thread
+        if thread is not None:
+            thread.join()
+
+    def nn_index(inc, qpts, num_neighbors, **kwargs):
+        """
+        Queries every segment and merges the results. Same interface as
+        pyflann.FLANN.nn_index.
+
+        Returns:
+            tuple: (idxs, dists)
+        """
+        with inc._lock:
+            segments = list(inc._segments)
+        if len(segments) == 0:
+            raise AssertionError(
+                'cannot query an IncrementalFlannIndex with no points')
+        num_qpts = len(qpts)
+        idxs_list = []
+        dists_list = []
+        offset = 0
+        for seg in segments:
+            num_seg_dpts = len(seg['dpts'])
+            seg_k = min(num_neighbors, num_seg_dpts)
+            seg_idxs, seg_dists = seg['flann'].nn_index(qpts, seg_k, **kwargs)
+            idxs_list.append(np.reshape(seg_idxs, (num_qpts, seg_k)) + offset)
+            dists_list.append(np.reshape(seg_dists, (num_qpts, seg_k)))
+            offset += num_seg_dpts
+        idxs = np.hstack(idxs_list)
+        dists = np.hstack(dists_list)
+        # keep the num_neighbors closest results over all segments
+        sortx = dists.argsort(axis=1, kind='mergesort')[:, 0:num_neighbors]
+        rowx = np.arange(num_qpts)[:, None]
+        idxs = idxs[rowx, sortx]
+        dists = dists[rowx, sortx]
+        if num_neighbors == 1:
+            # pyflann returns flat arrays for a single neighbor
+            idxs = idxs.ravel()
+            dists = dists.ravel()
+        return idxs, dists
+
+
 def get_kdtree_flann_params():
     flann_params = {
         'algorithm': 'kdtree',
@@ -27,6 +27,7 @@ Notes:
 """
 from __future__ import absolute_import, division, print_function
 from six.moves import range
+import time
 import warnings  # NOQA
 import six  # NOQA
 import utool as ut
@@ -494,6 +495,83 @@ def _test_hypothesis_inliers(Aff, invVR1s_m, xy2_m, det2_m, ori2_m,
     return hypo_inliers, hypo_errors
 
 
+@profile
+def _test_hypothesis_inliers_xyfilter(Aff, invVR1s_m, xy1_m, xy2_m, det2_m,
+                                      ori2_m, xy_thresh_sqrd,
+                                      scale_thresh_sqrd, ori_thresh):
+    """
+    Finds the same inliers as _test_hypothesis_inliers, but only computes
+    scale and orientation errors for matches inside the xy radius. Projecting
+    the keypoint centers is much cheaper than projecting the full keypoint
+    shapes, and usually only a small fraction of the matches pass the xy
+    test. Errors are not returned.
+
+    Returns:
+        ndarray: hypo_inliers
+
+    CommandLine:
+        python -m vtool.spatial_verification --test-_test_hypothesis_inliers_xyfilter
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from vtool.spatial_verification import *  # NOQA
+        >>> from vtool.spatial_verification import _test_hypothesis_inliers  # NOQA
+        >>> from vtool.spatial_verification import _test_hypothesis_inliers_xyfilter  # NOQA
+        >>> from vtool.spatial_verification import _affine_hypothesis_setup  # NOQA
+        >>> import vtool.tests.dummy as dummy
+        >>> kpts1, kpts2 = dummy.get_dummy_kpts_pair((100, 100))
+        >>> fm = dummy.make_dummy_fm(len(kpts1)).astype(np.int32)
+        >>> xy_thresh_sqrd = ktool.KPTS_DTYPE(50)
+        >>> scale_thresh_sqrd = ktool.KPTS_DTYPE(2)
+        >>> ori_thresh = ktool.KPTS_DTYPE(TAU / 4)
+        >>> setup = _affine_hypothesis_setup(kpts1, kpts2, fm)
+        >>> invVR1s_m, Aff_mats, xy1_m, xy2_m, det2_m, ori2_m = setup
+        >>> threshs = (xy_thresh_sqrd, scale_thresh_sqrd, ori_thresh)
+        >>> for Aff in Aff_mats:
+        >>>     inliers1 = _test_hypothesis_inliers(
+        >>>         Aff, invVR1s_m, xy2_m, det2_m, ori2_m, *threshs)[0]
+        >>>     inliers2 = _test_hypothesis_inliers_xyfilter(
+        >>>         Aff, invVR1s_m, xy1_m, xy2_m, det2_m, ori2_m, *threshs)
+        >>>     assert np.all(inliers1 == inliers2)
+    """
+    # Map keypoint centers from image 1 onto image 2
+    xy1_mt = Aff[0:2, 0:2].dot(xy1_m) + Aff[0:2, 2:3]
+    xy_err = dtool.L2_sqrd(xy2_m.T, xy1_mt.T, dtype=SV_DTYPE)
+    candxs = np.where(np.less(xy_err, xy_thresh_sqrd))[0]
+    # Only map the full shapes of the candidates
+    invVR1s_mt = matrix_multiply(Aff, invVR1s_m.take(candxs, axis=0))
+    _det1_mt  = ktool.get_invVR_mats_sqrd_scale(invVR1s_mt)
+    _ori1_mt  = ktool.get_invVR_mats_oris(invVR1s_mt)
+    scale_err = dtool.det_distance(_det1_mt, det2_m.take(candxs))
+    ori_err   = dtool.ori_distance(_ori1_mt, ori2_m.take(candxs))
+    cand_flag = np.less(scale_err, scale_thresh_sqrd)
+    np.logical_and(cand_flag, np.less(ori_err, ori_thresh), out=cand_flag)
+    hypo_inliers = candxs.compress(cand_flag)
+    return hypo_inliers
+
+
+def _affine_hypothesis_setup(kpts1, kpts2, fm):
+    """
+    Precomputes what is needed to test every affine hypothesis (the same
+    setup as get_affine_inliers).
+
+    Returns:
+        tuple: (invVR1s_m, Aff_mats, xy1_m, xy2_m, det2_m, ori2_m)
+    """
+    kpts1_m = kpts1.take(fm.T[0], axis=0)
+    kpts2_m = kpts2.take(fm.T[1], axis=0)
+    invVR2s_m = ktool.get_invVR_mats3x3(kpts2_m)
+    invVR1s_m = ktool.get_invVR_mats3x3(kpts1_m)
+    RV1s_m    = ktool.invert_invV_mats(invVR1s_m)
+    # The transform from kp1 to kp2 for every hypothesis
+    Aff_mats = matrix_multiply(invVR2s_m, RV1s_m)
+    xy1_m  = ktool.get_invVR_mats_xys(invVR1s_m)
+    xy2_m  = ktool.get_xys(kpts2_m)
+    det2_m = ktool.get_sqrd_scales(kpts2_m)
+    ori2_m = ktool.get_oris(kpts2_m)
+    return invVR1s_m, Aff_mats, xy1_m, xy2_m, det2_m, ori2_m
+
+
 @profile
 def get_affine_inliers(kpts1, kpts2, fm, fs,
                         xy_thresh_sqrd,
@@ -606,28 +684,257 @@ def get_best_affine_inliers(kpts1, kpts2, fm, fs, xy_thresh_sqrd, scale_thresh,
     # Test each affine hypothesis
     # get list if inliers, errors, the affine matrix for each hypothesis
     if HAVE_SVER_C_WRAPPER and not forcepy:
-        aff_inliers_list, aff_errors_list, Aff_mats = sver_c_wrapper.get_affine_inliers_cpp(
-            kpts1, kpts2, fm, fs, xy_thresh_sqrd, scale_thresh, ori_thresh)
-    else:
-        aff_inliers_list, aff_errors_list, Aff_mats = get_affine_inliers(kpts1, kpts2,
-                                                                         fm, fs,
-                                                                         xy_thresh_sqrd,
-                                                                         scale_thresh,
-                                                                         ori_thresh)
-
-    #ut.embed()
-    # Determine the best hypothesis using the number of inliers
-    # TODO: other measures in the error lists could be used as well
-    #nInliers_list = np.array([len(inliers) for inliers in aff_inliers_list])
-
-    weight_list = np.array([fs.take(inliers).sum() for inliers in aff_inliers_list])
-    #ut.embed()
+        aff_inliers_list, aff_errors_list, Aff_mats, _, weight_list = (
+            sver_c_wrapper.get_affine_inliers_cpp(
+                kpts1, kpts2, fm, fs, xy_thresh_sqrd, scale_thresh, ori_thresh))
+        # Determine the best hypothesis using the number of inliers
+        # TODO: other measures in the error lists could be used as well
+        best_index = weight_list.argmax()
+        aff_inliers = aff_inliers_list[best_index]
+        aff_errors = aff_errors_list[best_index]
+        Aff = Aff_mats[best_index]
+        return aff_inliers, aff_errors, Aff
+    # Only the weight of each hypothesis is needed to pick the best one. The
+    # errors are computed for the winner afterwords.
+    setup = _affine_hypothesis_setup(kpts1, kpts2, fm)
+    invVR1s_m, Aff_mats, xy1_m, xy2_m, det2_m, ori2_m = setup
+    weight_list = np.array([
+        fs.take(_test_hypothesis_inliers_xyfilter(
+            Aff, invVR1s_m, xy1_m, xy2_m, det2_m, ori2_m, xy_thresh_sqrd,
+            scale_thresh, ori_thresh)).sum()
+        for Aff in Aff_mats])
     #sortx = weight_list.argsort()[::-1]  # sort by non-inliers
     #best_index = sortx[0]  # chose best
     best_index = weight_list.argmax()
-    aff_inliers = aff_inliers_list[best_index]
-    aff_errors = aff_errors_list[best_index]
     Aff = Aff_mats[best_index]
+    aff_inliers, aff_errors = _test_hypothesis_inliers(
+        Aff, invVR1s_m, xy2_m, det2_m, ori2_m, xy_thresh_sqrd, scale_thresh,
+        ori_thresh)
+    return aff_inliers, aff_errors, Aff
+
+
+# Valid values of the hypo_mode option of spatially_verify_kpts
+HYPO_MODES = ['exhaustive', 'sorted', 'prosac']
+
+
+def affine_hypothesis_weight_bounds(kpts1_m, kpts2_m, fs, scale_thresh):
+    r"""
+    Upper bounds on the inlier weight of each affine hypothesis.
+
+    The scale test is symmetric: hypothesis i maps the squared scale of match
+    j to det1_j * (det2_i / det1_i), so the scale error is the ratio of r_i and
+    r_j, where r = det2 / det1. A match can only be an inlier of hypothesis i
+    if |log(r_i) - log(r_j)| < log(scale_thresh), so the weight of hypothesis i
+    is at most the sum of fs over that window. All bounds are computed with a
+    single sort and a cumulative sum.
+
+    Args:
+        kpts1_m (ndarray): matching keypoints in image 1
+        kpts2_m (ndarray): matching keypoints in image 2
+        fs (ndarray): non-negative match weights
+        scale_thresh (float):
+
+    Returns:
+        ndarray: weight_bounds
+
+    CommandLine:
+        python -m vtool.spatial_verification --test-affine_hypothesis_weight_bounds
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from vtool.spatial_verification import *  # NOQA
+        >>> import vtool.tests.dummy as dummy
+        >>> kpts1, kpts2 = dummy.get_dummy_kpts_pair((100, 100))
+        >>> fm = dummy.make_dummy_fm(len(kpts1)).astype(np.int32)
+        >>> fs = np.ones(len(fm), dtype=np.float64)
+        >>> kpts1_m = kpts1.take(fm.T[0], axis=0)
+        >>> kpts2_m = kpts2.take(fm.T[1], axis=0)
+        >>> scale_thresh = 2.0
+        >>> bounds = affine_hypothesis_weight_bounds(kpts1_m, kpts2_m, fs, scale_thresh)
+        >>> # The bounds must never be smaller than the true weights
+        >>> aff_inliers_list = get_affine_inliers(kpts1, kpts2, fm, fs, 1E9,
+        >>>                                       scale_thresh, TAU)[0]
+        >>> weights = np.array([fs.take(inliers).sum() for inliers in aff_inliers_list])
+        >>> assert np.all(weights <= bounds)
+        >>> result = ut.repr2(bounds.tolist())
+        >>> print(result)
+        [9.0, 9.0, 8.0, 7.0, 9.0, 7.0, 9.0, 9.0, 8.0]
+    """
+    det1_m = ktool.get_sqrd_scales(kpts1_m)
+    det2_m = ktool.get_sqrd_scales(kpts2_m)
+    log_ratios = np.log(det2_m.astype(np.float64)) - np.log(det1_m)
+    # Pad the window slightly so floating point error keeps the bound valid
+    radius = max(np.log(scale_thresh), 0) + 1E-9
+    sortx = log_ratios.argsort()
+    sorted_ratios = log_ratios.take(sortx)
+    cumsum_fs = np.zeros(len(fs) + 1, dtype=np.float64)
+    np.cumsum(fs.take(sortx), out=cumsum_fs[1:])
+    lowx = np.searchsorted(sorted_ratios, sorted_ratios - radius, side='left')
+    highx = np.searchsorted(sorted_ratios, sorted_ratios + radius, side='right')
+    weight_bounds = np.empty(len(fs), dtype=np.float64)
+    weight_bounds[sortx] = cumsum_fs.take(highx) - cumsum_fs.take(lowx)
+    return weight_bounds
+
+
+def get_hypothesis_order(fs, hypo_mode='sorted', rng_seed=0):
+    r"""
+    Order in which to test affine hypotheses.
+
+    Args:
+        fs (ndarray): match weights
+        hypo_mode (str): 'sorted' tests hypotheses by decreasing match score.
+            'prosac' is the randomized PROSAC-like variant: each hypothesis is
+            drawn from a window of the score ranking that grows as sampling
+            progresses, so good matches are tried first without being a
+            strict function of the scores.
+        rng_seed (int): seed for the 'prosac' mode
+
+    Returns:
+        ndarray: hypo_order
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from vtool.spatial_verification import *  # NOQA
+        >>> fs = np.array([.1, .9, .5, .3, .7, .2, .8, .4, .6, 0])
+        >>> order1 = get_hypothesis_order(fs, 'prosac', rng_seed=0)
+        >>> order2 = get_hypothesis_order(fs, 'prosac', rng_seed=0)
+        >>> assert np.all(order1 == order2), 'must be deterministic'
+        >>> assert sorted(order1.tolist()) == list(range(len(fs)))
+        >>> result = ut.repr2(get_hypothesis_order(fs, 'sorted').tolist())
+        >>> print(result)
+        [1, 6, 4, 8, 2, 7, 3, 5, 0, 9]
+    """
+    # stable sort by decreasing score
+    sortx = np.argsort(-fs, kind='mergesort')
+    if hypo_mode == 'sorted':
+        hypo_order = sortx
+    elif hypo_mode == 'prosac':
+        rng = np.random.RandomState(rng_seed)
+        ranks = np.arange(len(fs))
+        # the rank r hypothesis is drawn from a window that has grown to
+        # roughly 2 * r hypotheses
+        sample_keys = ranks + rng.rand(len(fs)) * (ranks + 1)
+        hypo_order = sortx.take(np.argsort(sample_keys, kind='mergesort'))
+    else:
+        raise NotImplementedError('[vtool] Unknown hypo_mode=%r' % (hypo_mode,))
+    return hypo_order
+
+
+@profile
+def get_best_affine_inliers_bounded(kpts1, kpts2, fm, fs, xy_thresh_sqrd,
+                                    scale_thresh, ori_thresh,
+                                    hypo_mode='sorted', max_hypotheses=None,
+                                    time_budget=None, confidence=None,
+                                    rng_seed=0, verbose=False):
+    r"""
+    Finds the best affine hypothesis without always testing every one.
+
+    Hypotheses are tested in the order given by get_hypothesis_order and
+    testing stops as soon as one of the following holds:
+        * the best weight cannot be beaten by any remaining hypothesis (see
+          affine_hypothesis_weight_bounds). Hypotheses that cannot beat the
+          current best are skipped.
+        * max_hypotheses hypotheses have been tested
+        * time_budget seconds have elapsed
+        * (if confidence is given) the RANSAC probability of not yet having
+          tested an inlier hypothesis drops below 1 - confidence
+
+    Only the first stopping rule is exact. With no budgets this returns a
+    hypothesis with the same weight as get_best_affine_inliers.
+
+    Args:
+        kpts1 (ndarray[ndim=2]): all keypoints in image 1
+        kpts2 (ndarray[ndim=2]): all keypoints in image 2
+        fm (ndarray[ndim=2]): matching keypoint indexes
+        fs (ndarray): non-negative match weights
+        xy_thresh_sqrd (float):
+        scale_thresh (float):
+        ori_thresh (float):
+        hypo_mode (str): 'sorted' or 'prosac' (see get_hypothesis_order)
+        max_hypotheses (int): maximum number of hypotheses to test
+        time_budget (float): maximum number of seconds to spend testing
+        confidence (float): probability of early RANSAC-style termination
+        rng_seed (int): seed for hypo_mode='prosac'
+
+    Returns:
+        tuple: (aff_inliers, aff_errors, Aff)
+
+    CommandLine:
+        python -m vtool.spatial_verification --test-get_best_affine_inliers_bounded
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from vtool.spatial_verification import *  # NOQA
+        >>> import vtool.tests.dummy as dummy
+        >>> kpts1, kpts2 = dummy.get_dummy_kpts_pair((100, 100))
+        >>> fm = dummy.make_dummy_fm(len(kpts1)).astype(np.int32)
+        >>> rng = np.random.RandomState(0)
+        >>> fs = rng.rand(len(fm))
+        >>> xy_thresh_sqrd = ktool.KPTS_DTYPE(50)
+        >>> scale_thresh = ktool.KPTS_DTYPE(2)
+        >>> ori_thresh = ktool.KPTS_DTYPE(TAU / 4)
+        >>> args = (kpts1, kpts2, fm, fs, xy_thresh_sqrd, scale_thresh, ori_thresh)
+        >>> aff_inliers1, aff_errors1, Aff1 = get_best_affine_inliers(*args, forcepy=True)
+        >>> for hypo_mode in ['sorted', 'prosac']:
+        >>>     aff_inliers2, aff_errors2, Aff2 = get_best_affine_inliers_bounded(
+        >>>         *args, hypo_mode=hypo_mode)
+        >>>     assert fs.take(aff_inliers1).sum() == fs.take(aff_inliers2).sum()
+        >>> aff_inliers3 = get_best_affine_inliers_bounded(*args, max_hypotheses=1)[0]
+        >>> result = ut.repr2((aff_inliers1.tolist(), aff_inliers3.tolist()))
+        >>> print(result)
+        ([1, 4, 5, 8], [8])
+    """
+    kpts1_m = kpts1.take(fm.T[0], axis=0)
+    kpts2_m = kpts2.take(fm.T[1], axis=0)
+    setup = _affine_hypothesis_setup(kpts1, kpts2, fm)
+    invVR1s_m, Aff_mats, xy1_m, xy2_m, det2_m, ori2_m = setup
+
+    num_matches = len(fm)
+    weight_bounds = affine_hypothesis_weight_bounds(kpts1_m, kpts2_m, fs,
+                                                    scale_thresh)
+    hypo_order = get_hypothesis_order(fs, hypo_mode, rng_seed)
+    # The best weight any hypothesis at or after each position can achieve
+    remain_bounds = np.maximum.accumulate(
+        weight_bounds.take(hypo_order)[::-1])[::-1]
+
+    best_weight = -np.inf
+    best_hypox = None
+    best_num_inliers = 0
+    num_tested = 0
+    start_time = time.time()
+    for count, hypox in enumerate(hypo_order):
+        if remain_bounds[count] <= best_weight:
+            if verbose:
+                print('[sver] no remaining hypothesis can do better')
+            break
+        if weight_bounds[hypox] <= best_weight:
+            continue
+        if best_hypox is not None:
+            # Always test at least one hypothesis
+            if max_hypotheses is not None and num_tested >= max_hypotheses:
+                break
+            if time_budget is not None and time.time() - start_time > time_budget:
+                break
+        hypo_inliers = _test_hypothesis_inliers_xyfilter(
+            Aff_mats[hypox], invVR1s_m, xy1_m, xy2_m, det2_m, ori2_m,
+            xy_thresh_sqrd, scale_thresh, ori_thresh)
+        num_tested += 1
+        weight = fs.take(hypo_inliers).sum()
+        if weight > best_weight:
+            best_weight = weight
+            best_hypox = hypox
+            best_num_inliers = len(hypo_inliers)
+        if confidence is not None:
+            # Chance that all tested hypotheses were outliers
+            inlier_frac = best_num_inliers / num_matches
+            if (1 - inlier_frac) ** num_tested <= 1 - confidence:
+                break
+    if verbose:
+        print('[sver] tested %d / %d hypotheses' % (num_tested, num_matches))
+    Aff = Aff_mats[best_hypox]
+    aff_inliers, aff_errors = _test_hypothesis_inliers(
+        Aff, invVR1s_m, xy2_m, det2_m, ori2_m, xy_thresh_sqrd, scale_thresh,
+        ori_thresh)
     return aff_inliers, aff_errors, Aff
 
 
@@ -887,11 +1194,15 @@ def test_affine_errors(H, kpts1, kpts2, fm, xy_thresh_sqrd, scale_thresh_sqrd,
 @profile
 def refine_inliers(kpts1, kpts2, fm, aff_inliers, xy_thresh_sqrd,
                    scale_thresh=2.0, ori_thresh=1.57, full_homog_checks=True,
-                   refine_method='homog'):
+                   refine_method='homog', forcepy=False, workspace=None):
     """
     Given a set of hypothesis inliers, computes a homography and refines inliers
     returned homography maps image1 space into image2 space
 
+    The 'homog' and 'affine' refine methods run natively (see
+    sver_c_wrapper.refine_inliers_cpp) unless forcepy is True. The native
+    version reuses the buffers of workspace (an SverWorkspace) if given.
+
     CommandLine:
         python -m vtool.spatial_verification --test-refine_inliers
         python -m vtool.spatial_verification --test-refine_inliers:0
@@ -934,6 +1245,16 @@ def refine_inliers(kpts1, kpts2, fm, aff_inliers, xy_thresh_sqrd,
         >>> ut.show_if_requested()
 
     """
+    if (HAVE_SVER_C_WRAPPER and not forcepy and
+         refine_method in sver_c_wrapper.REFINE_METHOD_CODES):
+        homog_tup1 = sver_c_wrapper.refine_inliers_cpp(
+            kpts1, kpts2, fm, aff_inliers, xy_thresh_sqrd, scale_thresh,
+            ori_thresh, full_homog_checks, refine_method=refine_method,
+            workspace=workspace)
+        return homog_tup1
+    # (no-op unless spatially_verify_kpts used precision='float32')
+    kpts1 = kpts1.astype(np.float64, casting='same_kind', copy=False)
+    kpts2 = kpts2.astype(np.float64, casting='same_kind', copy=False)
     H = estimate_refined_transform(kpts1, kpts2, fm, aff_inliers,
                                    refine_method=refine_method)
     if refine_method.endswith('homog'):
@@ -948,11 +1269,101 @@ def refine_inliers(kpts1, kpts2, fm, aff_inliers, xy_thresh_sqrd,
     return homog_tup1
 
 
+class SverWorkspace(ut.NiceRepr):
+    r"""
+    Growable scratch buffers for spatial verification.
+
+    Passing the same workspace to repeated calls of spatially_verify_kpts
+    (or to the functions in sver_c_wrapper) reuses the output buffers, so a
+    worker stops allocating once it has seen its largest number of matches.
+
+    Arrays returned by a call that used a workspace may be views into it and
+    are overwritten by the next call using the same workspace. Copy them if
+    they need to live longer. A workspace must not be shared between threads.
+
+    CommandLine:
+        python -m vtool.spatial_verification --test-SverWorkspace
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from vtool.spatial_verification import *  # NOQA
+        >>> workspace = SverWorkspace()
+        >>> errors1 = workspace.get('errors', (3, 10), np.float64)
+        >>> errors2 = workspace.get('errors', (3, 5), np.float64)
+        >>> fm = workspace.asarray('fm', np.zeros((4, 2), np.int32), np.int64)
+        >>> assert np.may_share_memory(errors1, errors2)
+        >>> assert errors2.shape == (3, 5) and fm.dtype == np.int64
+        >>> result = str(workspace)
+        >>> print(result)
+        <SverWorkspace(nbytes=304, num_allocs=2)>
+    """
+    def __init__(workspace):
+        workspace._buffers = {}
+        workspace.num_allocs = 0
+
+    def __nice__(workspace):
+        return 'nbytes=%d, num_allocs=%d' % (workspace.nbytes,
+                                             workspace.num_allocs)
+
+    @property
+    def nbytes(workspace):
+        return sum(buf.nbytes for buf in workspace._buffers.values())
+
+    def get(workspace, key, shape, dtype):
+        """
+        Returns an uninitialized C-contiguous array with shape and dtype backed
+        by the buffer named key.
+        """
+        dtype = np.dtype(dtype)
+        size = int(np.prod(shape))
+        buf = workspace._buffers.get((key, dtype), None)
+        if buf is None or len(buf) < size:
+            # grow geometrically so slowly increasing sizes rarely reallocate
+            new_size = size if buf is None else max(size, 2 * len(buf))
+            buf = np.empty(new_size, dtype=dtype)
+            workspace._buffers[(key, dtype)] = buf
+            workspace.num_allocs += 1
+        return buf[:size].reshape(shape)
+
+    def asarray(workspace, key, arr, dtype):
+        """
+        Like np.ascontiguousarray, but a conversion is copied into the buffer
+        named key instead of a new array.
+        """
+        if arr.dtype == dtype and arr.flags.c_contiguous:
+            return arr
+        out = workspace.get(key, arr.shape, dtype)
+        out[...] = arr
+        return out
+
+    def clear(workspace):
+        """ Releases all buffers """
+        workspace._buffers.clear()
+
+
 def get_best_affine_inliers_(kpts1, kpts2, fm, fs, xy_thresh_sqrd,
-                             scale_thresh, ori_thresh):
-    if HAVE_SVER_C_WRAPPER:
+                             scale_thresh, ori_thresh, hypo_mode='exhaustive',
+                             hypo_kw=None, precision='float64',
+                             workspace=None):
+    """
+    hypo_mode='exhaustive' tests every hypothesis (natively if possible).
+    Other modes use get_best_affine_inliers_bounded with the options in
+    hypo_kw. precision and workspace are only used by the native exhaustive
+    search.
+    """
+    if hypo_mode not in HYPO_MODES:
+        raise ValueError('Unknown hypo_mode=%r. Valid values are %r' % (
+            hypo_mode, HYPO_MODES))
+    if hypo_mode != 'exhaustive':
+        if hypo_kw is None:
+            hypo_kw = {}
+        aff_inliers, aff_errors, Aff = get_best_affine_inliers_bounded(
+            kpts1, kpts2, fm, fs, xy_thresh_sqrd, scale_thresh, ori_thresh,
+            hypo_mode=hypo_mode, **hypo_kw)
+    elif HAVE_SVER_C_WRAPPER:
         aff_inliers, aff_errors, Aff = sver_c_wrapper.get_best_affine_inliers_cpp(
-            kpts1, kpts2, fm, fs, xy_thresh_sqrd, scale_thresh, ori_thresh)
+            kpts1, kpts2, fm, fs, xy_thresh_sqrd, scale_thresh, ori_thresh,
+            precision=precision, workspace=workspace)
     else:
         if ut.NOT_QUIET:
             print('WARNING: sver has not been compiled')
@@ -961,6 +1372,74 @@ def get_best_affine_inliers_(kpts1, kpts2, fm, fs, xy_thresh_sqrd,
     return aff_inliers, aff_errors, Aff
 
 
+def _refine_affine_hypothesis(kpts1, kpts2, fm, aff_inliers, aff_errors, Aff,
+                              xy_thresh_sqrd, scale_thresh, ori_thresh,
+                              min_nInliers, returnAff, full_homog_checks,
+                              refine_method, workspace=None):
+    """
+    Second half of spatially_verify_kpts. Checks that the best affine
+    hypothesis has enough inliers and refines it.
+
+    Returns:
+        tuple : svtup or None
+    """
+    # Return if there are not enough inliers to compute homography
+    if len(aff_inliers) < min_nInliers:
+        # Test user defined param
+        if VERBOSE_SVER:
+            print('[sver] Failed spatial verification len(aff_inliers) = %r' %
+                  (len(aff_inliers),))
+        svtup = None
+        return svtup
+    if ((refine_method.endswith('homog') and len(aff_inliers) < 7) or
+         len(aff_inliers) < 4):
+        # Test fundamental param
+        # need to have 4 or more inliers to comopute an affine
+        # and need at least 7 to compute a homography
+        if VERBOSE_SVER:
+            print('[sver] Failed spatial verification len(aff_inliers) = %r' %
+                  (len(aff_inliers),))
+        svtup = None
+        return svtup
+    # Refine inliers using a projective transformation (homography)
+    try:
+        refined_inliers, refined_errors, H = refine_inliers(
+            kpts1, kpts2, fm, aff_inliers, xy_thresh_sqrd, scale_thresh,
+            ori_thresh, full_homog_checks, refine_method=refine_method,
+            workspace=workspace)
+        #print(refined_inliers)
+    except npl.LinAlgError as ex:
+        if ut.VERYVERBOSE and ut.SUPER_STRICT:
+            ut.printex(ex, 'numeric error in homog estimation.', iswarning=True)
+        return None
+    except ValueError:
+        if ut.VERYVERBOSE and ut.SUPER_STRICT:
+            ut.printex(ex, 'error cv2 in homog estimation.', iswarning=True)
+        return None
+    except IndexError:
+        raise
+    except Exception as ex:
+        # There is a weird error that starts with MemoryError and ends up
+        # makeing len(h) = 6.
+        ut.printex(ex, 'Unknown error in homog estimation.',
+                      keys=['kpts1', 'kpts2',  'fm', 'fm.shape', 'kpts1.shape',
+                            (len, 'aff_inliers'),
+                            'kpts2.shape', 'xy_thresh_sqrd', 'scale_thresh',
+                            'min_nInliers'])
+        if ut.SUPER_STRICT:
+            print('SUPER_STRICT is on. Reraising')
+            raise
+        return None
+    if VERBOSE_SVER:
+        print('[sver] Succesfully finished spatial verification.')
+    if returnAff:
+        svtup = (refined_inliers, refined_errors, H, aff_inliers, aff_errors, Aff)
+        return svtup
+    else:
+        svtup = (refined_inliers, refined_errors, H, None, None, None)
+        return svtup
+
+
 #@profile
 def spatially_verify_kpts(kpts1, kpts2, fm,
                           xy_thresh=.01,
@@ -971,7 +1450,11 @@ def spatially_verify_kpts(kpts1, kpts2, fm,
                           match_weights=None,
                           returnAff=False,
                           full_homog_checks=True,
-                          refine_method='homog'):
+                          refine_method='homog',
+                          hypo_mode='exhaustive',
+                          hypo_kw=None,
+                          precision='float64',
+                          workspace=None):
     """
     Driver function
     Spatially validates feature matches
@@ -991,6 +1474,18 @@ def spatially_verify_kpts(kpts1, kpts2, fm,
         dlen_sqrd2 (float): diagonal length squared of image/chip 2
         min_nInliers (int): default=4
         returnAff (bool): returns best affine hypothesis as well
+        hypo_mode (str): 'exhaustive' tests every affine hypothesis. 'sorted'
+            and 'prosac' test hypotheses in score order and can terminate
+            early to bound the verification latency.
+        hypo_kw (dict): options for get_best_affine_inliers_bounded
+            (max_hypotheses, time_budget, confidence, rng_seed)
+        precision (str): 'float64' or 'float32'. With 'float32' the native
+            exhaustive hypothesis search reads float32 keypoints directly
+            (no upcast copy) and uses a vectorized float32 kernel. Other
+            searches and the refinement still run in float64.
+        workspace (SverWorkspace): reuse the buffers of this workspace for the
+            native computations. The errors and matrices in the returned
+            svtup are then only valid until the workspace is used again.
 
     Returns:
         tuple : (refined_inliers, refined_errors, H, aff_inliers, aff_errors, Aff) if success else None
@@ -1043,14 +1538,23 @@ def spatially_verify_kpts(kpts1, kpts2, fm,
         tuple(numpy.ndarray, tuple(numpy.ndarray*3), numpy.ndarray, numpy.ndarray, tuple(numpy.ndarray*3), numpy.ndarray)
 
     """
+    if hypo_mode not in HYPO_MODES:
+        raise ValueError('Unknown hypo_mode=%r. Valid values are %r' % (
+            hypo_mode, HYPO_MODES))
     if len(fm) == 0:
         if VERBOSE_SVER:
             print('[sver] Cannot verify with no matches')
         svtup = None
         return svtup
-    # Cast keypoints to float64 to avoid numerical issues
-    kpts1 = kpts1.astype(np.float64, casting='same_kind', copy=False)
-    kpts2 = kpts2.astype(np.float64, casting='same_kind', copy=False)
+    if precision == 'float32' and HAVE_SVER_C_WRAPPER and hypo_mode == 'exhaustive':
+        # The native float32 kernel does not need float64 keypoints
+        kpts1 = kpts1.astype(np.float32, casting='same_kind', copy=False)
+        kpts2 = kpts2.astype(np.float32, casting='same_kind', copy=False)
+    else:
+        # Cast keypoints to float64 to avoid numerical issues
+        precision = 'float64'
+        kpts1 = kpts1.astype(np.float64, casting='same_kind', copy=False)
+        kpts2 = kpts2.astype(np.float64, casting='same_kind', copy=False)
     #kpts1 = kpts1.astype(np.float64)
     #kpts2 = kpts2.astype(np.float64)
     assert match_weights is not None, 'provide at least ones please for match_weights'
@@ -1062,63 +1566,116 @@ def spatially_verify_kpts(kpts1, kpts2, fm,
     # Determine the best hypothesis transformation and get its inliers
     xy_thresh_sqrd = dlen_sqrd2 * xy_thresh
     aff_inliers, aff_errors, Aff = get_best_affine_inliers_(
-        kpts1, kpts2, fm, fs, xy_thresh_sqrd, scale_thresh, ori_thresh)
+        kpts1, kpts2, fm, fs, xy_thresh_sqrd, scale_thresh, ori_thresh,
+        hypo_mode=hypo_mode, hypo_kw=hypo_kw, precision=precision,
+        workspace=workspace)
     #print(aff_inliers)
 
-    # Return if there are not enough inliers to compute homography
-    if len(aff_inliers) < min_nInliers:
-        # Test user defined param
-        if VERBOSE_SVER:
-            print('[sver] Failed spatial verification len(aff_inliers) = %r' %
-                  (len(aff_inliers),))
-        svtup = None
-        return svtup
-    if ((refine_method.endswith('homog') and len(aff_inliers) < 7) or
-         len(aff_inliers) < 4):
-        # Test fundamental param
-        # need to have 4 or more inliers to comopute an affine
-        # and need at least 7 to compute a homography
-        if VERBOSE_SVER:
-            print('[sver] Failed spatial verification len(aff_inliers) = %r' %
-                  (len(aff_inliers),))
-        svtup = None
-        return svtup
-    # Refine inliers using a projective transformation (homography)
-    try:
-        refined_inliers, refined_errors, H = refine_inliers(
-            kpts1, kpts2, fm, aff_inliers, xy_thresh_sqrd, scale_thresh,
-            ori_thresh, full_homog_checks, refine_method=refine_method)
-        #print(refined_inliers)
-    except npl.LinAlgError as ex:
-        if ut.VERYVERBOSE and ut.SUPER_STRICT:
-            ut.printex(ex, 'numeric error in homog estimation.', iswarning=True)
-        return None
-    except ValueError:
-        if ut.VERYVERBOSE and ut.SUPER_STRICT:
-            ut.printex(ex, 'error cv2 in homog estimation.', iswarning=True)
-        return None
-    except IndexError:
-        raise
-    except Exception as ex:
-        # There is a weird error that starts with MemoryError and ends up
-        # makeing len(h) = 6.
-        ut.printex(ex, 'Unknown error in homog estimation.',
-                      keys=['kpts1', 'kpts2',  'fm', 'fm.shape', 'kpts1.shape',
-                            (len, 'aff_inliers'),
-                            'kpts2.shape', 'xy_thresh', 'scale_thresh',
-                            'dlen_sqrd2', 'min_nInliers'])
-        if ut.SUPER_STRICT:
-            print('SUPER_STRICT is on. Reraising')
-            raise
-        return None
-    if VERBOSE_SVER:
-        print('[sver] Succesfully finished spatial verification.')
-    if returnAff:
-        svtup = (refined_inliers, refined_errors, H, aff_inliers, aff_errors, Aff)
-        return svtup
-    else:
-        svtup = (refined_inliers, refined_errors, H, None, None, None)
-        return svtup
+    return _refine_affine_hypothesis(
+        kpts1, kpts2, fm, aff_inliers, aff_errors, Aff, xy_thresh_sqrd,
+        scale_thresh, ori_thresh, min_nInliers, returnAff, full_homog_checks,
+        refine_method, workspace=workspace)
+
+
+def spatially_verify_kpts_batch(kpts1_list, kpts2_list, fm_list,
+                                match_weights_list, xy_thresh=.01,
+                                scale_thresh=2.0, ori_thresh=TAU / 4.0,
+                                dlen_sqrd2_list=None, min_nInliers=4,
+                                returnAff=False, full_homog_checks=True,
+                                refine_method='homog'):
+    r"""
+    Spatially verifies many pairs of keypoint matches at once.
+
+    The affine hypothesis search of every pair is done in a single call to the
+    C library (see sver_c_wrapper.get_best_affine_inliers_batch_cpp), so a
+    1-vs-N query pays the FFI cost once. Falls back to calling
+    spatially_verify_kpts on each pair if the C library is unavailable.
+
+    Args:
+        kpts1_list (list or ndarray): keypoints in image 1 for each pair. A
+            single ndarray is shared by every pair.
+        kpts2_list (list or ndarray): keypoints in image 2 for each pair. A
+            single ndarray is shared by every pair.
+        fm_list (list): feature matches for each pair
+        match_weights_list (list): match weights for each pair
+        dlen_sqrd2_list (list): diagonal length squared of each chip 2
+        (other args are the same as spatially_verify_kpts)
+
+    Returns:
+        list : svtup_list - the output of spatially_verify_kpts for each pair
+
+    CommandLine:
+        python -m vtool.spatial_verification --test-spatially_verify_kpts_batch
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from vtool.spatial_verification import *  # NOQA
+        >>> import vtool.tests.dummy as dummy
+        >>> kpts1, kpts2 = dummy.get_dummy_kpts_pair((100, 100))
+        >>> fm = dummy.make_dummy_fm(len(kpts1)).astype(np.int32)
+        >>> fm_list = [fm, fm[0:5], fm[0:0]]
+        >>> match_weights_list = [np.ones(len(fm_)) for fm_ in fm_list]
+        >>> dlen_sqrd2_list = [ktool.get_kpts_dlen_sqrd(kpts2)] * len(fm_list)
+        >>> svtup_list = spatially_verify_kpts_batch(
+        >>>     kpts1, kpts2, fm_list, match_weights_list, xy_thresh=.1,
+        >>>     dlen_sqrd2_list=dlen_sqrd2_list, refine_method='affine')
+        >>> for fm_, fs_, svtup in zip(fm_list, match_weights_list, svtup_list):
+        >>>     svtup_ = spatially_verify_kpts(
+        >>>         kpts1, kpts2, fm_, xy_thresh=.1,
+        >>>         dlen_sqrd2=dlen_sqrd2_list[0], match_weights=fs_,
+        >>>         refine_method='affine')
+        >>>     assert (svtup is None) == (svtup_ is None)
+        >>>     if svtup is not None:
+        >>>         assert np.all(svtup[0] == svtup_[0])
+        >>>         assert np.allclose(svtup[2], svtup_[2])
+        >>> result = [None if svtup is None else len(svtup[0]) for svtup in svtup_list]
+        >>> print(result)
+        [9, 4, None]
+    """
+    num_pairs = len(fm_list)
+    if dlen_sqrd2_list is None:
+        dlen_sqrd2_list = [None] * num_pairs
+    if not HAVE_SVER_C_WRAPPER:
+        _kpts1_iter = ([kpts1_list] * num_pairs
+                       if isinstance(kpts1_list, np.ndarray) else kpts1_list)
+        _kpts2_iter = ([kpts2_list] * num_pairs
+                       if isinstance(kpts2_list, np.ndarray) else kpts2_list)
+        svtup_list = [
+            spatially_verify_kpts(
+                kpts1, kpts2, fm, xy_thresh, scale_thresh, ori_thresh,
+                dlen_sqrd2, min_nInliers, match_weights, returnAff,
+                full_homog_checks, refine_method)
+            for kpts1, kpts2, fm, match_weights, dlen_sqrd2 in zip(
+                _kpts1_iter, _kpts2_iter, fm_list, match_weights_list,
+                dlen_sqrd2_list)
+        ]
+        return svtup_list
+    packed = sver_c_wrapper.pack_sver_jobs(kpts1_list, kpts2_list, fm_list,
+                                           match_weights_list)
+    kpts1_views, kpts2_views = packed['kpts1_views'], packed['kpts2_views']
+    # Get diagonal length if not provided
+    xy_thresh_sqrd_list = np.empty(num_pairs, dtype=np.float64)
+    for px, (kpts2, fm, dlen_sqrd2) in enumerate(zip(kpts2_views, fm_list,
+                                                     dlen_sqrd2_list)):
+        if dlen_sqrd2 is None:
+            kpts2_m = kpts2.take(fm.T[1], axis=0)
+            dlen_sqrd2 = ktool.get_kpts_dlen_sqrd(kpts2_m) if len(fm) > 0 else 0
+        xy_thresh_sqrd_list[px] = dlen_sqrd2 * xy_thresh
+    aff_inliers_list, aff_errors_list, Aff_mats, _ = (
+        sver_c_wrapper.get_best_affine_inliers_batch_cpp(
+            packed, xy_thresh_sqrd_list, scale_thresh, ori_thresh))
+    svtup_list = [
+        None if len(fm) == 0 else
+        _refine_affine_hypothesis(
+            kpts1, kpts2, fm, aff_inliers, aff_errors, Aff, xy_thresh_sqrd,
+            scale_thresh, ori_thresh, min_nInliers, returnAff,
+            full_homog_checks, refine_method)
+        for (kpts1, kpts2, fm, aff_inliers, aff_errors, Aff,
+             xy_thresh_sqrd) in zip(kpts1_views, kpts2_views, fm_list,
+                                    aff_inliers_list, aff_errors_list,
+                                    Aff_mats, xy_thresh_sqrd_list)
+    ]
+    return svtup_list
 
 
 if __name__ == '__main__':
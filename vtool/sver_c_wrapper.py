@@ -31,8 +31,12 @@ FLAGS_RW = 'aligned, c_contiguous, writeable'
 FLAGS_RO = 'aligned, c_contiguous'
 
 kpts_t = np.ctypeslib.ndpointer(dtype=kpts_dtype, ndim=2, flags=FLAGS_RO)
+kpts32_t = np.ctypeslib.ndpointer(dtype=np.float32, ndim=2, flags=FLAGS_RO)
 fm_t  = np.ctypeslib.ndpointer(dtype=fm_dtype, ndim=2, flags=FLAGS_RO)
 fs_t  = np.ctypeslib.ndpointer(dtype=fs_dtype, ndim=1, flags=FLAGS_RO)
+fs32_t  = np.ctypeslib.ndpointer(dtype=np.float32, ndim=1, flags=FLAGS_RO)
+offsets_t = np.ctypeslib.ndpointer(dtype=fm_dtype, ndim=1, flags=FLAGS_RO)
+threshs_t = np.ctypeslib.ndpointer(dtype=np.float64, ndim=1, flags=FLAGS_RO)
 
 
 def inliers_t(ndim):
@@ -43,6 +47,10 @@ def errs_t(ndim):
     return np.ctypeslib.ndpointer(dtype=np.float64, ndim=ndim, flags=FLAGS_RW)
 
 
+def errs32_t(ndim):
+    return np.ctypeslib.ndpointer(dtype=np.float32, ndim=ndim, flags=FLAGS_RW)
+
+
 def mats_t(ndim):
     return np.ctypeslib.ndpointer(dtype=np.float64, ndim=ndim, flags=FLAGS_RW)
 
@@ -90,50 +98,505 @@ if __name__ != '__main__':
                                        fm_t, fs_t, C.c_size_t,
                                        C.c_double, C.c_double, C.c_double,
                                        inliers_t(1), errs_t(2), mats_t(2)]
+    # get_affine_inliers for only the top_k hypotheses (returns the number
+    #  of hypotheses written)
+    c_getaffineinliers_topk = c_sver['get_affine_inliers_topk']
+    c_getaffineinliers_topk.restype = C.c_size_t
+    c_getaffineinliers_topk.argtypes = [kpts_t, C.c_size_t,
+                                        kpts_t, C.c_size_t,
+                                        fm_t, fs_t, C.c_size_t,
+                                        C.c_double, C.c_double, C.c_double,
+                                        C.c_size_t, offsets_t, errs_t(1),
+                                        inliers_t(2), errs_t(3), mats_t(3)]
+    # float32 version of get_best_affine_inliers (errors are float32)
+    c_getbestaffineinliers_f32 = c_sver['get_best_affine_inliers_f32']
+    c_getbestaffineinliers_f32.restype = C.c_int
+    c_getbestaffineinliers_f32.argtypes = [kpts32_t, C.c_size_t,
+                                           kpts32_t, C.c_size_t,
+                                           fm_t, fs32_t, C.c_size_t,
+                                           C.c_double, C.c_double, C.c_double,
+                                           inliers_t(1), errs32_t(2), mats_t(2)]
+    # get_best_affine_inliers for many jobs packed into flat buffers
+    #  (see pack_sver_jobs)
+    c_getbestaffineinliers_batch = c_sver['get_best_affine_inliers_batch']
+    c_getbestaffineinliers_batch.restype = None
+    c_getbestaffineinliers_batch.argtypes = [kpts_t, offsets_t,
+                                             kpts_t, offsets_t,
+                                             fm_t, fs_t, offsets_t, C.c_size_t,
+                                             threshs_t, C.c_double, C.c_double,
+                                             inliers_t(1), errs_t(1), mats_t(3),
+                                             errs_t(1)]
+    # refine the inliers of an affine hypothesis with a homography or affine
+    #  transform (returns nonzero if the transform is degenerate)
+    c_refineinliers = c_sver['refine_inliers']
+    c_refineinliers.restype = C.c_int
+    c_refineinliers.argtypes = [kpts_t, C.c_size_t,
+                                kpts_t, C.c_size_t,
+                                fm_t, C.c_size_t,
+                                offsets_t, C.c_size_t,
+                                C.c_double, C.c_double, C.c_double,
+                                C.c_bool, C.c_int,
+                                inliers_t(1), errs_t(2), mats_t(2)]
+    # refine_inliers for float32 keypoints
+    c_refineinliers_f32 = c_sver['refine_inliers_f32']
+    c_refineinliers_f32.restype = C.c_int
+    c_refineinliers_f32.argtypes = [kpts32_t, C.c_size_t,
+                                    kpts32_t, C.c_size_t,
+                                    fm_t, C.c_size_t,
+                                    offsets_t, C.c_size_t,
+                                    C.c_double, C.c_double, C.c_double,
+                                    C.c_bool, C.c_int,
+                                    inliers_t(1), errs_t(2), mats_t(2)]
+
+
+def _empty(workspace, key, shape, dtype):
+    """ np.empty, or a reused buffer if workspace (an SverWorkspace) is given """
+    if workspace is None:
+        return np.empty(shape, dtype)
+    return workspace.get(key, shape, dtype)
+
+
+def _ascontiguous(workspace, key, arr, dtype):
+    """ np.ascontiguousarray, but converts into workspace buffers if given """
+    if workspace is None:
+        return np.ascontiguousarray(arr, dtype=dtype)
+    return workspace.asarray(key, np.asarray(arr), dtype)
 
 
 @profile
-def get_affine_inliers_cpp(kpts1, kpts2, fm, fs, xy_thresh_sqrd, scale_thresh_sqrd, ori_thresh):
+def get_affine_inliers_cpp(kpts1, kpts2, fm, fs, xy_thresh_sqrd,
+                           scale_thresh_sqrd, ori_thresh, top_k=None,
+                           workspace=None):
+    r"""
+    Args:
+        top_k (int): if specified only the top_k hypotheses with the largest
+            inlier weight are returned (in descending order of weight). This
+            needs O(top_k * M) memory instead of O(M ** 2).
+        workspace (SverWorkspace): reuse these output buffers. The returned
+            errors and matrices are views into it.
+
+    Returns:
+        tuple: (out_inliers, out_errors, out_mats, hypo_idxs, weights) -
+            the inliers, errors, and matrix of each returned hypothesis, the
+            index of its defining match, and its inlier weight. Without top_k
+            every hypothesis is returned in match order (hypo_idxs is
+            arange(len(fm))).
+
+    CommandLine:
+        python -m vtool.sver_c_wrapper --test-get_affine_inliers_cpp
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from vtool.sver_c_wrapper import *  # NOQA
+        >>> from vtool.spatial_verification import SverWorkspace
+        >>> import vtool.tests.dummy as dummy
+        >>> kpts1, kpts2 = dummy.get_dummy_kpts_pair((100, 100))
+        >>> kpts1 = kpts1.astype(np.float64)
+        >>> kpts2 = kpts2.astype(np.float64)
+        >>> fm = dummy.make_dummy_fm(len(kpts1)).astype(fm_dtype)
+        >>> fs = np.ones(len(fm), dtype=np.float64)
+        >>> xy_thresh_sqrd = .001 * ktool.get_kpts_dlen_sqrd(kpts2)
+        >>> args = (kpts1, kpts2, fm, fs, xy_thresh_sqrd, 2.0, TAU / 4)
+        >>> full_tup = get_affine_inliers_cpp(*args)
+        >>> out_inliers, out_errors, out_mats, hypo_idxs, weights = full_tup
+        >>> workspace = SverWorkspace()
+        >>> top_tup = get_affine_inliers_cpp(*args, top_k=3, workspace=workspace)
+        >>> sortx = ut.argsort(weights.tolist(), reverse=True)
+        >>> assert np.all(top_tup[3] == hypo_idxs[sortx[0:3]])
+        >>> assert np.all(top_tup[4] == weights[sortx[0:3]])
+        >>> assert np.allclose(top_tup[2][0], out_mats[np.argmax(weights)])
+        >>> # the second call reuses the buffers of the first
+        >>> top_tup = get_affine_inliers_cpp(*args, top_k=3, workspace=workspace)
+        >>> result = ut.repr2({
+        >>>     'top_weights': top_tup[4].tolist(),
+        >>>     'top_num_inliers': [len(inliers) for inliers in top_tup[0]],
+        >>>     'num_allocs': workspace.num_allocs,
+        >>> })
+        >>> print(result)
+        {'num_allocs': 6, 'top_num_inliers': [4, 2, 2], 'top_weights': [4.0, 2.0, 2.0]}
+    """
     #np.ascontiguousarray(kpts1)
     #with ut.Timer('PreC'):
     num_matches = len(fm)
-    fm = np.ascontiguousarray(fm, dtype=fm_dtype)
-    out_inlier_flags = np.empty((num_matches, num_matches), np.bool)
-    out_errors = np.empty((num_matches, 3, num_matches), np.float64)
-    out_mats = np.empty((num_matches, 3, 3), np.float64)
-    #with ut.Timer('C'):
-    c_getaffineinliers(kpts1, kpts1.size,
-                       kpts2, kpts2.size,
-                       fm, fs, len(fm),
-                       xy_thresh_sqrd, scale_thresh_sqrd, ori_thresh,
-                       out_inlier_flags, out_errors, out_mats)
+    fm = _ascontiguous(workspace, 'fm', fm, fm_dtype)
+    # match scores may be float32 (e.g. from normalized_nearest_neighbors)
+    fs = _ascontiguous(workspace, 'fs', fs, fs_dtype)
+    if top_k is not None:
+        top_k = min(top_k, num_matches)
+        out_hypo_idxs = _empty(workspace, 'hypo_idxs', (top_k,), fm_dtype)
+        out_weights = _empty(workspace, 'weights', (top_k,), np.float64)
+        out_inlier_flags = _empty(workspace, 'inlier_flags', (top_k, num_matches), np.bool)
+        out_errors = _empty(workspace, 'errors', (top_k, 3, num_matches), np.float64)
+        out_mats = _empty(workspace, 'mats', (top_k, 3, 3), np.float64)
+        c_getaffineinliers_topk(kpts1, kpts1.size,
+                                kpts2, kpts2.size,
+                                fm, fs, len(fm),
+                                xy_thresh_sqrd, scale_thresh_sqrd, ori_thresh,
+                                top_k, out_hypo_idxs, out_weights,
+                                out_inlier_flags, out_errors, out_mats)
+    else:
+        out_inlier_flags = _empty(workspace, 'inlier_flags', (num_matches, num_matches), np.bool)
+        out_errors = _empty(workspace, 'errors', (num_matches, 3, num_matches), np.float64)
+        out_mats = _empty(workspace, 'mats', (num_matches, 3, 3), np.float64)
+        #with ut.Timer('C'):
+        c_getaffineinliers(kpts1, kpts1.size,
+                           kpts2, kpts2.size,
+                           fm, fs, len(fm),
+                           xy_thresh_sqrd, scale_thresh_sqrd, ori_thresh,
+                           out_inlier_flags, out_errors, out_mats)
     #with ut.Timer('C'):
     out_inliers = [np.where(row)[0] for row in out_inlier_flags]
     out_errors = list(map(tuple, out_errors))
-    return out_inliers, out_errors, out_mats
+    if top_k is None:
+        out_hypo_idxs = np.arange(num_matches, dtype=fm_dtype)
+        out_weights = np.array([fs.take(inliers).sum() for inliers in out_inliers],
+                               dtype=np.float64)
+    return out_inliers, out_errors, out_mats, out_hypo_idxs, out_weights
+
+
+# dtypes of the native affine hypothesis search
+SVER_PRECISIONS = ['float64', 'float32']
 
 
 @profile
 def get_best_affine_inliers_cpp(kpts1, kpts2, fm, fs, xy_thresh_sqrd,
-                                scale_thresh_sqrd, ori_thresh):
+                                scale_thresh_sqrd, ori_thresh,
+                                precision='float64', workspace=None):
+    r"""
+    Args:
+        precision (str): 'float64' or 'float32'. The float32 kernel reads
+            float32 keypoints without a cast copy and scores hypotheses with a
+            vectorized structure-of-arrays loop. The best few hypotheses are
+            re-scored with the exact tests that produce the returned inliers,
+            so the winner is chosen by the weight of its returned inliers.
+            Its errors are float32.
+        workspace (SverWorkspace): reuse these output buffers. The returned
+            errors and matrix are views into it.
+
+    CommandLine:
+        python -m vtool.sver_c_wrapper --test-get_best_affine_inliers_cpp
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from vtool.sver_c_wrapper import *  # NOQA
+        >>> import vtool.tests.dummy as dummy
+        >>> kpts1, kpts2 = dummy.get_dummy_kpts_pair((100, 100))
+        >>> fm = dummy.make_dummy_fm(len(kpts1)).astype(fm_dtype)
+        >>> fs = np.ones(len(fm), dtype=np.float64)
+        >>> xy_thresh_sqrd = .01 * ktool.get_kpts_dlen_sqrd(kpts2)
+        >>> args = (fm, fs, xy_thresh_sqrd, 2.0, TAU / 4)
+        >>> tup64 = get_best_affine_inliers_cpp(
+        >>>     kpts1.astype(np.float64), kpts2.astype(np.float64), *args)
+        >>> tup32 = get_best_affine_inliers_cpp(
+        >>>     kpts1.astype(np.float32), kpts2.astype(np.float32), *args,
+        >>>     precision='float32')
+        >>> assert np.all(tup64[0] == tup32[0])
+        >>> assert np.allclose(tup64[2], tup32[2], rtol=1E-4, atol=1E-3)
+        >>> result = ut.repr2((tup32[0].tolist(), str(tup32[1][0].dtype)))
+        >>> print(result)
+        ([0, 1, 2, 3, 4, 5, 6, 7, 8], 'float32')
+    """
     #np.ascontiguousarray(kpts1)
     #with ut.Timer('PreC'):
-    fm = np.ascontiguousarray(fm, dtype=fm_dtype)
-    out_inlier_flags = np.empty((len(fm),), np.bool)
-    out_errors = np.empty((3, len(fm)), np.float64)
-    out_mat = np.empty((3, 3), np.float64)
-    #with ut.Timer('C'):
-    c_getbestaffineinliers(kpts1, 6 * len(kpts1),
-                           kpts2, 6 * len(kpts2),
-                           fm, fs, len(fm),
-                           xy_thresh_sqrd, scale_thresh_sqrd, ori_thresh,
-                           out_inlier_flags, out_errors, out_mat)
+    fm = _ascontiguous(workspace, 'fm', fm, fm_dtype)
+    out_inlier_flags = _empty(workspace, 'inlier_flags', (len(fm),), np.bool)
+    out_mat = _empty(workspace, 'mat', (3, 3), np.float64)
+    if precision == 'float32':
+        # no copies if the keypoints are already float32 (e.g. from pyhesaff)
+        kpts1 = _ascontiguous(workspace, 'kpts1', kpts1, np.float32)
+        kpts2 = _ascontiguous(workspace, 'kpts2', kpts2, np.float32)
+        fs = _ascontiguous(workspace, 'fs', fs, np.float32)
+        out_errors = _empty(workspace, 'errors', (3, len(fm)), np.float32)
+        c_getbestaffineinliers_f32(kpts1, 6 * len(kpts1),
+                                   kpts2, 6 * len(kpts2),
+                                   fm, fs, len(fm),
+                                   xy_thresh_sqrd, scale_thresh_sqrd,
+                                   ori_thresh, out_inlier_flags, out_errors,
+                                   out_mat)
+    elif precision == 'float64':
+        # match scores may be float32 (e.g. from normalized_nearest_neighbors)
+        fs = _ascontiguous(workspace, 'fs', fs, fs_dtype)
+        out_errors = _empty(workspace, 'errors', (3, len(fm)), np.float64)
+        #with ut.Timer('C'):
+        c_getbestaffineinliers(kpts1, 6 * len(kpts1),
+                               kpts2, 6 * len(kpts2),
+                               fm, fs, len(fm),
+                               xy_thresh_sqrd, scale_thresh_sqrd, ori_thresh,
+                               out_inlier_flags, out_errors, out_mat)
+    else:
+        raise ValueError('Unknown precision=%r. Valid values are %r' % (
+            precision, SVER_PRECISIONS))
     #with ut.Timer('C'):
     out_inliers = np.where(out_inlier_flags)[0]
     out_errors = tuple(out_errors)
     return out_inliers, out_errors, out_mat
 
 
+# refine methods implemented by refine_inliers in sver.cpp
+REFINE_METHOD_CODES = {
+    'homog': 0,
+    'affine': 1,
+}
+
+
+@profile
+def refine_inliers_cpp(kpts1, kpts2, fm, aff_inliers, xy_thresh_sqrd,
+                       scale_thresh=2.0, ori_thresh=1.57,
+                       full_homog_checks=True, refine_method='homog',
+                       workspace=None):
+    r"""
+    Native version of spatial_verification.refine_inliers. Only supports
+    refine_method='homog' and refine_method='affine'. If workspace (an
+    SverWorkspace) is given the returned errors and matrix are views into it.
+    If both keypoint arrays are float32 they are read without a float64 copy
+    (the transform and errors are still computed in float64).
+
+    Returns:
+        tuple: (refined_inliers, refined_errors, H)
+
+    Raises:
+        np.linalg.LinAlgError: if the refined transform is rank deficient
+
+    CommandLine:
+        python -m vtool.sver_c_wrapper --test-refine_inliers_cpp
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from vtool.sver_c_wrapper import *  # NOQA
+        >>> import vtool.spatial_verification as sver
+        >>> import vtool.tests.dummy as dummy
+        >>> kpts1, kpts2 = dummy.get_dummy_kpts_pair((100, 100))
+        >>> kpts1 = kpts1.astype(np.float64)
+        >>> kpts2 = kpts2.astype(np.float64)
+        >>> fm = dummy.make_dummy_fm(len(kpts1)).astype(fm_dtype)
+        >>> aff_inliers = np.arange(len(fm))
+        >>> xy_thresh_sqrd = .01 * ktool.get_kpts_dlen_sqrd(kpts2)
+        >>> for refine_method in ['homog', 'affine']:
+        >>>     for full_homog_checks in [True, False]:
+        >>>         args = (kpts1, kpts2, fm, aff_inliers, xy_thresh_sqrd, 2.0,
+        >>>                 1.57, full_homog_checks, refine_method)
+        >>>         py_tup = sver.refine_inliers(*args, forcepy=True)
+        >>>         c_tup = refine_inliers_cpp(*args)
+        >>>         assert np.all(py_tup[0] == c_tup[0])
+        >>>         assert np.allclose(py_tup[2], c_tup[2])
+        >>>         for err1, err2 in zip(py_tup[1], c_tup[1]):
+        >>>             assert (err1 is None and err2 is None) or np.allclose(err1, err2)
+        >>> # float32 keypoints give the same refinement without a cast copy
+        >>> tup32 = refine_inliers_cpp(kpts1.astype(np.float32),
+        >>>                            kpts2.astype(np.float32), *args[2:])
+        >>> assert np.all(tup32[0] == c_tup[0])
+        >>> assert np.allclose(tup32[2], c_tup[2], rtol=1E-4, atol=1E-4)
+        >>> refined_inliers, refined_errors, H = c_tup
+        >>> result = np.array_str(H, precision=2, suppress_small=True)
+        >>> print(result)
+        [[ 0.99 -0.    0.21]
+         [ 0.01  1.01 -1.15]
+         [ 0.    0.    1.  ]]
+    """
+    num_matches = len(fm)
+    if kpts1.dtype == np.float32 and kpts2.dtype == np.float32:
+        c_refine = c_refineinliers_f32
+        kpts1 = _ascontiguous(workspace, 'kpts1', kpts1, np.float32)
+        kpts2 = _ascontiguous(workspace, 'kpts2', kpts2, np.float32)
+    else:
+        c_refine = c_refineinliers
+        kpts1 = _ascontiguous(workspace, 'kpts1', kpts1, kpts_dtype)
+        kpts2 = _ascontiguous(workspace, 'kpts2', kpts2, kpts_dtype)
+    fm = _ascontiguous(workspace, 'fm', fm, fm_dtype)
+    aff_inliers = _ascontiguous(workspace, 'aff_inliers', aff_inliers, fm_dtype)
+    method_code = REFINE_METHOD_CODES[refine_method]
+    out_inlier_flags = _empty(workspace, 'refined_inlier_flags', (num_matches,), np.bool)
+    out_errors = _empty(workspace, 'refined_errors', (3, num_matches), np.float64)
+    out_mat = _empty(workspace, 'H', (3, 3), np.float64)
+    failed = c_refine(kpts1, kpts1.size,
+                      kpts2, kpts2.size,
+                      fm, num_matches,
+                      aff_inliers, len(aff_inliers),
+                      xy_thresh_sqrd, scale_thresh, ori_thresh,
+                      full_homog_checks, method_code,
+                      out_inlier_flags, out_errors, out_mat)
+    if failed:
+        raise np.linalg.LinAlgError('Rank defficient homography ')
+    if refine_method == 'homog':
+        refined_inliers = np.where(out_inlier_flags)[0].astype(np.int32)
+    else:
+        refined_inliers = np.where(out_inlier_flags)[0]
+    if refine_method == 'homog' and not full_homog_checks:
+        refined_errors = (out_errors[0], None, None)
+    else:
+        refined_errors = tuple(out_errors)
+    return refined_inliers, refined_errors, out_mat
+
+
+def _stack_with_offsets(arr_list, dtype, ncols=None):
+    """
+    Stacks a list of arrays into one contiguous array and returns the
+    start offset of each array (with the total length appended)
+    """
+    lens = np.array([len(arr) for arr in arr_list], dtype=fm_dtype)
+    offsets = np.zeros(len(lens) + 1, dtype=fm_dtype)
+    np.cumsum(lens, out=offsets[1:])
+    if ncols is None:
+        shape = (offsets[-1],)
+        arr_list = [np.asarray(arr).ravel() for arr in arr_list]
+    else:
+        shape = (offsets[-1], ncols)
+        arr_list = [np.asarray(arr).reshape(-1, ncols) for arr in arr_list]
+    flat = np.empty(shape, dtype=dtype)
+    if len(arr_list) > 0:
+        np.concatenate(arr_list, out=flat)
+    return flat, offsets
+
+
+def pack_sver_jobs(kpts1_list, kpts2_list, fm_list, fs_list):
+    r"""
+    Packs many spatial verification jobs into flat offset-indexed buffers
+
+    Args:
+        kpts1_list (list): keypoints of image 1 for each job. If a single
+            ndarray is given it is shared by every job (i.e. 1-vs-N matching)
+            and is not copied.
+        kpts2_list (list): keypoints of image 2 for each job (or a shared ndarray)
+        fm_list (list): feature matches for each job
+        fs_list (list): feature scores for each job
+
+    Returns:
+        dict: packed - flat buffers and offsets understood by
+            get_best_affine_inliers_batch_cpp
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from vtool.sver_c_wrapper import *  # NOQA
+        >>> import vtool.tests.dummy as dummy
+        >>> kpts1, kpts2 = dummy.get_dummy_kpts_pair((100, 100))
+        >>> fm = dummy.make_dummy_fm(len(kpts1))
+        >>> fm_list = [fm, fm[0:4], fm[0:0]]
+        >>> fs_list = [np.ones(len(fm_)) for fm_ in fm_list]
+        >>> packed = pack_sver_jobs(kpts1, [kpts2] * 3, fm_list, fs_list)
+        >>> keys = ['kpts1_offsets', 'kpts2_offsets', 'fm_offsets']
+        >>> result = ut.repr2({key: packed[key].tolist() for key in keys}, nl=1)
+        >>> print(result)
+        {
+            'fm_offsets': [0, 9, 13, 13],
+            'kpts1_offsets': [0, 0, 0],
+            'kpts2_offsets': [0, 9, 18, 27],
+        }
+    """
+    num_jobs = len(fm_list)
+    assert len(fs_list) == num_jobs, 'must have a score for every job'
+
+    def _pack_kpts(kpts_list):
+        if isinstance(kpts_list, np.ndarray):
+            # All jobs share the same keypoints
+            kpts_flat = np.ascontiguousarray(kpts_list, dtype=kpts_dtype)
+            kpts_offsets = np.zeros(num_jobs, dtype=fm_dtype)
+            kpts_views = [kpts_flat] * num_jobs
+        else:
+            assert len(kpts_list) == num_jobs, 'must have keypoints for every job'
+            kpts_flat, kpts_offsets = _stack_with_offsets(kpts_list, kpts_dtype, 6)
+            kpts_views = [kpts_flat[start:stop] for start, stop in
+                          zip(kpts_offsets[:-1], kpts_offsets[1:])]
+        return kpts_flat, kpts_offsets, kpts_views
+    kpts1_flat, kpts1_offsets, kpts1_views = _pack_kpts(kpts1_list)
+    kpts2_flat, kpts2_offsets, kpts2_views = _pack_kpts(kpts2_list)
+    fm_flat, fm_offsets = _stack_with_offsets(fm_list, fm_dtype, 2)
+    fs_flat, fs_offsets = _stack_with_offsets(fs_list, fs_dtype)
+    assert np.all(fm_offsets == fs_offsets), 'fm and fs lengths disagree'
+    packed = {
+        'num_jobs': num_jobs,
+        'kpts1_flat': kpts1_flat,
+        'kpts1_offsets': kpts1_offsets,
+        'kpts2_flat': kpts2_flat,
+        'kpts2_offsets': kpts2_offsets,
+        # per-job (float64) keypoint views into the flat buffers
+        'kpts1_views': kpts1_views,
+        'kpts2_views': kpts2_views,
+        'fm_flat': fm_flat,
+        'fs_flat': fs_flat,
+        'fm_offsets': fm_offsets,
+    }
+    return packed
+
+
+@profile
+def get_best_affine_inliers_batch_cpp(packed, xy_thresh_sqrd_list,
+                                      scale_thresh_sqrd, ori_thresh):
+    r"""
+    Finds the best affine hypothesis for many pairs in a single native call.
+    Jobs are distributed over cores with OpenMP, so the FFI and thread startup
+    cost is paid once per batch instead of once per pair.
+
+    Args:
+        packed (dict): jobs packed by pack_sver_jobs
+        xy_thresh_sqrd_list (list or float): xy threshold for each job
+        scale_thresh_sqrd (float):
+        ori_thresh (float):
+
+    Returns:
+        tuple: (aff_inliers_list, aff_errors_list, Aff_mats, weights) -
+            per-job inliers and errors in the format of
+            get_best_affine_inliers_cpp, and the (num_jobs, 3, 3) affine
+            hypotheses with their inlier weights
+
+    CommandLine:
+        python -m vtool.sver_c_wrapper --test-get_best_affine_inliers_batch_cpp
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from vtool.sver_c_wrapper import *  # NOQA
+        >>> import vtool.spatial_verification as sver
+        >>> import vtool.tests.dummy as dummy
+        >>> kpts1, kpts2 = dummy.get_dummy_kpts_pair((100, 100))
+        >>> kpts1 = kpts1.astype(np.float64)
+        >>> kpts2 = kpts2.astype(np.float64)
+        >>> fm = dummy.make_dummy_fm(len(kpts1)).astype(fm_dtype)
+        >>> rng = np.random.RandomState(0)
+        >>> fm_list = [fm, fm[::-1], fm[0:5], fm[0:0]]
+        >>> fs_list = [rng.rand(len(fm_)) for fm_ in fm_list]
+        >>> xy_thresh_sqrd, scale_thresh_sqrd, ori_thresh = 50.0, 2.0, TAU / 4
+        >>> packed = pack_sver_jobs(kpts1, kpts2, fm_list, fs_list)
+        >>> batch_tup = get_best_affine_inliers_batch_cpp(
+        >>>     packed, xy_thresh_sqrd, scale_thresh_sqrd, ori_thresh)
+        >>> aff_inliers_list, aff_errors_list, Aff_mats, weights = batch_tup
+        >>> # Check against the python implementation (which cant handle no matches)
+        >>> for fm_, fs_, inliers, errors, Aff in list(zip(
+        >>>         fm_list, fs_list, aff_inliers_list, aff_errors_list, Aff_mats))[:-1]:
+        >>>     py_tup = sver.get_best_affine_inliers(
+        >>>         kpts1, kpts2, fm_, fs_, xy_thresh_sqrd, scale_thresh_sqrd,
+        >>>         ori_thresh, forcepy=True)
+        >>>     assert np.all(py_tup[0] == inliers)
+        >>>     assert np.allclose(py_tup[1], errors)
+        >>>     assert np.allclose(py_tup[2], Aff)
+        >>> result = ut.repr2(list(map(len, aff_inliers_list)))
+        >>> print(result)
+        [4, 4, 2, 0]
+    """
+    num_jobs = packed['num_jobs']
+    fm_offsets = packed['fm_offsets']
+    num_matches = fm_offsets[-1]
+    xy_thresh_sqrd_list = np.ascontiguousarray(np.broadcast_to(
+        xy_thresh_sqrd_list, (num_jobs,)), dtype=np.float64)
+    out_inlier_flags = np.zeros((num_matches,), np.bool)
+    out_errors = np.zeros((3 * num_matches,), np.float64)
+    out_mats = np.zeros((num_jobs, 3, 3), np.float64)
+    out_weights = np.zeros((num_jobs,), np.float64)
+    c_getbestaffineinliers_batch(packed['kpts1_flat'], packed['kpts1_offsets'],
+                                 packed['kpts2_flat'], packed['kpts2_offsets'],
+                                 packed['fm_flat'], packed['fs_flat'],
+                                 fm_offsets, num_jobs,
+                                 xy_thresh_sqrd_list, scale_thresh_sqrd,
+                                 ori_thresh, out_inlier_flags, out_errors,
+                                 out_mats, out_weights)
+    # Split the flat outputs into per-job views
+    aff_inliers_list = [
+        np.where(out_inlier_flags[start:stop])[0]
+        for start, stop in zip(fm_offsets[:-1], fm_offsets[1:])]
+    aff_errors_list = [
+        tuple(out_errors[3 * start:3 * stop].reshape(3, stop - start))
+        for start, stop in zip(fm_offsets[:-1], fm_offsets[1:])]
+    return aff_inliers_list, aff_errors_list, out_mats, out_weights
+
+
 def test_sver_wrapper2():
     r"""
     CommandLine:
@@ -260,7 +723,7 @@ def test_sver_wrapper():
         with ut.Indenter('[TEST1] '):
             inlier_tup = vt.compare_implementations(
                 sver.get_affine_inliers,
-                get_affine_inliers_cpp,
+                lambda *args: get_affine_inliers_cpp(*args)[0:3],
                 args, lbl1='py', lbl2='c',
                 output_lbl=('aff_inliers_list', 'aff_errors_list', 'Aff_mats')
             )
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+"""
+Compares direct and pyramid chip extraction across chip sizes
+
+CommandLine:
+    python -m vtool.tests.time_chip_extraction
+    python -m vtool.tests.time_chip_extraction --theta=0
+"""
+from __future__ import absolute_import, division, print_function
+import utool
+import timeit
+import numpy as np
+import cv2
+from vtool import chip as ctool
+from vtool import image as gtool
+
+
+def testdata_large_image(dsize=(4000, 3000)):
+    """ upsamples a test image to the size of a typical camera photo """
+    imgBGR = gtool.imread(utool.grab_test_imgpath('carl.jpg'))
+    imgBGR = cv2.resize(imgBGR, dsize, interpolation=cv2.INTER_CUBIC)
+    return imgBGR
+
+
+def antialiased_reference_chip(imgBGR, bbox, theta, new_size):
+    """ prefilters the whole image for the chip scale before warping """
+    sigma = max(bbox[2] / new_size[0], bbox[3] / new_size[1]) / 2.5
+    blurBGR = cv2.GaussianBlur(imgBGR, (0, 0), sigma) if sigma > .5 else imgBGR
+    return ctool.extract_chip_from_img(blurBGR, bbox, theta, new_size)
+
+
+def time_chip_extraction(chip_widths=[32, 64, 128, 256, 512, 1024, 2048],
+                         theta=.3, number=5, tol=2.0):
+    """
+    Times extract_chip_from_img with and without pyramid=True. Error is the
+    mean absolute difference to a chip warped from a prefiltered image, so
+    it measures aliasing as well as any divergence of the pyramid mode.
+    """
+    imgBGR = testdata_large_image()
+    img_h, img_w = imgBGR.shape[0:2]
+    bbox = (img_w // 20, img_h // 20, (img_w * 3) // 4, (img_h * 3) // 4)
+    print('----------')
+    print('BENCHMARK: ' + utool.get_caller_name())
+    print('image size = %r, bbox = %r, theta = %r' % ((img_w, img_h), bbox, theta))
+    row_list = []
+    for chip_width in chip_widths:
+        new_size = ctool.get_scaled_size_with_width(chip_width, *bbox[2:4])
+        ref_chip = antialiased_reference_chip(imgBGR, bbox, theta, new_size).astype(np.float32)
+        chip1 = ctool.extract_chip_from_img(imgBGR, bbox, theta, new_size)
+        chip2 = ctool.extract_chip_from_img(imgBGR, bbox, theta, new_size,
+                                            pyramid=True)
+        assert chip1.shape == chip2.shape
+        direct_err = np.abs(ref_chip - chip1).mean()
+        pyramid_err = np.abs(ref_chip - chip2).mean()
+        assert pyramid_err <= max(direct_err, tol), (
+            'pyramid chip diverged: err=%r' % (pyramid_err,))
+        direct_time = timeit.timeit(
+            lambda: ctool.extract_chip_from_img(imgBGR, bbox, theta, new_size),
+            number=number) / number
+        pyramid_time = timeit.timeit(
+            lambda: ctool.extract_chip_from_img(imgBGR, bbox, theta, new_size,
+                                                pyramid=True),
+            number=number) / number
+        row_list.append((new_size, direct_time, pyramid_time, direct_err,
+                         pyramid_err))
+    print('%12s %10s %10s %8s %10s %11s' % (
+        'chip size', 'direct', 'pyramid', 'speedup', 'direct_err',
+        'pyramid_err'))
+    for (new_size, direct_time, pyramid_time, direct_err,
+         pyramid_err) in row_list:
+        print('%12s %9.4fs %9.4fs %7.2fx %10.2f %11.2f' % (
+            '%dx%d' % tuple(new_size), direct_time, pyramid_time,
+            direct_time / pyramid_time, direct_err, pyramid_err))
+    return row_list
+
+
+if __name__ == '__main__':
+    theta = utool.get_argval('--theta', type_=float, default=.3)
+    time_chip_extraction(theta=theta)